@@ -1,24 +1,200 @@
 # single_file_app.py
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash
+from flask import (Flask, Response, request, jsonify, render_template, redirect, url_for, session, flash,
+                   current_app, g, has_request_context, stream_with_context)
+from flask.cli import AppGroup
+from flask_jwt_extended import (JWTManager, create_access_token, create_refresh_token, get_jwt,
+                                get_jwt_identity, jwt_required)
 from flask_sqlalchemy import SQLAlchemy
+from dotenv import load_dotenv
+from sqlalchemy import and_, case, event, insert, or_, select, union_all, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, joinedload, selectinload, validates
+from sqlalchemy.schema import CreateTable
 from werkzeug.security import generate_password_hash, check_password_hash
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta
-from functools import wraps
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache, wraps
+import base64
+import click
+import csv
+import hmac
+import io
+import json
 import logging
+import math
 import os
+import random
+import re
+import threading
+import time
+import zlib
 
-# Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Инициализация приложения
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///school_canteen.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'your-secret-key-here-change-in-production'
-
-# Инициализация базы данных
-db = SQLAlchemy(app)
+# Переменные окружения из файла .env (если он есть)
+load_dotenv()
+
+
+# ================== НАСТРОЙКИ ==================
+
+def parse_bool(value, default=False):
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_bool(name, default):
+    return parse_bool(os.environ.get(name), default)
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+# Ключ из исходников: годится только для локальной отладки
+DEFAULT_SECRET_KEY = 'your-secret-key-here-change-in-production'
+
+
+class Config:
+    """Настройки приложения; каждую можно переопределить переменной окружения"""
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///school_canteen.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY)
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+    # JWT для мобильного API (заголовок Authorization: Bearer); по умолчанию подписывается SECRET_KEY.
+    # Вне режима отладки ключ обязателен: с ключом из исходников токен подделает любой
+    JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or SECRET_KEY
+    JWT_TOKEN_LOCATION = ['headers']
+    JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=env_int('JWT_ACCESS_MINUTES', 60))
+    JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=env_int('JWT_REFRESH_DAYS', 30))
+
+    # Пул соединений
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 20)
+    DB_POOL_TIMEOUT = env_int('DB_POOL_TIMEOUT', 30)
+    DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+    DB_POOL_PRE_PING = env_bool('DB_POOL_PRE_PING', True)
+
+    # PRAGMA для SQLite, выполняются при каждом новом соединении
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)
+    SQLITE_CACHE_SIZE = env_int('SQLITE_CACHE_SIZE', -20000)  # отрицательное значение - в КиБ
+    SQLITE_MMAP_SIZE = env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+
+    # Роль и id ученика берутся из подписанной сессии
+    SESSION_IDENTITY_CACHE = env_bool('SESSION_IDENTITY_CACHE', True)
+
+    MENU_CACHE_BACKEND = os.environ.get('MENU_CACHE_BACKEND', 'memory')  # memory или redis
+    MENU_CACHE_TTL = env_int('MENU_CACHE_TTL', 300)
+    MENU_CACHE_MAX_ENTRIES = env_int('MENU_CACHE_MAX_ENTRIES', 256)
+    MENU_STOCK_TTL = env_int('MENU_STOCK_TTL', 2)
+
+    # Поток заказов для экранов кухни (SSE). memory - только внутри процесса, redis - между воркерами
+    ORDER_EVENTS_BACKEND = os.environ.get('ORDER_EVENTS_BACKEND', 'memory')
+    ORDER_EVENTS_BUFFER = env_int('ORDER_EVENTS_BUFFER', 1000)  # сколько событий хранится для переподключения
+    KITCHEN_STREAM_HEARTBEAT = env_int('KITCHEN_STREAM_HEARTBEAT', 15)
+    KITCHEN_STREAM_MAX_SECONDS = env_int('KITCHEN_STREAM_MAX_SECONDS', 300)
+
+    # Хеширование паролей: метод werkzeug ('scrypt', 'scrypt:16384:8:1', 'pbkdf2:sha256:600000');
+    # хеши старым методом пересчитываются при успешном входе
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', min(os.cpu_count() or 1, 4))  # 0 - в потоке запроса
+    PASSWORD_HASH_MAX_PENDING = env_int('PASSWORD_HASH_MAX_PENDING', 32)  # больше - отказ 503
+    PASSWORD_HASH_TIMEOUT = env_int('PASSWORD_HASH_TIMEOUT', 10)
+
+    # Ограничение неудачных попыток входа: ведро на логин - LOGIN_RATE_BURST попыток подряд,
+    # дальше LOGIN_RATE_PER_MINUTE в минуту; ведро на IP больше, за одним NAT сидит целый класс.
+    # Успешный вход попытку не расходует; 0 - без ограничения
+    LOGIN_RATE_BURST = env_int('LOGIN_RATE_BURST', 10)
+    LOGIN_RATE_PER_MINUTE = env_int('LOGIN_RATE_PER_MINUTE', 10)
+    LOGIN_IP_RATE_BURST = env_int('LOGIN_IP_RATE_BURST', 200)
+    LOGIN_IP_RATE_PER_MINUTE = env_int('LOGIN_IP_RATE_PER_MINUTE', 100)
+
+    # Сколько обратных прокси (nginx, балансировщик) стоит перед приложением: адрес клиента и схема
+    # берутся из их X-Forwarded-For/-Proto (ProxyFix). 0 - заголовкам не доверять
+    TRUSTED_PROXIES = env_int('TRUSTED_PROXIES', 0)
+
+    # Фоновые задачи: очередь в таблице jobs, исполнитель - отдельный процесс `flask run-jobs`.
+    # JOBS_ENABLED=1 запускает исполнитель еще и в каждом веб-процессе (для запуска одним процессом)
+    JOBS_ENABLED = env_bool('JOBS_ENABLED', False)
+    JOB_WORKERS = env_int('JOB_WORKERS', 2)
+    JOB_POLL_INTERVAL = env_int('JOB_POLL_INTERVAL', 2)
+    JOB_VISIBILITY_TIMEOUT = env_int('JOB_VISIBILITY_TIMEOUT', 300)  # после этого задачу может взять другой процесс
+    JOB_MAX_ATTEMPTS = env_int('JOB_MAX_ATTEMPTS', 5)
+    JOB_RETRY_BASE_DELAY = env_int('JOB_RETRY_BASE_DELAY', 10)
+    JOB_RETENTION_DAYS = env_int('JOB_RETENTION_DAYS', 7)
+    # Периодические задачи, секунды между запусками (0 - не запускать)
+    BALANCE_SNAPSHOT_INTERVAL = env_int('BALANCE_SNAPSHOT_INTERVAL', 3600)
+    STATS_RECONCILE_INTERVAL = env_int('STATS_RECONCILE_INTERVAL', 86400)
+    JOB_PRUNE_INTERVAL = env_int('JOB_PRUNE_INTERVAL', 3600)
+
+    # Байесовская оценка блюда: средняя оценка, сглаженная к общей средней с весом RATING_PRIOR_WEIGHT отзывов
+    RATING_PRIOR_WEIGHT = env_int('RATING_PRIOR_WEIGHT', 10)
+
+    # Прогноз спроса для количества порций: вес заказа убывает вдвое за FORECAST_HALF_LIFE_DAYS дней
+    FORECAST_HALF_LIFE_DAYS = env_int('FORECAST_HALF_LIFE_DAYS', 28)
+    FORECAST_SAFETY_PERCENT = env_int('FORECAST_SAFETY_PERCENT', 10)  # запас сверх прогноза
+    FORECAST_MIN_PORTIONS = env_int('FORECAST_MIN_PORTIONS', 10)
+    FORECAST_DEFAULT_PORTIONS = env_int('FORECAST_DEFAULT_PORTIONS', 100)  # для блюд без истории
+
+    # Пополнение склада: расход считается по заказам за окно, заявка создается, если запас
+    # опустится ниже минимума в пределах срока поставки; заказывается запас на REPLENISH_COVER_DAYS дней
+    REPLENISH_INTERVAL = env_int('REPLENISH_INTERVAL', 3600)
+    REPLENISH_WINDOW_DAYS = env_int('REPLENISH_WINDOW_DAYS', 28)
+    REPLENISH_LEAD_DAYS = env_int('REPLENISH_LEAD_DAYS', 3)
+    REPLENISH_COVER_DAYS = env_int('REPLENISH_COVER_DAYS', 14)
+
+    # Архив: выданные заказы старше горизонта с их оплатами переносятся в таблицы учебных полугодий
+    ARCHIVE_HORIZON_DAYS = env_int('ARCHIVE_HORIZON_DAYS', 365)
+    ARCHIVE_BATCH_SIZE = env_int('ARCHIVE_BATCH_SIZE', 1000)
+    ARCHIVE_INTERVAL = env_int('ARCHIVE_INTERVAL', 86400)
+
+    # Метрики и профилирование (по умолчанию выключены и ничего не стоят)
+    METRICS_ENABLED = env_bool('METRICS_ENABLED', False)
+    SLOW_QUERY_MS = env_int('SLOW_QUERY_MS', 0)  # 0 - не логировать медленные запросы
+    PROFILING_ENABLED = env_bool('PROFILING_ENABLED', False)
+    PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Profile')  # значение 'pyinstrument' - HTML-отчет
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')  # по умолчанию instance/profiles
+    # Профилирование доступно администратору или по токену в заголовке <PROFILE_HEADER>-Token
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+    # /metrics: с токеном - по заголовку Authorization: Bearer <токен>, без него - только с localhost
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+# Инициализация базы данных (подключается к приложению в create_app)
+db = SQLAlchemy()
+
+# Маршруты и команды CLI собираются здесь и регистрируются в create_app
+ROUTES = []
+cli = AppGroup('canteen')
+
+
+class Money(db.TypeDecorator):
+    """Денежная сумма: в базе целые копейки (как в журнале балансов), в Python - Decimal в рублях.
+    Суммы в SQL (SUM, триггеры счетчиков) считаются в копейках без ошибок округления."""
+    impl = db.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_kopecks(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else kopecks_to_rubles(value)
+
+
+def route(rule, **options):
+    """Декоратор маршрута: то же, что app.route, но для приложения из create_app"""
+
+    def decorator(view):
+        ROUTES.append((rule, view, options))
+        return view
+
+    return decorator
 
 
 # ================== МОДЕЛИ БАЗЫ ДАННЫХ ==================
@@ -32,6 +208,10 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_users_role', 'role'),
+    )
+
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -39,15 +219,34 @@ class User(db.Model):
 class Student(db.Model):
     __tablename__ = 'students'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     grade = db.Column(db.String(10), nullable=False)
     allergies = db.Column(db.Text, nullable=True)
     preferences = db.Column(db.Text, nullable=True)
-    balance = db.Column(db.Float, default=0.0)
+    # Битовая маска аллергенов и исключенных продуктов, разобранная из allergies и preferences
+    restriction_mask = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Баланс до перехода на журнал операций; перенесен в balance_ledger и больше не обновляется
+    legacy_balance = db.Column('balance', db.Float, default=0.0)
+
+    user = db.relationship('User', backref=db.backref('student', uselist=False))
 
     def __repr__(self):
         return f'<Student {self.id}>'
 
+    @property
+    def balance(self):
+        """Баланс в рублях (Decimal): снимок плюс операции журнала после него.
+        Считается один раз до конца транзакции: шаблоны читают его несколько раз за страницу,
+        а COMMIT (где и меняется журнал) сбрасывает значение вместе с остальными атрибутами."""
+        if '_balance_kopecks' not in self.__dict__:
+            self.__dict__['_balance_kopecks'] = get_balance(self.id)
+        return kopecks_to_rubles(self.__dict__['_balance_kopecks'])
+
+
+# Приемы пищи; другие значения menus.meal_type запрещены (валидатор модели и триггеры базы),
+# иначе такие блюда пропали бы из меню и кабинетов, которые строятся по этому списку
+MEAL_TYPES = ('breakfast', 'lunch')
+
 
 class Menu(db.Model):
     __tablename__ = 'menus'
@@ -56,12 +255,23 @@ class Menu(db.Model):
     meal_type = db.Column(db.String(20), nullable=False)  # breakfast, lunch
     dish_name = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=True)
-    price = db.Column(db.Float, nullable=False)
+    price = db.Column(Money, nullable=False)
     available_count = db.Column(db.Integer, default=100)
 
+    __table_args__ = (
+        db.Index('ix_menus_date_meal_type', 'date', 'meal_type'),
+        db.Index('uq_menus_date_meal_type_dish_name', 'date', 'meal_type', 'dish_name', unique=True),
+    )
+
     def __repr__(self):
         return f'<Menu {self.dish_name} ({self.date})>'
 
+    @validates('meal_type')
+    def validate_meal_type(self, key, value):
+        if value not in MEAL_TYPES:
+            raise ValueError(f"Прием пищи должен быть одним из: {', '.join(MEAL_TYPES)}")
+        return value
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -70,7 +280,8 @@ class Menu(db.Model):
             'meal_type_display': 'Завтрак' if self.meal_type == 'breakfast' else 'Обед',
             'dish_name': self.dish_name,
             'description': self.description,
-            'price': self.price,
+            # Строка '150.00': точная сумма, которая переживает JSON и кэш меню
+            'price': str(self.price) if self.price is not None else None,
             'available_count': self.available_count
         }
 
@@ -84,6 +295,14 @@ class Order(db.Model):
     status = db.Column(db.String(20), default='pending')  # pending, paid, issued
     payment_type = db.Column(db.String(20), nullable=True)  # single, subscription
 
+    student = db.relationship('Student', backref='orders')
+    menu = db.relationship('Menu', backref='orders')
+
+    __table_args__ = (
+        db.Index('ix_orders_order_date_status', 'order_date', 'status'),
+        db.Index('ix_orders_student_id_order_date', 'student_id', 'order_date'),
+    )
+
     def __repr__(self):
         return f'<Order {self.id} ({self.status})>'
 
@@ -92,15 +311,53 @@ class Payment(db.Model):
     __tablename__ = 'payments'
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     payment_date = db.Column(db.DateTime, default=datetime.utcnow)
-    method = db.Column(db.String(50), nullable=False)  # card, cash
+    method = db.Column(db.String(50), nullable=False)  # card, cash, balance (списание с баланса за заказ)
     status = db.Column(db.String(20), default='completed')
 
+    __table_args__ = (
+        db.Index('ix_payments_payment_date_status', 'payment_date', 'status'),
+    )
+
     def __repr__(self):
         return f'<Payment {self.id} ({self.amount})>'
 
 
+class BalanceEntry(db.Model):
+    """Операция по балансу ученика (журнал только дописывается). Сумма в копейках: + пополнение, - списание"""
+    __tablename__ = 'balance_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # opening, topup, charge, refund
+    # Без внешнего ключа: заказ может быть перенесен в архив полугодия (orders_archive_*), а строки журнала
+    # не меняются; заказ по order_id находится через history_select('orders', ...)
+    order_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Покрывающий индекс для суммы операций ученика после снимка
+        db.Index('ix_balance_ledger_student_id_id_amount', 'student_id', 'id', 'amount'),
+        db.Index('ix_balance_ledger_order_id', 'order_id'),
+    )
+
+    def __repr__(self):
+        return f'<BalanceEntry {self.id} ({self.kind} {self.amount})>'
+
+
+class BalanceSnapshot(db.Model):
+    """Баланс ученика на момент операции журнала ledger_id (пересчитывается периодически)"""
+    __tablename__ = 'balance_snapshots'
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), primary_key=True)
+    ledger_id = db.Column(db.Integer, nullable=False, default=0)
+    balance = db.Column(db.Integer, nullable=False, default=0)  # копейки
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<BalanceSnapshot {self.student_id} ({self.balance})>'
+
+
 class Product(db.Model):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
@@ -108,8 +365,16 @@ class Product(db.Model):
     unit = db.Column(db.String(20), nullable=False)  # кг, л, шт
     current_quantity = db.Column(db.Float, default=0)
     min_quantity = db.Column(db.Float, default=10)
+    # Битовая маска аллергенов (ALLERGENS); если не задана, определяется по названию
+    allergens = db.Column(db.Integer, nullable=False, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('uq_products_name', 'name', unique=True),
+        # Частичный индекс: только продукты с низким запасом, в порядке названия
+        db.Index('ix_products_low_stock_name', 'name', sqlite_where=db.text('current_quantity < min_quantity')),
+    )
+
     def __repr__(self):
         return f'<Product {self.name}>'
 
@@ -120,6 +385,7 @@ class Product(db.Model):
             'unit': self.unit,
             'current_quantity': self.current_quantity,
             'min_quantity': self.min_quantity,
+            'allergens': allergen_codes(self.allergens or 0),
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'is_low_stock': self.is_low_stock,
             'progress_percentage': self.progress_percentage
@@ -138,6 +404,24 @@ class Product(db.Model):
         return min(percentage, 100)
 
 
+class DishIngredient(db.Model):
+    """Продукт в составе блюда: сколько единиц продукта уходит на одну порцию"""
+    __tablename__ = 'dish_ingredients'
+    id = db.Column(db.Integer, primary_key=True)
+    dish_name = db.Column(db.String(200), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)  # в единицах продукта (кг, л, шт)
+
+    product = db.relationship('Product')
+
+    __table_args__ = (
+        db.Index('uq_dish_ingredients_dish_name_product_id', 'dish_name', 'product_id', unique=True),
+    )
+
+    def __repr__(self):
+        return f'<DishIngredient {self.dish_name}: {self.product_id} x {self.quantity}>'
+
+
 class PurchaseRequest(db.Model):
     __tablename__ = 'purchase_requests'
     id = db.Column(db.Integer, primary_key=True)
@@ -148,6 +432,11 @@ class PurchaseRequest(db.Model):
     requested_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     approved_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_purchase_requests_status_request_date', 'status', 'request_date'),
+        db.Index('ix_purchase_requests_request_date', 'request_date'),
+    )
+
     def __repr__(self):
         return f'<PurchaseRequest {self.id} ({self.status})>'
 
@@ -159,20 +448,202 @@ class Review(db.Model):
     dish_name = db.Column(db.String(200), nullable=False)
     rating = db.Column(db.Integer, nullable=False)  # 1-5
     comment = db.Column(db.Text, nullable=True)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     def __repr__(self):
         return f'<Review {self.id} ({self.rating} stars)>'
 
 
+class CatalogVersion(db.Model):
+    """Версия справочника (например, продуктов): растет при каждом изменении, обновляется триггерами"""
+    __tablename__ = 'catalog_versions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CatalogVersion {self.name} v{self.version}>'
+
+
+class Job(db.Model):
+    """Фоновая задача в очереди (хранится в базе и переживает перезапуск процесса)"""
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=True)  # JSON с аргументами задачи
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_name_status', 'name', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} ({self.status})>'
+
+
+class ArchivePartition(db.Model):
+    """Архивная таблица источника (заказы, оплаты) за учебное полугодие: число строк и диапазон дат"""
+    __tablename__ = 'archive_partitions'
+    table_name = db.Column(db.String(100), primary_key=True)
+    source = db.Column(db.String(50), nullable=False)  # orders, payments
+    term = db.Column(db.String(20), nullable=False)
+    rows_count = db.Column(db.Integer, nullable=False, default=0)
+    amount_total = db.Column(Money, nullable=False, default=0)  # сумма оплат (для payments)
+    date_from = db.Column(db.DateTime, nullable=True)
+    date_to = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ArchivePartition {self.table_name} ({self.rows_count} rows)>'
+
+
+class DashboardStats(db.Model):
+    """Счетчики для кабинета администратора (одна строка, обновляется триггерами)"""
+    __tablename__ = 'dashboard_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    users_total = db.Column(db.Integer, nullable=False, default=0)
+    students_total = db.Column(db.Integer, nullable=False, default=0)
+    cooks_total = db.Column(db.Integer, nullable=False, default=0)
+    admins_total = db.Column(db.Integer, nullable=False, default=0)
+    orders_total = db.Column(db.Integer, nullable=False, default=0)
+    payments_total = db.Column(db.Integer, nullable=False, default=0)
+    revenue_total = db.Column(Money, nullable=False, default=0)
+    reviews_total = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    purchase_requests_total = db.Column(db.Integer, nullable=False, default=0)
+    purchase_requests_pending = db.Column(db.Integer, nullable=False, default=0)
+    reconciled_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<DashboardStats {self.orders_total} orders>'
+
+    @property
+    def avg_rating(self):
+        if not self.reviews_total:
+            return 0
+        return self.rating_sum / self.reviews_total
+
+
+RATING_VALUES = range(1, 6)
+
+
+class DishRating(db.Model):
+    """Сводка отзывов о блюде: количество, сумма и распределение оценок (обновляется триггерами)"""
+    __tablename__ = 'dish_ratings'
+    dish_name = db.Column(db.String(200), primary_key=True)
+    reviews_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_1 = db.Column(db.Integer, nullable=False, default=0)
+    rating_2 = db.Column(db.Integer, nullable=False, default=0)
+    rating_3 = db.Column(db.Integer, nullable=False, default=0)
+    rating_4 = db.Column(db.Integer, nullable=False, default=0)
+    rating_5 = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DishRating {self.dish_name} ({self.reviews_count} reviews)>'
+
+    @property
+    def avg_rating(self):
+        if not self.reviews_count:
+            return 0
+        return self.rating_sum / self.reviews_count
+
+    @property
+    def histogram(self):
+        return {str(value): getattr(self, f'rating_{value}') for value in RATING_VALUES}
+
+
 # ================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==================
 
 def get_current_user():
-    """Получить текущего пользователя из сессии"""
-    if 'user_id' in session:
-        user = User.query.get(session['user_id'])
-        return user
-    return None
+    """Получить текущего пользователя из сессии (не больше одного запроса к базе за HTTP-запрос)"""
+    if 'user_id' not in session:
+        return None
+    if 'current_user' not in g:
+        g.current_user = User.query.get(session['user_id'])
+    return g.current_user
+
+
+class IdentityGone(Exception):
+    """Пользователь из сессии удален из базы"""
+
+
+class Identity:
+    """Текущий пользователь: id, имя, роль и id ученика без запроса к базе.
+    Остальные поля User загружаются из базы только при обращении к ним."""
+
+    def __init__(self, user_id, username, role, student_id):
+        self.id = user_id
+        self.username = username
+        self.role = role
+        self.student_id = student_id
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        user = get_current_user()
+        if user is None:
+            raise IdentityGone()
+        return getattr(user, name)
+
+    def __repr__(self):
+        return f'<Identity {self.username} ({self.role})>'
+
+
+def remember_identity(user):
+    """Сохранить пользователя и его профиль ученика в подписанной сессии"""
+    student = user.student if user.role == 'student' else None
+    session['user_id'] = user.id
+    session['username'] = user.username
+    session['role'] = user.role
+    session['student_id'] = student.id if student else None
+
+
+def get_identity():
+    """Получить текущего пользователя для проверки роли (из сессии, без запроса к базе)"""
+    if 'user_id' not in session:
+        return None
+    if 'identity' not in g:
+        if current_app.config['SESSION_IDENTITY_CACHE'] and 'role' in session and 'student_id' in session:
+            g.identity = Identity(session['user_id'], session.get('username'),
+                                  session['role'], session['student_id'])
+        else:
+            # Кэш выключен или сессия создана до его появления: читаем из базы один раз
+            user = get_current_user()
+            if user is None:
+                return None
+            if current_app.config['SESSION_IDENTITY_CACHE']:
+                remember_identity(user)
+            student = user.student if user.role == 'student' else None
+            g.identity = Identity(user.id, user.username, user.role, student.id if student else None)
+    return g.identity
+
+
+def get_current_student():
+    """Профиль текущего ученика (один раз за HTTP-запрос)"""
+    identity = get_identity()
+    if identity is None or identity.student_id is None:
+        return None
+    if 'current_student' not in g:
+        g.current_student = Student.query.get(identity.student_id)
+    return g.current_student
+
+
+def identity_gone(error):
+    """Сессия удаленного пользователя: очистить ее и отправить на вход"""
+    session.clear()
+    flash('Учетная запись не найдена, войдите снова', 'warning')
+    return redirect(url_for('login'))
 
 
 def login_required(f):
@@ -188,12 +659,55 @@ def login_required(f):
     return decorated_function
 
 
+def encode_cursor(values):
+    """Упаковать значения ключа последней строки страницы в курсор"""
+    plain = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(plain).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Распаковать курсор; None, если курсор пустой или поврежден"""
+    if not cursor:
+        return None
+    try:
+        plain = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if len(plain) != len(columns):
+            return None
+        values = []
+        for column, value in zip(columns, plain):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif python_type is not str:
+                value = python_type(value)
+            values.append(value)
+        return values
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def keyset_page(query, columns, cursor=None, limit=50, descending=True):
+    """Страница запроса по ключу (columns), без OFFSET: стоимость не зависит от номера страницы"""
+    values = decode_cursor(cursor, columns)
+    if values is not None:
+        key = db.tuple_(*columns)
+        query = query.filter(key < tuple(values) if descending else key > tuple(values))
+    query = query.order_by(*[column.desc() if descending else column.asc() for column in columns])
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in columns])
+    return items, next_cursor
+
+
 # Контекстный процессор для шаблонов
-@app.context_processor
 def utility_processor():
     import math
     return dict(
-        get_current_user=get_current_user,
+        # Шаблоны получают пользователя из сессии без запроса к базе; старое имя оставлено для совместимости
+        get_identity=get_identity,
+        get_current_user=get_identity,
         datetime=datetime,
         min=min,
         max=max,
@@ -206,13 +720,2563 @@ def utility_processor():
     )
 
 
+# ================== ПАРОЛИ И ВХОД ==================
+
+class PasswordHashingBusy(Exception):
+    """Очередь хеширования паролей переполнена"""
+
+
+class PasswordHasher:
+    """Хеширование и проверка паролей в пуле процессов: scrypt/pbkdf2 держат GIL, и вход целого класса
+    в потоках блокировал бы остальные запросы. Число ожидающих задач ограничено max_pending."""
+
+    def __init__(self, method, workers, max_pending, timeout):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn: дочерние процессы не наследуют соединения с базой и блокировки потоков
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _run(self, func, *args):
+        pool = self._pool()
+        if pool is None:
+            return func(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHashingBusy()
+        try:
+            return pool.submit(func, *args).result(timeout=self.timeout)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Хеш получен другим методом или с другими параметрами, чем задано сейчас"""
+        return password_hash.split('$', 1)[0] != hash_method_prefix(self.method)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+@lru_cache(maxsize=8)
+def hash_method_prefix(method):
+    """Полная запись метода в начале хеша ('scrypt' -> 'scrypt:32768:8:1')"""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def get_password_hasher():
+    """Пул хеширования паролей текущего приложения"""
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is None:
+        config = current_app.config
+        hasher = current_app.extensions.setdefault('password_hasher', PasswordHasher(
+            config['PASSWORD_HASH_METHOD'], config['PASSWORD_HASH_WORKERS'],
+            config['PASSWORD_HASH_MAX_PENDING'], config['PASSWORD_HASH_TIMEOUT']))
+    return hasher
+
+
+def hash_password(password):
+    return get_password_hasher().hash(password)
+
+
+def verify_password(user, password):
+    """Проверить пароль; при успехе хеш старым методом заменяется хешем по текущей политике"""
+    hasher = get_password_hasher()
+    if not password or not hasher.verify(user.password, password):
+        return False
+    if hasher.needs_rehash(user.password):
+        user.password = hasher.hash(password)
+        db.session.commit()
+    return True
+
+
+class RateLimiter:
+    """Ведра токенов в памяти процесса: burst попыток подряд, дальше rate в секунду.
+    Попытка разрешена, только если токен есть во всех ведрах ее ключей."""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}  # ключ -> (токены, время последнего обновления)
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allow(self, *keys):
+        """(True, 0) и списание токена или (False, через сколько секунд появится токен)"""
+        now = time.monotonic()
+        with self._lock:
+            levels = {key: self._tokens(key, now) for key in keys}
+            lowest = min(levels.values())
+            if lowest < 1:
+                return False, math.ceil((1 - lowest) / self.rate) if self.rate else 60
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return True, 0
+
+    def refund(self, *keys):
+        """Вернуть списанный токен (попытка оказалась успешной)"""
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                if key in self._buckets:
+                    self._buckets[key] = (min(self.burst, self._tokens(key, now) + 1), now)
+
+    def _prune(self, now):
+        """Убрать полностью восстановившиеся ведра (они ничем не отличаются от новых)"""
+        for key in [key for key in self._buckets if self._tokens(key, now) >= self.burst]:
+            del self._buckets[key]
+
+
+# Вид ключа ограничения попыток входа -> (настройка запаса, настройка скорости в минуту)
+LOGIN_LIMITS = {
+    'user': ('LOGIN_RATE_BURST', 'LOGIN_RATE_PER_MINUTE'),
+    'ip': ('LOGIN_IP_RATE_BURST', 'LOGIN_IP_RATE_PER_MINUTE'),
+}
+
+
+def get_login_limiter(kind):
+    """Ограничитель попыток входа текущего приложения для ключей вида kind ('user', 'ip');
+    None, если его запас в настройках равен 0"""
+    config = current_app.config
+    burst_setting, rate_setting = LOGIN_LIMITS[kind]
+    if config[burst_setting] <= 0:
+        return None
+    limiters = current_app.extensions.setdefault('login_limiters', {})
+    limiter = limiters.get(kind)
+    if limiter is None:
+        limiter = limiters.setdefault(kind, RateLimiter(config[rate_setting] / 60, config[burst_setting]))
+    return limiter
+
+
+def login_retry_after(*keys):
+    """0, если попытка входа разрешена (по токену списано со всех ведер ключей), иначе через сколько
+    секунд повторить. Ключи - пары (вид, значение): ('user', логин), ('ip', адрес клиента)."""
+    charged = []
+    for key in keys:
+        limiter = get_login_limiter(key[0])
+        if limiter is None:
+            continue
+        allowed, retry_after = limiter.allow(key)
+        if not allowed:
+            for charged_limiter, charged_key in charged:
+                charged_limiter.refund(charged_key)
+            logger.warning(f"Слишком много попыток входа: {keys}")
+            return retry_after
+        charged.append((limiter, key))
+    return 0
+
+
+def login_succeeded(*keys):
+    """Вернуть попытку, списанную login_retry_after: ограничиваются только неудачные входы"""
+    for key in keys:
+        limiter = get_login_limiter(key[0])
+        if limiter is not None:
+            limiter.refund(key)
+
+
+def login_rate_limited(*keys):
+    """Ответ 429, если у ключей (логин, IP) закончились попытки, иначе None"""
+    retry_after = login_retry_after(*keys)
+    if not retry_after:
+        return None
+    response = current_app.make_response(
+        (render_template('login.html', error='Слишком много попыток, попробуйте позже'), 429))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# ================== ЗАГРУЗКА ДАННЫХ ДЛЯ КАБИНЕТОВ ==================
+
+# Сколько SQL-запросов может выполнить загрузка кабинета независимо от числа заказов
+DASHBOARD_QUERY_BUDGET = 5
+
+
+def day_range(column, day):
+    """Условие 'дата-время попадает в день' в виде полуинтервала, который использует индекс"""
+    start = datetime.combine(day, datetime.min.time())
+    return and_(column >= start, column < start + timedelta(days=1))
+
+
+def student_orders_query(student_id, day):
+    """Запрос заказов ученика за день вместе с блюдами"""
+    return (Order.query
+            .options(selectinload(Order.menu))
+            .filter(Order.student_id == student_id, day_range(Order.order_date, day)))
+
+
+def kitchen_orders_query(day):
+    """Запрос заказов за день для кухни: блюдо, ученик и пользователь одним JOIN"""
+    return (Order.query
+            .options(joinedload(Order.menu),
+                     joinedload(Order.student).joinedload(Student.user))
+            .filter(day_range(Order.order_date, day))
+            .order_by(Order.order_date))
+
+
+def menu_for_date_query(day):
+    """Запрос меню на день"""
+    return Menu.query.filter_by(date=day).order_by(Menu.meal_type, Menu.dish_name)
+
+
+def load_student_orders(student_id, day):
+    """Заказы ученика за день вместе с блюдами (без ленивых подзапросов)"""
+    return student_orders_query(student_id, day).all()
+
+
+def load_kitchen_orders(day):
+    """Заказы за день для кухни вместе с блюдами и учениками"""
+    return kitchen_orders_query(day).all()
+
+
+class QueryCounter:
+    """Контекстный менеджер, считающий SQL-запросы к базе"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self._on_execute)
+        return False
+
+
+# ================== КЭШ МЕНЮ ==================
+
+
+class LRUCacheBackend:
+    """Кэш в памяти процесса: LRU с ограничением размера и временем жизни записей"""
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class LocalRedisClient:
+    """Локальная замена Redis-клиента (get/setex/delete) для работы без сервера Redis"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._data.pop(key, None)
+                return None
+            return entry[0]
+
+    def setex(self, key, seconds, value):
+        with self._lock:
+            self._data[key] = (value if isinstance(value, bytes) else str(value).encode(),
+                               time.monotonic() + seconds)
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+
+class RedisCacheBackend:
+    """Кэш в Redis-совместимом хранилище, значения сериализуются в JSON"""
+
+    def __init__(self, client, ttl=300, prefix='canteen:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.setex(self.prefix + key, int(ttl or self.ttl) or 1, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+
+def make_cache_backend(config):
+    """Создать бэкенд кэша по настройкам приложения"""
+    ttl = config['MENU_CACHE_TTL']
+    if config['MENU_CACHE_BACKEND'] == 'redis':
+        redis_url = os.environ.get('REDIS_URL')
+        if redis_url:
+            try:
+                import redis
+                return RedisCacheBackend(redis.Redis.from_url(redis_url), ttl=ttl)
+            except ImportError:
+                logger.warning("Пакет redis не установлен, используется локальная замена")
+        return RedisCacheBackend(LocalRedisClient(), ttl=ttl)
+    return LRUCacheBackend(max_entries=config['MENU_CACHE_MAX_ENTRIES'], ttl=ttl)
+
+
+def get_menu_cache():
+    """Кэш меню текущего приложения"""
+    cache = current_app.extensions.get('menu_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('menu_cache', make_cache_backend(current_app.config))
+    return cache
+
+
+def menu_cache_key(day, meal_type):
+    return f'menu:{day.isoformat()}:{meal_type}'
+
+
+def menu_stock_key(day):
+    return f'stock:{day.isoformat()}'
+
+
+def get_menu_for_date(day):
+    """Меню на день (список словарей Menu.to_dict с аллергенами) через кэш с актуальными остатками"""
+    cache = get_menu_cache()
+    cached = {meal_type: cache.get(menu_cache_key(day, meal_type)) for meal_type in MEAL_TYPES}
+    if any(items is None for items in cached.values()):
+        cached = {meal_type: [] for meal_type in MEAL_TYPES}
+        items = menu_for_date_query(day).all()
+        # Аллергены блюд считаются один раз при заполнении кэша дня
+        masks = dish_allergen_masks(item.dish_name for item in items)
+        for item in items:
+            mask = masks.get(item.dish_name, 0)
+            cached.setdefault(item.meal_type, []).append(
+                dict(item.to_dict(), allergen_mask=mask, allergens=allergen_labels(mask),
+                     allergens_known=item.dish_name in masks))
+        for meal_type in MEAL_TYPES:
+            cache.set(menu_cache_key(day, meal_type), cached[meal_type])
+
+    # Остатки меняются при каждом заказе, поэтому хранятся отдельно с коротким TTL
+    stock = cache.get(menu_stock_key(day))
+    if stock is None:
+        stock = {str(menu_id): count for menu_id, count in db.session.execute(
+            select(Menu.id, Menu.available_count).where(Menu.date == day)
+        ).all()}
+        cache.set(menu_stock_key(day), stock, ttl=current_app.config['MENU_STOCK_TTL'])
+
+    return [
+        dict(item, available_count=stock.get(str(item['id']), item['available_count']))
+        for meal_type in MEAL_TYPES
+        for item in cached[meal_type]
+    ]
+
+
+def invalidate_menu_stock(*days):
+    """Сбросить кэш остатков на указанные дни"""
+    get_menu_cache().delete(*[menu_stock_key(day) for day in set(days)])
+
+
+def invalidate_menu_cache(day, meal_type=None):
+    """Сбросить кэш меню (и остатков) на день или на один прием пищи"""
+    meal_types = [meal_type] if meal_type else MEAL_TYPES
+    get_menu_cache().delete(*[menu_cache_key(day, value) for value in meal_types], menu_stock_key(day))
+
+
+def invalidate_menu_cache_on_commit(session, day, meal_type=None):
+    """Отложить сброс кэша меню до фиксации транзакции session: до COMMIT другой запрос
+    заполнил бы кэш старыми данными, а после отката сбрасывать нечего"""
+    session.info.setdefault('menu_cache_pending', set()).add((day, meal_type))
+
+
+@event.listens_for(Session, 'after_commit')
+def flush_menu_cache_invalidations(session):
+    for day, meal_type in session.info.pop('menu_cache_pending', ()):
+        invalidate_menu_cache(day, meal_type)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_menu_cache_invalidations(session):
+    session.info.pop('menu_cache_pending', None)
+
+
+@event.listens_for(Menu, 'after_insert')
+@event.listens_for(Menu, 'after_update')
+@event.listens_for(Menu, 'after_delete')
+def invalidate_menu_on_change(mapper, connection, target):
+    """Изменение блюда через ORM сбрасывает кэш старого и нового дня после COMMIT"""
+    state = db.inspect(target)
+    days = set(state.attrs.date.history.deleted or ()) | {target.date}
+    meal_types = set(state.attrs.meal_type.history.deleted or ()) | {target.meal_type}
+    for day in days:
+        for meal_type in meal_types:
+            if day and meal_type:
+                invalidate_menu_cache_on_commit(state.session, day, meal_type)
+
+
+# ================== АЛЛЕРГЕНЫ ==================
+
+# Номер бита -> (код, название, шаблоны слов); порядок не менять, маски хранятся в базе.
+# Шаблон сопоставляется с началом слова, \b в конце требует совпадения слова целиком.
+ALLERGENS = [
+    ('milk', 'Молоко', (r'молок', r'молоч', r'лактоз', r'сыр\b', r'сыра', r'сырн', r'творог', r'творож', r'сливк',
+                        r'сливоч', r'сметан', r'кефир', r'йогурт')),
+    ('gluten', 'Глютен', (r'глютен', r'пшени', r'мука', r'муки', r'мучн', r'лапш', r'макарон', r'хлеб', r'ячмен',
+                          r'овес', r'овся', r'блин')),
+    ('eggs', 'Яйца', (r'яйц', r'яиц', r'яич', r'омлет')),
+    ('fish', 'Рыба', (r'рыб', r'лосос', r'треск', r'минта', r'горбуш')),
+    ('shellfish', 'Морепродукты', (r'морепродукт', r'креветк', r'кальмар', r'мидии')),
+    ('nuts', 'Орехи', (r'орех', r'арахис', r'миндал', r'фундук')),
+    ('soy', 'Соя', (r'со[яие]\b', r'соев')),
+    ('sesame', 'Кунжут', (r'кунжут',)),
+    ('citrus', 'Цитрусовые', (r'цитрус', r'апельсин', r'лимон', r'мандарин', r'грейпфрут')),
+    ('honey', 'Мед', (r'м[её]д\b', r'меда\b', r'медом\b', r'медов')),
+    # Не аллерген, но исключается по предпочтениям (вегетарианцы)
+    ('meat', 'Мясо', (r'мяс', r'куриц', r'курин', r'говяд', r'свин', r'индейк', r'котлет', r'фарш', r'колбас')),
+]
+ALLERGEN_PATTERNS = [re.compile(r'\b(?:' + '|'.join(patterns) + ')') for _, _, patterns in ALLERGENS]
+ALLERGEN_BITS = {code: 1 << bit for bit, (code, _, _) in enumerate(ALLERGENS)}
+
+# Предпочтения, исключающие группы продуктов целиком
+DIET_EXCLUSIONS = {
+    'вегетариан': ('meat', 'fish', 'shellfish'),
+    'веган': ('meat', 'fish', 'shellfish', 'milk', 'eggs', 'honey'),
+}
+
+
+def parse_allergens(text):
+    """Битовая маска аллергенов, упомянутых в тексте (по кодам ALLERGENS или шаблонам слов)"""
+    text = (text or '').lower()
+    mask = 0
+    for word in re.findall(r'\w+', text):
+        mask |= ALLERGEN_BITS.get(word, 0)
+    for bit, pattern in enumerate(ALLERGEN_PATTERNS):
+        if pattern.search(text):
+            mask |= 1 << bit
+    return mask
+
+
+def parse_restrictions(allergies, preferences):
+    """Маска ограничений ученика: аллергии, диета ("вегетарианец") и "без ..." в предпочтениях"""
+    mask = parse_allergens(allergies)
+    preferences = (preferences or '').lower()
+    for stem, codes in DIET_EXCLUSIONS.items():
+        if stem in preferences:
+            for code in codes:
+                mask |= ALLERGEN_BITS[code]
+    for phrase in re.findall(r'без\s+(\w+)', preferences):
+        mask |= parse_allergens(phrase)
+    return mask
+
+
+def allergen_codes(mask):
+    return [code for code, bit in ALLERGEN_BITS.items() if mask & bit]
+
+
+def allergen_labels(mask):
+    return [label for bit, (_, label, _) in enumerate(ALLERGENS) if mask & (1 << bit)]
+
+
+def dish_allergen_masks(dish_names):
+    """Маски аллергенов блюд: объединение масок продуктов из состава (один запрос).
+    Блюда без состава в результат не попадают: их аллергены неизвестны, а не отсутствуют."""
+    names = set(dish_names)
+    if not names:
+        return {}
+    masks = {}
+    for dish_name, allergens in db.session.execute(
+        select(DishIngredient.dish_name, Product.allergens)
+        .join(Product, Product.id == DishIngredient.product_id)
+        .where(DishIngredient.dish_name.in_(names))
+    ).all():
+        masks[dish_name] = masks.get(dish_name, 0) | (allergens or 0)
+    return masks
+
+
+def restricted_dishes(restrictions, dish_names):
+    """Блюда, которые нельзя ученику с маской ограничений, и причина: запрещенные продукты или неизвестный состав"""
+    if not restrictions:
+        return {}
+    masks = dish_allergen_masks(dish_names)
+    reasons = {}
+    for dish_name in set(dish_names):
+        if dish_name not in masks:
+            reasons[dish_name] = 'Состав блюда не указан, аллергены неизвестны'
+        elif masks[dish_name] & restrictions:
+            reasons[dish_name] = f"Блюдо содержит: {', '.join(allergen_labels(masks[dish_name] & restrictions))}"
+    return reasons
+
+
+def filter_menu_for_student(menu, student):
+    """Блюда меню (из get_menu_for_date), в которых нет ничего из ограничений ученика"""
+    return filter_menu_by_restrictions(menu, (student.restriction_mask or 0) if student else 0)
+
+
+def filter_menu_by_restrictions(menu, restrictions):
+    """Ученику с ограничениями не показываются блюда с запрещенными продуктами и блюда без состава"""
+    if not restrictions:
+        return list(menu)
+    return [item for item in menu
+            if item.get('allergens_known', False) and not item['allergen_mask'] & restrictions]
+
+
+@event.listens_for(Student, 'before_insert')
+@event.listens_for(Student, 'before_update')
+def parse_student_restrictions(mapper, connection, target):
+    """Маска ограничений пересчитывается только при изменении текста аллергий или предпочтений"""
+    state = db.inspect(target)
+    if state.attrs.allergies.history.has_changes() or state.attrs.preferences.history.has_changes():
+        target.restriction_mask = parse_restrictions(target.allergies, target.preferences)
+
+
+@event.listens_for(Product, 'before_insert')
+def detect_product_allergens(mapper, connection, target):
+    if target.allergens is None:
+        target.allergens = parse_allergens(target.name)
+
+
+def dish_menu_days(connection, dish_names):
+    """Дни меню с сегодняшнего, где есть эти блюда"""
+    if not dish_names:
+        return []
+    return connection.execute(
+        select(Menu.date).distinct()
+        .where(Menu.dish_name.in_(set(dish_names)), Menu.date >= datetime.now().date())
+    ).scalars().all()
+
+
+def invalidate_dish_menus(session, connection, dish_names):
+    """Сбросить после COMMIT кэш меню на дни, где есть эти блюда (их аллергены изменились)"""
+    for day in dish_menu_days(connection, dish_names):
+        invalidate_menu_cache_on_commit(session, day)
+
+
+@event.listens_for(DishIngredient, 'after_insert')
+@event.listens_for(DishIngredient, 'after_update')
+@event.listens_for(DishIngredient, 'after_delete')
+def invalidate_menus_on_recipe_change(mapper, connection, target):
+    state = db.inspect(target)
+    invalidate_dish_menus(state.session, connection,
+                          set(state.attrs.dish_name.history.deleted or ()) | {target.dish_name})
+
+
+@event.listens_for(Product, 'after_update')
+def invalidate_menus_on_allergen_change(mapper, connection, target):
+    state = db.inspect(target)
+    if state.attrs.allergens.history.has_changes():
+        invalidate_dish_menus(state.session, connection, connection.execute(
+            select(DishIngredient.dish_name).where(DishIngredient.product_id == target.id)
+        ).scalars().all())
+
+
+# ================== СОБЫТИЯ ЗАКАЗОВ ДЛЯ КУХНИ ==================
+
+class MemoryEventBus:
+    """Шина событий в памяти процесса: кольцевой буфер последних событий и ожидание новых.
+    Id события - 'эпоха:номер'; эпоха меняется при перезапуске процесса."""
+
+    def __init__(self, buffer_size=1000):
+        self._events = deque(maxlen=buffer_size)
+        self._epoch = f'{int(time.time() * 1000):x}'
+        self._last_number = 0
+        self._condition = threading.Condition()
+
+    def publish(self, event_type, data):
+        with self._condition:
+            self._last_number += 1
+            event = {'id': f'{self._epoch}:{self._last_number}', 'type': event_type, 'data': data}
+            self._events.append((self._last_number, event))
+            self._condition.notify_all()
+        return event['id']
+
+    def last_id(self):
+        with self._condition:
+            return f'{self._epoch}:{self._last_number}'
+
+    def read(self, last_id, timeout=0):
+        """События после last_id, при их отсутствии ждет до timeout секунд.
+        None - события после last_id уже вытеснены из буфера (или id от другого процесса)."""
+        epoch, _, number = (last_id or '').partition(':')
+        if epoch != self._epoch or not number.isdigit():
+            return None
+        number = int(number)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if number > self._last_number:
+                    return None
+                if number < self._last_number:
+                    first_number = self._events[0][0] if self._events else self._last_number + 1
+                    if number + 1 < first_number:
+                        return None
+                    return [event for event_number, event in self._events if event_number > number]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+
+
+class RedisEventBus:
+    """Шина событий на Redis Streams: общая для всех воркеров, id событий - id записей потока"""
+
+    def __init__(self, client, stream='canteen:order-events', buffer_size=1000):
+        self.client = client
+        self.stream = stream
+        self.buffer_size = buffer_size
+
+    def publish(self, event_type, data):
+        event_id = self.client.xadd(self.stream, {'type': event_type, 'data': json.dumps(data)},
+                                    maxlen=self.buffer_size, approximate=True)
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+
+    def last_id(self):
+        entries = self.client.xrevrange(self.stream, count=1)
+        return self._decode(entries[0][0]) if entries else '0-0'
+
+    def read(self, last_id, timeout=0):
+        import redis
+        try:
+            first = self.client.xrange(self.stream, count=1)
+            if first and last_id != '0-0' and self._key(last_id) < self._key(self._decode(first[0][0])):
+                return None
+            options = {'block': int(timeout * 1000)} if timeout else {}
+            response = self.client.xread({self.stream: last_id}, count=self.buffer_size, **options)
+        except (redis.ResponseError, ValueError):
+            return None
+        return [
+            {'id': self._decode(entry_id), 'type': self._decode(fields[b'type']),
+             'data': json.loads(fields[b'data'])}
+            for _, entries in response or [] for entry_id, fields in entries
+        ]
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    @staticmethod
+    def _key(event_id):
+        milliseconds, _, sequence = event_id.partition('-')
+        return int(milliseconds), int(sequence or 0)
+
+
+def make_event_bus(config):
+    """Создать шину событий заказов по настройкам приложения"""
+    buffer_size = config['ORDER_EVENTS_BUFFER']
+    if config['ORDER_EVENTS_BACKEND'] == 'redis':
+        redis_url = os.environ.get('REDIS_URL')
+        if redis_url:
+            try:
+                import redis
+                return RedisEventBus(redis.Redis.from_url(redis_url), buffer_size=buffer_size)
+            except ImportError:
+                logger.warning("Пакет redis не установлен, события заказов доступны только внутри процесса")
+        else:
+            logger.warning("REDIS_URL не задан, события заказов доступны только внутри процесса")
+    return MemoryEventBus(buffer_size=buffer_size)
+
+
+def get_event_bus():
+    """Шина событий заказов текущего приложения"""
+    bus = current_app.extensions.get('order_events')
+    if bus is None:
+        bus = current_app.extensions.setdefault('order_events', make_event_bus(current_app.config))
+    return bus
+
+
+def kitchen_order_payload(order):
+    """Заказ в том виде, в каком его показывает экран кухни"""
+    return {
+        'id': order.id,
+        'status': order.status,
+        'order_date': order.order_date.isoformat() if order.order_date else None,
+        'menu_id': order.menu_id,
+        'menu_date': order.menu.date.isoformat() if order.menu else None,
+        'meal_type': order.menu.meal_type if order.menu else None,
+        'dish_name': order.menu.dish_name if order.menu else None,
+        'student_name': order.student.user.username if order.student and order.student.user else None,
+        'grade': order.student.grade if order.student else None,
+    }
+
+
+def publish_order_events(event_type, order_ids):
+    """Разослать экранам кухни события по заказам: один запрос к базе на пачку, а не на каждый экран"""
+    if not order_ids:
+        return
+    try:
+        orders = (Order.query
+                  .options(joinedload(Order.menu), joinedload(Order.student).joinedload(Student.user))
+                  .filter(Order.id.in_(list(order_ids)))
+                  .order_by(Order.id)
+                  .all())
+        bus = get_event_bus()
+        for order in orders:
+            bus.publish(event_type, kitchen_order_payload(order))
+    except Exception as e:
+        # Заказ уже сохранен; экраны кухни догонят состояние при переподключении
+        logger.warning(f"Не удалось разослать события заказов {list(order_ids)}: {e}")
+
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+
+def kitchen_event_stream(bus, last_id, heartbeat, max_seconds):
+    """Поток Server-Sent Events: пропущенные события, затем новые по мере появления.
+    Через max_seconds поток завершается, и браузер переподключается с Last-Event-ID."""
+    yield "retry: 3000\n\n"
+    if last_id is None:
+        last_id = bus.last_id()
+    deadline = time.monotonic() + max_seconds
+    while time.monotonic() < deadline:
+        events = bus.read(last_id, timeout=min(heartbeat, max(deadline - time.monotonic(), 0)))
+        if events is None:
+            # Пропущенные события уже не восстановить: экран должен заново загрузить заказы
+            last_id = bus.last_id()
+            yield format_sse({'id': last_id, 'type': 'reset', 'data': {}})
+        elif events:
+            last_id = events[-1]['id']
+            yield ''.join(format_sse(event) for event in events)
+        else:
+            yield ': keepalive\n\n'
+
+
+# ================== БАЛАНС УЧЕНИКОВ ==================
+
+KOPECK = Decimal('0.01')
+
+
+def to_kopecks(value):
+    """Сумма в рублях (число или строка) в целых копейках с округлением до копейки"""
+    try:
+        return int((Decimal(str(value)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f'Некорректная сумма: {value}')
+
+
+def kopecks_to_rubles(kopecks):
+    return (Decimal(kopecks or 0) / 100).quantize(KOPECK)
+
+
+def balance_expression(student_id):
+    """Баланс ученика в копейках как скалярный подзапрос: снимок + сумма операций после него"""
+    snapshot = BalanceSnapshot.__table__
+    snapshot_balance = select(snapshot.c.balance).where(snapshot.c.student_id == student_id).scalar_subquery()
+    snapshot_ledger_id = select(snapshot.c.ledger_id).where(snapshot.c.student_id == student_id).scalar_subquery()
+    delta = (select(db.func.sum(BalanceEntry.amount))
+             .where(BalanceEntry.student_id == student_id,
+                    BalanceEntry.id > db.func.coalesce(snapshot_ledger_id, 0))
+             .scalar_subquery())
+    return db.func.coalesce(snapshot_balance, 0) + db.func.coalesce(delta, 0)
+
+
+def get_balance(student_id):
+    """Баланс ученика в копейках"""
+    return db.session.execute(select(balance_expression(student_id))).scalar()
+
+
+@event.listens_for(Student, 'expire')
+def forget_student_balance(target, attrs):
+    """Сбросить запомненный Student.balance при COMMIT, ROLLBACK или expire()"""
+    target.__dict__.pop('_balance_kopecks', None)
+
+
+def credit_balance(student_id, kopecks, kind='topup'):
+    """Записать пополнение (или начальный остаток) в журнал; вставка, а не UPDATE строки ученика"""
+    db.session.add(BalanceEntry(student_id=student_id, amount=kopecks, kind=kind))
+
+
+def charge_orders(student_id, charges):
+    """Атомарно записать списания за заказы [(order_id, копейки), ...]; False, если средств недостаточно.
+    Все строки журнала вставляются одной командой INSERT ... SELECT с проверкой баланса на всю сумму,
+    затем по оплате на заказ (их видят счетчики выручки и выгрузка платежей)."""
+    total = sum(amount for _, amount in charges)
+    now = datetime.utcnow()
+    rows = db.union_all(*[
+        select(db.literal(order_id).label('order_id'), db.literal(-amount).label('amount'))
+        for order_id, amount in charges
+    ]).subquery()
+    result = db.session.execute(
+        insert(BalanceEntry).from_select(
+            ['student_id', 'amount', 'kind', 'order_id', 'created_at'],
+            select(db.literal(student_id), rows.c.amount, db.literal('charge'), rows.c.order_id, db.literal(now))
+            .where(balance_expression(student_id) >= total)
+        )
+    )
+    if result.rowcount != len(charges):
+        return False
+    db.session.execute(insert(Payment), [
+        {'order_id': order_id, 'amount': kopecks_to_rubles(amount), 'payment_date': now, 'method': 'balance',
+         'status': 'completed'}
+        for order_id, amount in charges
+    ])
+    return True
+
+
+# Перенос снимков вперед: снимок + операции после него, для всех учеников одной командой
+SNAPSHOT_BALANCES_SQL = """
+    INSERT OR REPLACE INTO balance_snapshots (student_id, ledger_id, balance, created_at)
+    SELECT l.student_id, MAX(l.id), COALESCE(s.balance, 0) + SUM(l.amount), :now
+    FROM balance_ledger l
+    LEFT JOIN balance_snapshots s ON s.student_id = l.student_id
+    WHERE l.id > COALESCE(s.ledger_id, 0)
+    GROUP BY l.student_id
+"""
+
+# Снимки с нуля по всему журналу
+REBUILD_SNAPSHOTS_SQL = """
+    INSERT OR REPLACE INTO balance_snapshots (student_id, ledger_id, balance, created_at)
+    SELECT student_id, MAX(id), SUM(amount), :now FROM balance_ledger GROUP BY student_id
+"""
+
+
+def snapshot_balances(connection, rebuild=False):
+    """Обновить снимки балансов всех учеников; вернуть число обновленных снимков"""
+    sql = REBUILD_SNAPSHOTS_SQL if rebuild else SNAPSHOT_BALANCES_SQL
+    return connection.execute(db.text(sql), {'now': datetime.utcnow()}).rowcount
+
+
+def verify_balances():
+    """Сверить баланс по снимкам с полной суммой журнала; список расхождений (id, по снимку, по журналу)"""
+    full = dict(db.session.execute(
+        select(BalanceEntry.student_id, db.func.sum(BalanceEntry.amount)).group_by(BalanceEntry.student_id)
+    ).all())
+    snapshots = {row.student_id: row for row in db.session.execute(
+        select(BalanceSnapshot.student_id, BalanceSnapshot.ledger_id, BalanceSnapshot.balance)
+    ).all()}
+    delta = dict(db.session.execute(
+        select(BalanceEntry.student_id, db.func.sum(BalanceEntry.amount))
+        .select_from(BalanceEntry)
+        .outerjoin(BalanceSnapshot, BalanceSnapshot.student_id == BalanceEntry.student_id)
+        .where(BalanceEntry.id > db.func.coalesce(BalanceSnapshot.ledger_id, 0))
+        .group_by(BalanceEntry.student_id)
+    ).all())
+    mismatches = []
+    for student_id in sorted(set(full) | set(snapshots)):
+        snapshot = snapshots.get(student_id)
+        fast = (snapshot.balance if snapshot else 0) + (delta.get(student_id) or 0)
+        expected = full.get(student_id) or 0
+        if fast != expected:
+            mismatches.append((student_id, fast, expected))
+    return mismatches
+
+
+# ================== ОФОРМЛЕНИЕ ЗАКАЗОВ ==================
+
+# Повторы при блокировке SQLite: количество попыток и базовая задержка (сек)
+ORDER_RETRY_ATTEMPTS = 6
+ORDER_RETRY_BASE_DELAY = 0.01
+ORDER_RETRY_MAX_DELAY = 0.5
+
+
+class OrderError(Exception):
+    """Заказ не может быть оформлен (сообщение показывается пользователю)"""
+
+    def __init__(self, message, category='warning'):
+        super().__init__(message)
+        self.message = message
+        self.category = category
+
+
+def is_database_locked(error):
+    """Проверить, что ошибка вызвана блокировкой SQLite"""
+    return isinstance(error, OperationalError) and 'database is locked' in str(error.orig)
+
+
+def run_with_retry(func, *args, attempts=ORDER_RETRY_ATTEMPTS, **kwargs):
+    """Выполнить транзакцию с ограниченными повторами при 'database is locked'"""
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_database_locked(e) or attempt == attempts - 1:
+                raise
+            # Экспоненциальная задержка со случайным разбросом, чтобы покупатели не повторяли синхронно
+            delay = min(ORDER_RETRY_BASE_DELAY * (2 ** attempt), ORDER_RETRY_MAX_DELAY)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            logger.debug(f"База заблокирована, повтор {attempt + 1}/{attempts - 1}")
+
+
+def take_stock(menu_id, quantity=1):
+    """Атомарно списать порции блюда; False, если порций не хватает"""
+    result = db.session.execute(
+        update(Menu)
+        .where(Menu.id == menu_id, Menu.available_count >= quantity)
+        .values(available_count=Menu.available_count - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def _place_order_once(student_id, menu_id):
+    menu = Menu.query.get(menu_id)
+    if not menu:
+        raise OrderError('Блюдо не найдено', 'danger')
+    price = to_kopecks(menu.price)
+    restrictions = db.session.scalar(select(Student.restriction_mask).where(Student.id == student_id))
+    reason = restricted_dishes(restrictions, [menu.dish_name]).get(menu.dish_name)
+    if reason:
+        raise OrderError(reason, 'danger')
+
+    # Сначала условный UPDATE остатка: транзакция сразу берет блокировку на запись,
+    # а проверка и списание выполняются одной командой без гонки
+    if not take_stock(menu.id):
+        db.session.rollback()
+        raise OrderError('Это блюдо закончилось')
+
+    order = Order(
+        student_id=student_id,
+        menu_id=menu.id,
+        status='pending'
+    )
+    menu_date = menu.date
+    db.session.add(order)
+    db.session.flush()
+
+    # Списание - строка журнала со ссылкой на заказ, строка ученика не обновляется
+    if not charge_orders(student_id, [(order.id, price)]):
+        db.session.rollback()
+        raise OrderError('Недостаточно средств на балансе')
+    db.session.commit()
+    invalidate_menu_stock(menu_date)
+    return order
+
+
+def place_order(student_id, menu_id):
+    """Оформить заказ: списать порцию и деньги без перепродажи"""
+    order = run_with_retry(_place_order_once, student_id, menu_id)
+    publish_order_events('order_created', [order.id])
+    return order
+
+
+# Максимум позиций в одной корзине и число попыток при конкурентном изменении остатков
+CHECKOUT_MAX_ITEMS = 50
+CHECKOUT_CONFLICT_ATTEMPTS = 3
+
+
+class CheckoutConflict(Exception):
+    """Остаток или баланс изменились между проверкой и списанием"""
+
+
+def _checkout_once(student_id, menu_ids):
+    wanted = Counter(menu_ids)
+
+    # Остатки, цены, баланс и ограничения ученика для всей корзины одним запросом
+    rows = db.session.execute(
+        select(Menu.id, Menu.date, Menu.dish_name, Menu.price, Menu.available_count,
+               balance_expression(student_id).label('balance'),
+               select(Student.restriction_mask).where(Student.id == student_id)
+               .scalar_subquery().label('restrictions'))
+        .where(Menu.id.in_(list(wanted)))
+    ).all()
+    menus = {row.id: row for row in rows}
+    balance = rows[0].balance if rows else 0
+    restricted = restricted_dishes(rows[0].restrictions if rows else 0, [row.dish_name for row in rows])
+    remaining = {row.id: row.available_count for row in rows}
+
+    # Позиции рассматриваются в порядке корзины: что не помещается в остаток или баланс, отклоняется
+    results = []
+    accepted = Counter()
+    total = 0
+    for menu_id in menu_ids:
+        row = menus.get(menu_id)
+        item = {'menu_id': menu_id}
+        if row is None:
+            item.update(status='not_found', message='Блюдо не найдено')
+        elif row.dish_name in restricted:
+            item.update(status='restricted', dish_name=row.dish_name, message=restricted[row.dish_name])
+        elif remaining[menu_id] <= 0:
+            item.update(status='sold_out', dish_name=row.dish_name, message='Это блюдо закончилось')
+        elif total + to_kopecks(row.price) > balance:
+            item.update(status='insufficient_funds', dish_name=row.dish_name,
+                        message='Недостаточно средств на балансе')
+        else:
+            remaining[menu_id] -= 1
+            accepted[menu_id] += 1
+            total += to_kopecks(row.price)
+            item.update(status='ok', dish_name=row.dish_name, price=str(row.price))
+        results.append(item)
+
+    if not accepted:
+        db.session.rollback()
+        return results, 0
+
+    for menu_id, quantity in accepted.items():
+        if not take_stock(menu_id, quantity):
+            db.session.rollback()
+            raise CheckoutConflict()
+
+    # Все заказы корзины одной многострочной вставкой
+    ok_results = [item for item in results if item['status'] == 'ok']
+    order_ids = db.session.scalars(
+        insert(Order).returning(Order.id, sort_by_parameter_order=True),
+        [{'student_id': student_id, 'menu_id': item['menu_id'], 'status': 'pending'} for item in ok_results]
+    ).all()
+    # Списания за все заказы одной командой с проверкой баланса на всю сумму
+    if not charge_orders(student_id, [(order_id, to_kopecks(item['price']))
+                                      for order_id, item in zip(order_ids, ok_results)]):
+        db.session.rollback()
+        raise CheckoutConflict()
+    db.session.commit()
+    invalidate_menu_stock(*[menus[menu_id].date for menu_id in accepted])
+
+    ok_items = iter(order_ids)
+    for item in results:
+        if item['status'] == 'ok':
+            item['order_id'] = next(ok_items)
+    return results, str(kopecks_to_rubles(total))
+
+
+def checkout(student_id, menu_ids):
+    """Оформить корзину заказов одной транзакцией"""
+    for attempt in range(CHECKOUT_CONFLICT_ATTEMPTS):
+        try:
+            results, total = run_with_retry(_checkout_once, student_id, menu_ids)
+            publish_order_events('order_created', [item['order_id'] for item in results if 'order_id' in item])
+            return results, total
+        except CheckoutConflict:
+            logger.debug(f"Корзина ученика {student_id} изменилась при оформлении, повтор {attempt + 1}")
+    raise OrderError('Не удалось оформить корзину, попробуйте еще раз')
+
+
+# Допустимые переходы статуса заказа: новый статус -> статус, из которого в него можно перейти
+ORDER_TRANSITIONS = {'paid': 'pending', 'issued': 'paid'}
+ORDER_BATCH_MAX = 500
+
+
+def class_orders_filter(grade, meal_type, day):
+    """Условие 'заказы класса на прием пищи в этот день' (подзапросы по индексам students и menus)"""
+    return and_(
+        Order.student_id.in_(select(Student.id).where(Student.grade == grade)),
+        Order.menu_id.in_(select(Menu.id).where(Menu.date == day, Menu.meal_type == meal_type)),
+    )
+
+
+def _transition_orders_once(status, condition):
+    updated = db.session.scalars(
+        update(Order)
+        .where(condition, Order.status == ORDER_TRANSITIONS[status])
+        .values(status=status)
+        .returning(Order.id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    return updated
+
+
+def transition_orders(status, order_ids=None, grade=None, meal_type=None, day=None):
+    """Перевести заказы в статус status одним UPDATE с проверкой текущего статуса.
+    Заказы задаются списком id или классом и приемом пищи; возвращает (обновленные id, пропущенные)
+    в обоих режимах: пропущены заказы в другом статусе и (для списка id) не найденные."""
+    if order_ids is not None:
+        condition = Order.id.in_(order_ids)
+    else:
+        condition = class_orders_filter(grade, meal_type, day)
+    updated = sorted(run_with_retry(_transition_orders_once, status, condition))
+
+    if order_ids is not None:
+        missing = set(order_ids) - set(updated)
+        current = dict(db.session.execute(
+            select(Order.id, Order.status).where(Order.id.in_(missing))
+        ).all()) if missing else {}
+    else:
+        # Заказы класса, которые не подошли по статусу (тем же условием, что и UPDATE)
+        current = dict(db.session.execute(
+            select(Order.id, Order.status).where(condition, Order.id.notin_(updated))
+        ).all())
+        missing = set(current)
+    skipped = [
+        {'id': order_id, 'reason': 'status', 'status': current[order_id]} if order_id in current
+        else {'id': order_id, 'reason': 'not_found'}
+        for order_id in sorted(missing)
+    ]
+    publish_order_events('order_status', updated)
+    return updated, skipped
+
+
+# ================== ИМПОРТ МЕНЮ И ПРОДУКТОВ ==================
+
+# Строк в одной пачке вставки (одна транзакция) и сколько ошибок разбора возвращать
+IMPORT_CHUNK_SIZE = 2000
+IMPORT_MAX_ERRORS = 100
+IMPORT_FORMATS = ('csv', 'jsonl')
+
+
+def import_field(row, name, default=None):
+    """Значение поля строки импорта без пробелов по краям; default, если поле пустое"""
+    value = row.get(name)
+    if isinstance(value, str):
+        value = value.strip()
+    return default if value in (None, '') else value
+
+
+def import_number(row, name, default=None, cast=float):
+    """Числовое поле строки импорта (неотрицательное)"""
+    value = import_field(row, name, default)
+    if value is None:
+        raise ValueError(f'Поле {name} обязательно')
+    try:
+        number = cast(value)
+    except (ValueError, TypeError):
+        raise ValueError(f'Поле {name} должно быть числом')
+    if number < 0:
+        raise ValueError(f'Поле {name} не может быть отрицательным')
+    return number
+
+
+def parse_menu_row(row):
+    """Проверить строку импорта меню и привести значения к типам столбцов"""
+    raw_date = import_field(row, 'date')
+    if raw_date is None:
+        raise ValueError('Поле date обязательно')
+    try:
+        day = datetime.strptime(str(raw_date), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('Дата должна быть в формате ГГГГ-ММ-ДД')
+    meal_type = import_field(row, 'meal_type')
+    if meal_type not in MEAL_TYPES:
+        raise ValueError(f"Поле meal_type должно быть одним из: {', '.join(MEAL_TYPES)}")
+    dish_name = import_field(row, 'dish_name')
+    if not dish_name:
+        raise ValueError('Поле dish_name обязательно')
+    if len(str(dish_name)) > 200:
+        raise ValueError('Название блюда длиннее 200 символов')
+    return {
+        'date': day,
+        'meal_type': meal_type,
+        'dish_name': str(dish_name),
+        'description': import_field(row, 'description'),
+        'price': import_number(row, 'price'),
+        # Без количества порций в файле новое блюдо получит прогноз спроса (fill_forecast_counts),
+        # а у существующего остаток не изменится
+        'available_count': (import_number(row, 'available_count', cast=int)
+                            if import_field(row, 'available_count') is not None else None),
+    }
+
+
+def parse_product_row(row):
+    """Проверить строку импорта продукта и привести значения к типам столбцов"""
+    name = import_field(row, 'name')
+    if not name:
+        raise ValueError('Название продукта обязательно')
+    if len(str(name)) > 200:
+        raise ValueError('Название продукта длиннее 200 символов')
+    unit = import_field(row, 'unit')
+    if not unit:
+        raise ValueError('Единица измерения обязательна')
+    return {
+        'name': str(name),
+        'unit': str(unit),
+        'current_quantity': import_number(row, 'current_quantity', default=0),
+        'min_quantity': import_number(row, 'min_quantity', default=10),
+        # Коды или названия через запятую; без столбца аллергены определяются по названию продукта
+        'allergens': parse_allergens(import_field(row, 'allergens') or name),
+    }
+
+
+def parse_dish_ingredient_row(row):
+    """Проверить строку импорта состава блюда: блюдо, продукт (название или product_id) и количество на порцию"""
+    dish_name = import_field(row, 'dish_name')
+    if not dish_name:
+        raise ValueError('Поле dish_name обязательно')
+    if len(str(dish_name)) > 200:
+        raise ValueError('Название блюда длиннее 200 символов')
+    product_id = import_field(row, 'product_id')
+    product = import_field(row, 'product')
+    if product_id is None and not product:
+        raise ValueError('Нужно поле product (название продукта) или product_id')
+    return {
+        'dish_name': str(dish_name),
+        'product_id': import_number(row, 'product_id', cast=int) if product_id is not None else None,
+        'product': str(product) if product else None,
+        'quantity': import_number(row, 'quantity'),
+    }
+
+
+def resolve_ingredient_products(rows):
+    """Подставить product_id по названиям продуктов (один запрос на пачку); строки с неизвестными
+    продуктами отклоняются"""
+    names = {row['product'] for row in rows if row['product_id'] is None}
+    ids = {row['product_id'] for row in rows if row['product_id'] is not None}
+    by_name = {}
+    for product_id, name in db.session.execute(
+            select(Product.id, Product.name).where(or_(Product.name.in_(names), Product.id.in_(ids)))).all():
+        by_name[name] = product_id
+    known_ids = set(by_name.values())
+    rejected = []
+    for row in rows:
+        product = row.pop('product')
+        if row['product_id'] is None:
+            row['product_id'] = by_name.get(product)
+        if row['product_id'] not in known_ids:
+            rejected.append((row, f"Продукт не найден: {product or row['product_id']}"))
+    return rejected
+
+
+def invalidate_imported_recipes(rows):
+    """Сбросить кэш меню с блюдами пачки импорта состава (изменились аллергены)"""
+    for day in dish_menu_days(db.session.connection(), {row['dish_name'] for row in rows}):
+        invalidate_menu_cache(day)
+
+
+def invalidate_imported_products(rows):
+    """Сбросить кэш меню с блюдами из продуктов пачки импорта (могли измениться аллергены).
+    Вызывается после COMMIT пачки, поэтому кэш сбрасывается сразу."""
+    connection = db.session.connection()
+    days = dish_menu_days(connection, connection.execute(
+        select(DishIngredient.dish_name).distinct()
+        .join(Product, Product.id == DishIngredient.product_id)
+        .where(Product.name.in_([row['name'] for row in rows]))
+    ).scalars().all())
+    for day in days:
+        invalidate_menu_cache(day)
+
+
+def invalidate_imported_menus(rows):
+    """Сбросить кэш меню на дни, затронутые пачкой импорта"""
+    for day in {row['date'] for row in rows}:
+        invalidate_menu_cache(day)
+
+
+def fill_forecast_counts(rows):
+    """Заполнить количество порций по прогнозу в новых строках меню, где оно не задано.
+    У блюд, которые уже есть в меню, остаток не меняется (заказы по нему уже списаны),
+    их строкам подставляется текущее значение."""
+    missing = [row for row in rows if row['available_count'] is None]
+    if not missing:
+        return
+    keys = db.tuple_(Menu.date, Menu.meal_type, Menu.dish_name)
+    current = {(day, meal_type, dish_name): count for day, meal_type, dish_name, count in db.session.execute(
+        select(Menu.date, Menu.meal_type, Menu.dish_name, Menu.available_count)
+        .where(keys.in_([(row['date'], row['meal_type'], row['dish_name']) for row in missing]))
+    ).all()}
+    for row in missing:
+        row['available_count'] = current.get((row['date'], row['meal_type'], row['dish_name']))
+    missing = [row for row in missing if row['available_count'] is None]
+    if not missing:
+        return
+    config = current_app.config
+    model = get_demand_model()
+    for row in missing:
+        row['available_count'] = (model.propose(row['meal_type'], row['dish_name'], row['date'], config)
+                                  if model else config['FORECAST_DEFAULT_PORTIONS'])
+
+
+class ImportSpec:
+    """Как импортировать таблицу: разбор строки, естественный ключ и столбцы, обновляемые при совпадении"""
+
+    def __init__(self, model, parse_row, key_columns, update_columns, prepare_chunk=None, after_chunk=None,
+                 optional_columns=()):
+        self.model = model
+        self.parse_row = parse_row
+        self.key_columns = key_columns
+        self.update_columns = update_columns
+        # Столбцы, которых может не быть в файле: тогда у существующей строки остается прежнее значение,
+        # а новая получает значение от prepare_chunk
+        self.optional_columns = optional_columns
+        # Вызывается после фиксации каждой пачки (например, для сброса кэша)
+        self.after_chunk = after_chunk
+        # Вызывается перед записью пачки (например, чтобы заполнить значения по умолчанию);
+        # может вернуть отклоненные строки [(строка, ошибка)], они не записываются
+        self.prepare_chunk = prepare_chunk
+
+    def upsert_statement(self):
+        """INSERT ... ON CONFLICT (ключ) DO UPDATE для executemany по пачке строк"""
+        table = self.model.__table__
+        statement = sqlite_insert(table)
+        set_ = {column: statement.excluded[column] for column in self.update_columns}
+        for column in self.optional_columns:
+            # Значение из файла (параметр given_<столбец>), а без него - прежнее значение строки
+            set_[column] = db.func.coalesce(db.bindparam(f'given_{column}', type_=table.c[column].type),
+                                            table.c[column])
+        return statement.on_conflict_do_update(index_elements=self.key_columns, set_=set_)
+
+    def mark_given(self, rows):
+        """Запомнить значения необязательных столбцов из файла до заполнения значений по умолчанию"""
+        for row in rows:
+            for column in self.optional_columns:
+                row[f'given_{column}'] = row[column]
+
+
+IMPORT_SPECS = {
+    'menus': ImportSpec(Menu, parse_menu_row, ['date', 'meal_type', 'dish_name'],
+                        ['description', 'price', 'available_count'],
+                        prepare_chunk=fill_forecast_counts, after_chunk=invalidate_imported_menus,
+                        optional_columns=['available_count']),
+    'products': ImportSpec(Product, parse_product_row, ['name'],
+                           ['unit', 'current_quantity', 'min_quantity', 'allergens'],
+                           after_chunk=invalidate_imported_products),
+    'dish_ingredients': ImportSpec(DishIngredient, parse_dish_ingredient_row, ['dish_name', 'product_id'],
+                                   ['quantity'], prepare_chunk=resolve_ingredient_products,
+                                   after_chunk=invalidate_imported_recipes),
+}
+
+
+def detect_import_format(filename=None, content_type=None):
+    """Формат файла импорта по расширению или типу содержимого; None, если не удалось определить"""
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in ('text/csv', 'application/csv'):
+        return 'csv'
+    if content_type in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+        return 'jsonl'
+    return None
+
+
+def iter_import_rows(text, fmt):
+    """Строки файла по одной: (номер строки, словарь значений или None, если строка не разобралась)"""
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(text, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def _write_import_chunk(statement, rows):
+    db.session.execute(statement, rows)
+    db.session.commit()
+
+
+def import_records(kind, text, fmt, chunk_size=IMPORT_CHUNK_SIZE):
+    """Потоково импортировать меню, продукты или состав блюд из текстового файла CSV/JSON Lines.
+
+    Строки проверяются и вставляются пачками по chunk_size (executemany с upsert по
+    естественному ключу), каждая пачка - отдельная короткая транзакция, поэтому память
+    не зависит от размера файла, а блокировка на запись не держится весь импорт."""
+    spec = IMPORT_SPECS[kind]
+    statement = spec.upsert_statement()
+    summary = {'processed': 0, 'imported': 0, 'failed': 0, 'errors': []}
+    chunk, numbers = [], []
+
+    def fail(number, error):
+        summary['failed'] += 1
+        if len(summary['errors']) < IMPORT_MAX_ERRORS:
+            summary['errors'].append({'line': number, 'error': error})
+
+    def flush():
+        spec.mark_given(chunk)
+        rejected = {}
+        if spec.prepare_chunk:
+            rejected = {id(row): error for row, error in spec.prepare_chunk(chunk) or ()}
+        for number, row in zip(numbers, chunk):
+            if id(row) in rejected:
+                fail(number, rejected[id(row)])
+        chunk[:] = [row for row in chunk if id(row) not in rejected]
+        if chunk:
+            run_with_retry(_write_import_chunk, statement, chunk)
+            if spec.after_chunk:
+                spec.after_chunk(chunk)
+        summary['imported'] += len(chunk)
+        chunk.clear()
+        numbers.clear()
+
+    for number, row in iter_import_rows(text, fmt):
+        summary['processed'] += 1
+        try:
+            if row is None:
+                raise ValueError('Строка не разобрана')
+            chunk.append(spec.parse_row(row))
+        except ValueError as e:
+            fail(number, str(e))
+            continue
+        numbers.append(number)
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return summary
+
+
+# ================== АРХИВ ЗАКАЗОВ ==================
+
+# Архивируемые таблицы: источник -> (модель, столбец даты)
+ARCHIVE_SOURCES = {
+    'orders': (Order, 'order_date'),
+    'payments': (Payment, 'payment_date'),
+}
+# Индексы архивных таблиц помимо индекса по дате: история заказов ученика в мобильном API
+ARCHIVE_INDEXES = {
+    'orders': [('student_id', 'order_date')],
+}
+# Описания архивных таблиц создаются по мере надобности и не входят в db.metadata (create_all их не трогает)
+archive_metadata = db.MetaData()
+archive_metadata_lock = threading.Lock()
+
+
+def archive_term(moment):
+    """Учебное полугодие даты: '2025_1' - сентябрь-декабрь 2025, '2025_2' - январь-август 2026"""
+    if moment.month >= 9:
+        return f'{moment.year}_1'
+    return f'{moment.year - 1}_2'
+
+
+def archive_table(source, term):
+    """Архивная таблица источника за полугодие: те же столбцы без внешних ключей, индекс по дате
+    и индексы из ARCHIVE_INDEXES"""
+    name = f'{source}_archive_{term}'
+    with archive_metadata_lock:
+        if name not in archive_metadata.tables:
+            model, date_name = ARCHIVE_SOURCES[source]
+            db.Table(name, archive_metadata,
+                     *[db.Column(column.name, column.type, primary_key=column.primary_key)
+                       for column in model.__table__.columns],
+                     db.Index(f'ix_{name}_{date_name}', date_name),
+                     *[db.Index(f"ix_{name}_{'_'.join(columns)}", *columns)
+                       for columns in ARCHIVE_INDEXES.get(source, ())])
+        return archive_metadata.tables[name]
+
+
+def archive_tables(source, start=None, end=None):
+    """Архивные таблицы источника, в которых есть строки за период [start, end)"""
+    if source not in ARCHIVE_SOURCES:
+        return []
+    query = ArchivePartition.query.filter(ArchivePartition.source == source, ArchivePartition.rows_count > 0)
+    if start:
+        query = query.filter(ArchivePartition.date_to >= start)
+    if end:
+        query = query.filter(ArchivePartition.date_from < end)
+    return [archive_table(source, partition.term) for partition in query.order_by(ArchivePartition.date_from)]
+
+
+def history_select(source, names, date_name, start=None, end=None, where=None):
+    """Единое чтение для отчетов: SELECT по оперативной таблице и архивам за период [start, end),
+    объединенный через UNION ALL и упорядоченный по дате. Архивы вне периода не затрагиваются.
+    where(table) возвращает дополнительные условия для каждой части."""
+    parts = []
+    for table in [db.metadata.tables[source]] + archive_tables(source, start, end):
+        date = table.c[date_name]
+        conditions = list(where(table)) if where else []
+        if start:
+            conditions.append(date >= start)
+        if end:
+            conditions.append(date < end)
+        parts.append(select(*[table.c[name] for name in names]).where(*conditions))
+    if len(parts) == 1:
+        return parts[0].order_by(parts[0].selected_columns[date_name])
+    return union_all(*parts).order_by(date_name)
+
+
+def record_archive_partition(connection, source, term, rows_count, amount_total, date_from, date_to):
+    statement = sqlite_insert(ArchivePartition).values(
+        table_name=archive_table(source, term).name, source=source, term=term, rows_count=rows_count,
+        amount_total=amount_total, date_from=date_from, date_to=date_to, updated_at=datetime.utcnow())
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[ArchivePartition.table_name],
+        set_={
+            'rows_count': ArchivePartition.rows_count + statement.excluded.rows_count,
+            'amount_total': ArchivePartition.amount_total + statement.excluded.amount_total,
+            'date_from': db.func.min(db.func.coalesce(ArchivePartition.date_from, statement.excluded.date_from),
+                                     statement.excluded.date_from),
+            'date_to': db.func.max(db.func.coalesce(ArchivePartition.date_to, statement.excluded.date_to),
+                                   statement.excluded.date_to),
+            'updated_at': statement.excluded.updated_at,
+        }
+    ))
+
+
+def _archive_batch(condition, batch_size):
+    """Перенести одну пачку заказов (и их оплат) в архивы полугодий одной транзакцией"""
+    rows = db.session.execute(
+        select(Order.id, Order.order_date).where(condition).order_by(Order.id).limit(batch_size)
+    ).all()
+    moved = Counter()
+    if not rows:
+        return moved
+    by_term = {}
+    for order_id, order_date in rows:
+        by_term.setdefault(archive_term(order_date), []).append(order_id)
+
+    connection = db.session.connection()
+    for term, order_ids in by_term.items():
+        # Оплаты лежат в архиве того же полугодия, что и их заказ
+        for source, key in (('payments', Payment.order_id), ('orders', Order.id)):
+            model, date_name = ARCHIVE_SOURCES[source]
+            hot = model.__table__
+            selected = key.in_(order_ids)
+            amount = hot.c.amount if source == 'payments' else db.literal(0)
+            count, amount_total, date_from, date_to = connection.execute(
+                select(db.func.count(), db.func.coalesce(db.func.sum(amount), 0),
+                       db.func.min(hot.c[date_name]), db.func.max(hot.c[date_name])).where(selected)
+            ).one()
+            if not count:
+                continue
+            table = archive_table(source, term)
+            table.create(connection, checkfirst=True)
+            # Журнал балансов не трогается: списания ссылаются на тот же id заказа, уже в архиве
+            connection.execute(table.insert().from_select(list(hot.c.keys()), select(hot).where(selected)))
+            connection.execute(hot.delete().where(selected))
+            record_archive_partition(connection, source, term, count, amount_total, date_from, date_to)
+            moved[source] += count
+            moved['revenue'] += amount_total
+
+    # Триггеры dashboard_stats вычли удаленные строки, а итоги за все время включают архив
+    connection.execute(
+        update(DashboardStats).where(DashboardStats.id == 1).values(
+            orders_total=DashboardStats.orders_total + moved['orders'],
+            payments_total=DashboardStats.payments_total + moved['payments'],
+            revenue_total=DashboardStats.revenue_total + moved['revenue'])
+    )
+    db.session.commit()
+    return moved
+
+
+def archive_closed_orders(horizon_days, batch_size, dry_run=False):
+    """Перенести выданные заказы старше horizon_days дней и их оплаты в архив пачками по batch_size.
+    Каждая пачка - отдельная короткая транзакция, поэтому запись в оперативные таблицы не блокируется
+    надолго. Возвращает число перенесенных (при dry_run - подлежащих переносу) заказов и оплат."""
+    cutoff = datetime.combine(datetime.now().date() - timedelta(days=horizon_days), datetime.min.time())
+    closed = and_(Order.status == 'issued', Order.order_date < cutoff)
+    if dry_run:
+        orders = select(Order.id).where(closed)
+        return {
+            'orders': db.session.scalar(select(db.func.count()).select_from(orders.subquery())),
+            'payments': db.session.scalar(select(db.func.count(Payment.id)).where(Payment.order_id.in_(orders))),
+        }
+    totals = Counter()
+    while True:
+        moved = run_with_retry(_archive_batch, closed, batch_size)
+        if not moved['orders']:
+            break
+        totals.update(moved)
+    return {'orders': totals['orders'], 'payments': totals['payments']}
+
+
+# ================== ЭКСПОРТ ДЛЯ БУХГАЛТЕРИИ ==================
+
+# Строк, читаемых из курсора и отдаваемых клиенту за один раз
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+
+
+class ExportSpec:
+    """Что выгружать из таблицы: столбцы, столбец даты для фильтра и сортировки, столбец статуса"""
+
+    def __init__(self, model, columns, date_column, status_column=None):
+        self.model = model
+        self.names = columns
+        self.date_name = date_column
+        self.status_name = status_column
+
+    def query(self, date_from=None, date_to=None, status=None):
+        """SELECT в порядке индекса по дате (вместе с архивом, если таблица архивируется):
+        фильтры по дате и статусу используют тот же индекс"""
+        start = datetime.combine(date_from, datetime.min.time()) if date_from else None
+        end = datetime.combine(date_to, datetime.min.time()) + timedelta(days=1) if date_to else None
+
+        def where(table):
+            return [table.c[self.status_name] == status] if status else []
+
+        return history_select(self.model.__tablename__, self.names, self.date_name, start, end, where)
+
+
+EXPORT_SPECS = {
+    'orders': ExportSpec(Order, ['id', 'student_id', 'menu_id', 'order_date', 'status', 'payment_type'],
+                         'order_date', 'status'),
+    'payments': ExportSpec(Payment, ['id', 'order_id', 'amount', 'payment_date', 'method', 'status'],
+                           'payment_date', 'status'),
+    'reviews': ExportSpec(Review, ['id', 'student_id', 'dish_name', 'rating', 'comment', 'date'], 'date'),
+}
+
+
+def export_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def iter_export_rows(statement):
+    """Строки выгрузки пачками по EXPORT_CHUNK_SIZE: курсор читается постепенно, а не через .all()"""
+    result = db.session.execute(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+    for rows in result.partitions():
+        yield rows
+
+
+def render_export(names, chunks, fmt):
+    """Текст выгрузки в CSV или NDJSON, по одному фрагменту на пачку строк"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(names)
+        for rows in chunks:
+            writer.writerows([export_value(value) for value in row] for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(names, map(export_value, row))), ensure_ascii=False) + '\n'
+                      for row in rows)
+
+
+def gzip_stream(chunks):
+    """Сжать поток фрагментов в gzip на лету"""
+    compressor = zlib.compressobj(wbits=31)  # 31 - заголовок и контрольная сумма gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(kind, fmt, compress=False, **filters):
+    """Генератор байтов выгрузки таблицы kind"""
+    spec = EXPORT_SPECS[kind]
+    text = render_export(spec.names, iter_export_rows(spec.query(**filters)), fmt)
+    if compress:
+        return gzip_stream(text)
+    return (chunk.encode() for chunk in text if chunk)
+
+
+# ================== ФОНОВЫЕ ЗАДАЧИ ==================
+
+# Задачи по имени; задача должна быть идемпотентной: после истечения JOB_VISIBILITY_TIMEOUT
+# ее может повторно взять другой процесс
+TASKS = {}
+
+# Периодические задачи: имя -> настройка с интервалом в секундах
+PERIODIC_JOBS = {}
+
+
+def task(name, interval_setting=None):
+    """Зарегистрировать фоновую задачу; с interval_setting задача повторяется по расписанию"""
+
+    def decorator(func):
+        TASKS[name] = func
+        if interval_setting:
+            PERIODIC_JOBS[name] = interval_setting
+        return func
+
+    return decorator
+
+
+def enqueue(name, payload=None, delay=0, unique=False, max_attempts=None, commit=True):
+    """Поставить задачу в очередь; с unique - только если такой же еще нет в очереди.
+    Возвращает True, если задача добавлена."""
+    if name not in TASKS:
+        raise LookupError(f'Неизвестная задача: {name}')
+    values = {
+        'name': name,
+        'payload': json.dumps(payload) if payload is not None else None,
+        'status': 'queued',
+        'attempts': 0,
+        'max_attempts': max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+        'run_at': datetime.utcnow() + timedelta(seconds=delay),
+        'created_at': datetime.utcnow(),
+    }
+    row = select(*[db.literal(value).label(key) for key, value in values.items()])
+    if unique:
+        # Проверка и вставка одной командой, чтобы процессы не поставили дубликаты
+        row = row.where(~select(Job.id).where(Job.name == name, Job.status.in_(('queued', 'running'))).exists())
+    added = db.session.execute(insert(Job).from_select(list(values), row)).rowcount == 1
+    if commit:
+        db.session.commit()
+    runner = current_app.extensions.get('jobs')
+    if runner is not None and added:
+        runner.wake()
+    return added
+
+
+def claim_job(visibility_timeout):
+    """Взять следующую готовую задачу (или зависшую дольше visibility_timeout) одной командой UPDATE"""
+    now = datetime.utcnow()
+    next_id = (select(Job.id)
+               .where(or_(and_(Job.status == 'queued', Job.run_at <= now),
+                          and_(Job.status == 'running', Job.locked_until < now)))
+               .order_by(Job.run_at, Job.id)
+               .limit(1)
+               .scalar_subquery())
+    row = db.session.execute(
+        update(Job)
+        .where(Job.id == next_id)
+        .values(status='running', attempts=Job.attempts + 1, started_at=now,
+                locked_until=now + timedelta(seconds=visibility_timeout))
+        .returning(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts, Job.run_at)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.session.commit()
+    return row
+
+
+def finish_job(job, error=None):
+    """Отметить задачу выполненной или, при ошибке, вернуть в очередь с задержкой (или провалить)"""
+    now = datetime.utcnow()
+    if error is None:
+        values = {'status': 'done', 'finished_at': now, 'locked_until': None}
+    elif job.attempts < job.max_attempts:
+        delay = current_app.config['JOB_RETRY_BASE_DELAY'] * (2 ** (job.attempts - 1))
+        values = {'status': 'queued', 'run_at': now + timedelta(seconds=delay), 'locked_until': None,
+                  'last_error': error}
+    else:
+        values = {'status': 'failed', 'finished_at': now, 'locked_until': None, 'last_error': error}
+    # Условие на attempts: если задачу уже перехватил другой процесс, его результат не затираем
+    db.session.execute(
+        update(Job).where(Job.id == job.id, Job.attempts == job.attempts).values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return values['status']
+
+
+def run_job(job, metrics=None):
+    """Выполнить взятую задачу и записать результат"""
+    started = time.perf_counter()
+    wait = max((datetime.utcnow() - job.run_at).total_seconds(), 0.0)
+    error = None
+    try:
+        func = TASKS.get(job.name)
+        if func is None:
+            raise LookupError(f'Неизвестная задача: {job.name}')
+        if job.attempts > job.max_attempts:
+            raise RuntimeError('Превышено число попыток')
+        func(**(json.loads(job.payload) if job.payload else {}))
+    except Exception as e:
+        db.session.rollback()
+        error = f'{type(e).__name__}: {e}'
+        logger.warning(f"Задача {job.name} #{job.id} (попытка {job.attempts}) завершилась ошибкой: {error}")
+    status = run_with_retry(finish_job, job, error)
+    if metrics is not None:
+        metrics.observe_job(job.name, status, wait, time.perf_counter() - started)
+
+    interval = current_app.config.get(PERIODIC_JOBS.get(job.name) or '', 0)
+    if interval and status in ('done', 'failed'):
+        run_with_retry(enqueue, job.name, delay=interval, unique=True)
+    return status
+
+
+def schedule_periodic_jobs():
+    """Поставить в очередь периодические задачи, которых там еще нет"""
+    for name, setting in PERIODIC_JOBS.items():
+        if current_app.config.get(setting):
+            enqueue(name, delay=current_app.config[setting], unique=True)
+
+
+def job_queue_depth():
+    """Число задач по статусам"""
+    return dict(db.session.execute(select(Job.status, db.func.count(Job.id)).group_by(Job.status)).all())
+
+
+class JobRunner:
+    """Исполнитель фоновых задач: поток-диспетчер берет задачи из таблицы jobs и отдает их пулу потоков.
+    Несколько процессов могут работать с одной очередью: задача берется атомарным UPDATE."""
+
+    def __init__(self, app, workers=2, poll_interval=2, visibility_timeout=300):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self._slots = threading.Semaphore(workers)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+            self._thread = threading.Thread(target=self._dispatch, name='job-dispatcher', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _claim(self):
+        with self.app.app_context():
+            try:
+                return run_with_retry(claim_job, self.visibility_timeout)
+            except Exception as e:
+                logger.warning(f"Не удалось взять задачу из очереди: {e}")
+                return None
+
+    def _dispatch(self):
+        with self.app.app_context():
+            try:
+                schedule_periodic_jobs()
+            except Exception as e:
+                logger.warning(f"Не удалось запланировать периодические задачи: {e}")
+        while not self._stopped.is_set():
+            self._slots.acquire()
+            job = self._claim()
+            if job is None:
+                self._slots.release()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        try:
+            with self.app.app_context():
+                run_job(job, self.app.extensions.get('metrics'))
+        except Exception as e:
+            logger.error(f"Сбой исполнителя на задаче {job.name} #{job.id}: {e}")
+        finally:
+            self._slots.release()
+
+    def run_pending(self):
+        """Выполнить в текущем потоке все готовые задачи; вернуть их число"""
+        count = 0
+        while True:
+            job = self._claim()
+            if job is None:
+                return count
+            with self.app.app_context():
+                run_job(job, self.app.extensions.get('metrics'))
+            count += 1
+
+
+def init_jobs(app):
+    """Создать исполнитель фоновых задач; он запускается при первом запросе к приложению"""
+    runner = app.extensions['jobs'] = JobRunner(
+        app,
+        workers=app.config['JOB_WORKERS'],
+        poll_interval=app.config['JOB_POLL_INTERVAL'],
+        visibility_timeout=app.config['JOB_VISIBILITY_TIMEOUT'],
+    )
+    if app.config['JOBS_ENABLED']:
+        app.before_request(runner.start)
+
+
+@task('snapshot_balances', interval_setting='BALANCE_SNAPSHOT_INTERVAL')
+def snapshot_balances_task():
+    """Обновить снимки балансов"""
+    snapshot_balances(db.session.connection())
+    db.session.commit()
+
+
+@task('reconcile_stats', interval_setting='STATS_RECONCILE_INTERVAL')
+def reconcile_stats_task():
+    """Пересчитать счетчики кабинета администратора и сводку отзывов по блюдам"""
+    reconcile_dashboard_stats(db.session.connection())
+    rebuild_dish_ratings(db.session.connection())
+    db.session.commit()
+
+
+@task('archive_orders', interval_setting='ARCHIVE_INTERVAL')
+def archive_orders_task():
+    """Перенести старые выданные заказы и их оплаты в архив"""
+    config = current_app.config
+    moved = archive_closed_orders(config['ARCHIVE_HORIZON_DAYS'], config['ARCHIVE_BATCH_SIZE'])
+    if moved['orders']:
+        logger.info(f"В архив перенесено заказов: {moved['orders']}, оплат: {moved['payments']}")
+
+
+@task('prune_jobs', interval_setting='JOB_PRUNE_INTERVAL')
+def prune_jobs_task():
+    """Удалить завершенные задачи старше JOB_RETENTION_DAYS"""
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['JOB_RETENTION_DAYS'])
+    Job.query.filter(Job.status.in_(('done', 'failed')), Job.finished_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# ================== ПОПОЛНЕНИЕ СКЛАДА ==================
+
+def consumption_rates(since):
+    """Расход продуктов в единицах за период: заказы x состав блюд, одна агрегация в SQL"""
+    return dict(db.session.execute(
+        select(DishIngredient.product_id, db.func.sum(DishIngredient.quantity))
+        .select_from(Order)
+        .join(Menu, Menu.id == Order.menu_id)
+        .join(DishIngredient, DishIngredient.dish_name == Menu.dish_name)
+        .where(Order.order_date >= since)
+        .group_by(DishIngredient.product_id)
+    ).all())
+
+
+def project_replenishment(window_days, lead_days, cover_days, now=None):
+    """Прогноз по всем продуктам за один проход: дневной расход, через сколько дней запас
+    опустится до минимума и сколько заказать, если это случится в пределах срока поставки"""
+    # Расход считается одним GROUP BY в базе (consumption_rates), дальше - арифметика на строку продукта;
+    # NumPy из requirements.txt нужен прогнозу спроса (DemandModel), здесь он ничего не ускорит
+    now = now or datetime.utcnow()
+    used = consumption_rates(now - timedelta(days=window_days))
+    pending = set(db.session.scalars(
+        select(PurchaseRequest.product_id).where(PurchaseRequest.status == 'pending')
+    ).all())
+    projections = []
+    for product in db.session.execute(
+            select(Product.id, Product.name, Product.unit, Product.current_quantity, Product.min_quantity)
+            .order_by(Product.name)).all():
+        daily_rate = (used.get(product.id) or 0.0) / window_days
+        current = product.current_quantity or 0.0
+        minimum = product.min_quantity or 0.0
+        if current < minimum:
+            days_left = 0.0
+        elif daily_rate > 0:
+            days_left = (current - minimum) / daily_rate
+        else:
+            days_left = None  # не расходуется
+        target = max(minimum * 3, minimum + daily_rate * cover_days)
+        needed = days_left is not None and days_left <= lead_days
+        projections.append({
+            'product_id': product.id,
+            'name': product.name,
+            'unit': product.unit,
+            'current_quantity': current,
+            'min_quantity': minimum,
+            'daily_rate': round(daily_rate, 3),
+            'days_left': round(days_left, 1) if days_left is not None else None,
+            'has_pending_request': product.id in pending,
+            'order_quantity': round(target - current, 3) if needed and target > current else 0.0,
+        })
+    return projections
+
+
+def generate_purchase_requests(config, dry_run=False):
+    """Создать заявки на закупку для продуктов, которым грозит нехватка (одной вставкой,
+    без дублей к уже ожидающим заявкам); вернуть список созданных позиций"""
+    projections = project_replenishment(config['REPLENISH_WINDOW_DAYS'], config['REPLENISH_LEAD_DAYS'],
+                                        config['REPLENISH_COVER_DAYS'])
+    wanted = [item for item in projections if item['order_quantity'] > 0 and not item['has_pending_request']]
+    if not wanted or dry_run:
+        return wanted
+    requested_by = db.session.scalar(
+        select(User.id).where(User.role.in_(('cook', 'admin'))).order_by(User.role.desc(), User.id).limit(1))
+    if requested_by is None:
+        logger.warning("Нет повара или администратора, от имени которого создавать заявки на закупку")
+        return []
+    now = datetime.utcnow()
+    db.session.execute(insert(PurchaseRequest), [
+        {'product_id': item['product_id'], 'quantity': item['order_quantity'], 'status': 'pending',
+         'requested_by': requested_by, 'request_date': now}
+        for item in wanted
+    ])
+    db.session.commit()
+    logger.info(f"Создано заявок на закупку: {len(wanted)}")
+    return wanted
+
+
+@task('replenish', interval_setting='REPLENISH_INTERVAL')
+def replenish_task():
+    """Проверить запасы и создать заявки на закупку"""
+    generate_purchase_requests(current_app.config)
+
+
+# ================== ПРОГНОЗ СПРОСА ==================
+
+# Минимальный суммарный вес наблюдений блюда в этот день недели, иначе берется среднее по всем дням
+FORECAST_MIN_WEEKDAY_WEIGHT = 0.5
+
+
+def weekday_of(ordinals):
+    """День недели (0 - понедельник) для порядковых номеров дат: date(1, 1, 1) - понедельник"""
+    return (ordinals - 1) % 7
+
+
+class DemandHistory:
+    """История спроса в массивах NumPy: когда какое блюдо было в меню и сколько его заказал каждый класс"""
+
+    def __init__(self, offerings, counts):
+        import numpy as np
+        self.dishes = {}  # (meal_type, dish_name) -> номер
+        self.grades = {}  # класс -> номер
+        offer_rows = [(self._dish(meal_type, dish_name), day.toordinal()) for day, meal_type, dish_name in offerings]
+        count_rows = [(self._dish(meal_type, dish_name), self.grades.setdefault(grade, len(self.grades)),
+                       day.toordinal(), count)
+                      for day, meal_type, dish_name, grade, count in counts]
+        self.offer_dish, self.offer_day = (np.array(column, dtype=np.int64).reshape(-1)
+                                           for column in (zip(*offer_rows) if offer_rows else ([], [])))
+        self.count_dish, self.count_grade, self.count_day, self.count = (
+            np.array(column, dtype=np.int64).reshape(-1)
+            for column in (zip(*count_rows) if count_rows else ([], [], [], [])))
+
+    def _dish(self, meal_type, dish_name):
+        return self.dishes.setdefault((meal_type, dish_name), len(self.dishes))
+
+    @classmethod
+    def load(cls):
+        """Вся история двумя агрегирующими запросами: предложения блюд и заказы по дням и классам"""
+        offerings = db.session.execute(
+            select(Menu.date, Menu.meal_type, Menu.dish_name).distinct()
+        ).all()
+        counts = db.session.execute(
+            select(Menu.date, Menu.meal_type, Menu.dish_name, Student.grade, db.func.count(Order.id))
+            .select_from(Order)
+            .join(Menu, Menu.id == Order.menu_id)
+            .join(Student, Student.id == Order.student_id)
+            .group_by(Menu.date, Menu.meal_type, Menu.dish_name, Student.grade)
+        ).all()
+        return cls(offerings, counts)
+
+
+class DemandModel:
+    """Экспоненциально взвешенное среднее числа заказов блюда по дням недели и классам.
+    Вся история обрабатывается одним проходом через np.bincount; в расчет идут только дни до as_of."""
+
+    def __init__(self, history, as_of, half_life_days):
+        import numpy as np
+        self.history = history
+        dishes = max(len(history.dishes), 1)
+        grades = max(len(history.grades), 1)
+        as_of = as_of.toordinal()
+
+        # Знаменатель - взвешенное число дней, когда блюдо было в меню (дни без заказов тоже считаются)
+        seen = history.offer_day < as_of
+        weights = 0.5 ** ((as_of - history.offer_day[seen]) / half_life_days)
+        slots = history.offer_dish[seen] * 7 + weekday_of(history.offer_day[seen])
+        self.offered = np.bincount(slots, weights=weights, minlength=dishes * 7).reshape(dishes, 7)
+
+        seen = history.count_day < as_of
+        weights = 0.5 ** ((as_of - history.count_day[seen]) / half_life_days) * history.count[seen]
+        slots = ((history.count_dish[seen] * 7 + weekday_of(history.count_day[seen])) * grades
+                 + history.count_grade[seen])
+        self.ordered = np.bincount(slots, weights=weights, minlength=dishes * 7 * grades).reshape(dishes, 7, grades)
+
+    def predict(self, meal_type, dish_name, day):
+        """Ожидаемые заказы блюда по классам (массив) или None, если блюдо раньше не подавалось"""
+        dish = self.history.dishes.get((meal_type, dish_name))
+        if dish is None or not self.offered[dish].sum():
+            return None
+        weekday = day.weekday()
+        if self.offered[dish, weekday] >= FORECAST_MIN_WEEKDAY_WEIGHT:
+            return self.ordered[dish, weekday] / self.offered[dish, weekday]
+        return self.ordered[dish].sum(axis=0) / self.offered[dish].sum()
+
+    def by_grade(self, meal_type, dish_name, day):
+        expected = self.predict(meal_type, dish_name, day)
+        if expected is None:
+            return {}
+        return {grade: round(float(expected[index]), 2) for grade, index in self.history.grades.items()
+                if expected[index] > 0}
+
+    def propose(self, meal_type, dish_name, day, config):
+        """Предлагаемое количество порций: прогноз с запасом, не меньше минимума"""
+        expected = self.predict(meal_type, dish_name, day)
+        if expected is None:
+            return config['FORECAST_DEFAULT_PORTIONS']
+        portions = math.ceil(float(expected.sum()) * (1 + config['FORECAST_SAFETY_PERCENT'] / 100))
+        return max(portions, config['FORECAST_MIN_PORTIONS'])
+
+
+def get_demand_model():
+    """Модель спроса на сегодня (обучается раз в день на всей истории); None без NumPy"""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        logger.warning("NumPy не установлен, количество порций не прогнозируется")
+        return None
+    today = datetime.now().date()
+    cached = current_app.extensions.get('demand_model')
+    if cached is None or cached[0] != today:
+        model = DemandModel(DemandHistory.load(), today, current_app.config['FORECAST_HALF_LIFE_DAYS'])
+        cached = current_app.extensions['demand_model'] = (today, model)
+    return cached[1]
+
+
+def backtest_demand(days, half_life_days, config, baseline=100):
+    """Проверка прогноза на истории: для каждого из последних days дней модель обучается
+    только на предыдущих днях. Возвращает ошибки прогноза, недостачу и остатки порций."""
+    import numpy as np
+    history = DemandHistory.load()
+    if not len(history.offer_day):
+        return None
+    last_day = int(history.offer_day.max())
+    totals = Counter()
+    for dish, day, count in zip(history.count_dish.tolist(), history.count_day.tolist(), history.count.tolist()):
+        totals[(dish, day)] += count
+    names = {index: key for key, index in history.dishes.items()}
+
+    predicted, proposed, actual = [], [], []
+    fit_seconds = 0.0
+    for ordinal in range(last_day - days + 1, last_day + 1):
+        offered = np.unique(history.offer_dish[history.offer_day == ordinal])
+        if not len(offered):
+            continue
+        day = datetime.fromordinal(ordinal).date()
+        started = time.perf_counter()
+        model = DemandModel(history, day, half_life_days)
+        fit_seconds += time.perf_counter() - started
+        for dish in offered.tolist():
+            meal_type, dish_name = names[dish]
+            expected = model.predict(meal_type, dish_name, day)
+            predicted.append(float(expected.sum()) if expected is not None else float(baseline))
+            proposed.append(model.propose(meal_type, dish_name, day, config))
+            actual.append(totals.get((dish, ordinal), 0))
+    if not actual:
+        return None
+
+    predicted, proposed, actual = (np.array(values, dtype=float) for values in (predicted, proposed, actual))
+    total = actual.sum() or 1.0
+
+    def outcome(portions):
+        return {
+            'short_share': round(float((portions < actual).mean()), 3),  # доля блюд, которых не хватило
+            'shortage': int(np.clip(actual - portions, 0, None).sum()),
+            'leftover': int(np.clip(portions - actual, 0, None).sum()),
+        }
+
+    return {
+        'offerings': int(len(actual)),
+        'mae': round(float(np.abs(predicted - actual).mean()), 2),
+        'wape': round(float(np.abs(predicted - actual).sum() / total), 3),
+        'bias': round(float((predicted - actual).sum() / total), 3),
+        'forecast': outcome(proposed),
+        'baseline': dict(outcome(np.full_like(actual, baseline)), portions=baseline),
+        'fit_ms_per_day': round(fit_seconds * 1000 / max(days, 1), 2),
+    }
+
+
+# ================== МИГРАЦИИ ==================
+
+# Шаги миграции по порядку; номер примененного шага хранится в PRAGMA user_version.
+# Каждый шаг должен быть идемпотентным: на новой базе create_all уже создал актуальную схему.
+MIGRATIONS = []
+
+
+def migration(func):
+    """Зарегистрировать шаг миграции"""
+    MIGRATIONS.append(func)
+    return func
+
+
+def add_missing_columns(connection, model, *names):
+    """Добавить в существующую таблицу столбцы модели, которых в ней еще нет"""
+    existing = {column['name'] for column in db.inspect(connection).get_columns(model.__tablename__)}
+    for name in names:
+        column = model.__table__.columns[name]
+        if column.name in existing:
+            continue
+        definition = f"{column.name} {column.type.compile(connection.dialect)}"
+        if column.server_default is not None:
+            definition += f" NOT NULL DEFAULT {column.server_default.arg}"
+        connection.exec_driver_sql(f"ALTER TABLE {model.__tablename__} ADD COLUMN {definition}")
+
+
+def create_missing_indexes(connection, *names):
+    """Создать индексы с этими именами, которых еще нет в существующей базе.
+    Шаг миграции перечисляет свои индексы явно: индекс, добавленный в модель позже,
+    создает его собственный шаг (со своими проверками), а не первый по порядку."""
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+@migration
+def add_hot_column_indexes(connection):
+    """Индексы для фильтров кабинетов по датам, статусам и пользователям"""
+    create_missing_indexes(connection, 'ix_users_role', 'ix_students_user_id', 'ix_menus_date_meal_type',
+                           'ix_orders_order_date_status', 'ix_orders_student_id_order_date',
+                           'ix_purchase_requests_status_request_date', 'ix_reviews_date')
+
+
+# Изменения счетчиков dashboard_stats по событиям таблиц: (таблица, событие) -> SET-выражения
+USER_ROLES = ('student', 'cook', 'admin')
+STATS_TRIGGERS = {
+    ('users', 'INSERT'): ['users_total = users_total + 1'] + [
+        f"{role}s_total = {role}s_total + (NEW.role = '{role}')" for role in USER_ROLES],
+    ('users', 'DELETE'): ['users_total = users_total - 1'] + [
+        f"{role}s_total = {role}s_total - (OLD.role = '{role}')" for role in USER_ROLES],
+    ('users', 'UPDATE OF role'): [
+        f"{role}s_total = {role}s_total + (NEW.role = '{role}') - (OLD.role = '{role}')" for role in USER_ROLES],
+    ('orders', 'INSERT'): ['orders_total = orders_total + 1'],
+    ('orders', 'DELETE'): ['orders_total = orders_total - 1'],
+    ('payments', 'INSERT'): ['payments_total = payments_total + 1',
+                             'revenue_total = revenue_total + NEW.amount'],
+    ('payments', 'DELETE'): ['payments_total = payments_total - 1',
+                             'revenue_total = revenue_total - OLD.amount'],
+    ('payments', 'UPDATE OF amount'): ['revenue_total = revenue_total + NEW.amount - OLD.amount'],
+    ('reviews', 'INSERT'): ['reviews_total = reviews_total + 1', 'rating_sum = rating_sum + NEW.rating'],
+    ('reviews', 'DELETE'): ['reviews_total = reviews_total - 1', 'rating_sum = rating_sum - OLD.rating'],
+    ('reviews', 'UPDATE OF rating'): ['rating_sum = rating_sum + NEW.rating - OLD.rating'],
+    ('purchase_requests', 'INSERT'): [
+        'purchase_requests_total = purchase_requests_total + 1',
+        "purchase_requests_pending = purchase_requests_pending + (NEW.status = 'pending')"],
+    ('purchase_requests', 'DELETE'): [
+        'purchase_requests_total = purchase_requests_total - 1',
+        "purchase_requests_pending = purchase_requests_pending - (OLD.status = 'pending')"],
+    ('purchase_requests', 'UPDATE OF status'): [
+        "purchase_requests_pending = purchase_requests_pending + (NEW.status = 'pending') - (OLD.status = 'pending')"],
+}
+
+# Полный пересчет счетчиков из исходных таблиц (итоги заказов и оплат - вместе с архивом)
+RECONCILE_STATS_SQL = """
+    INSERT OR REPLACE INTO dashboard_stats (
+        id, users_total, students_total, cooks_total, admins_total, orders_total,
+        payments_total, revenue_total, reviews_total, rating_sum,
+        purchase_requests_total, purchase_requests_pending, reconciled_at
+    ) VALUES (
+        1,
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM users WHERE role = 'student'),
+        (SELECT COUNT(*) FROM users WHERE role = 'cook'),
+        (SELECT COUNT(*) FROM users WHERE role = 'admin'),
+        (SELECT COUNT(*) FROM orders)
+            + (SELECT COALESCE(SUM(rows_count), 0) FROM archive_partitions WHERE source = 'orders'),
+        (SELECT COUNT(*) FROM payments)
+            + (SELECT COALESCE(SUM(rows_count), 0) FROM archive_partitions WHERE source = 'payments'),
+        (SELECT COALESCE(SUM(amount), 0) FROM payments)
+            + (SELECT COALESCE(SUM(amount_total), 0) FROM archive_partitions WHERE source = 'payments'),
+        (SELECT COUNT(*) FROM reviews),
+        (SELECT COALESCE(SUM(rating), 0) FROM reviews),
+        (SELECT COUNT(*) FROM purchase_requests),
+        (SELECT COUNT(*) FROM purchase_requests WHERE status = 'pending'),
+        :now
+    )
+"""
+
+
+def reconcile_dashboard_stats(connection):
+    """Пересчитать счетчики кабинета администратора с нуля"""
+    connection.execute(db.text(RECONCILE_STATS_SQL), {'now': datetime.utcnow()})
+
+
+@migration
+def install_dashboard_stats(connection):
+    """Таблица счетчиков кабинета администратора и триггеры для ее обновления"""
+    DashboardStats.__table__.create(connection, checkfirst=True)
+    for (table, action), assignments in STATS_TRIGGERS.items():
+        name = f"trg_stats_{table}_{action.split()[0].lower()}"
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {action} ON {table} "
+            f"BEGIN UPDATE dashboard_stats SET {', '.join(assignments)} WHERE id = 1; END"
+        )
+    reconcile_dashboard_stats(connection)
+
+
+def get_dashboard_stats():
+    """Строка счетчиков для кабинета администратора"""
+    stats = DashboardStats.query.get(1)
+    if stats is None:
+        reconcile_dashboard_stats(db.session.connection())
+        db.session.commit()
+        stats = DashboardStats.query.get(1)
+    return stats
+
+
+def rating_delta_sql(row, sign):
+    """SET-выражения, добавляющие (sign='+') или убирающие (sign='-') отзыв row (NEW/OLD) из сводки блюда"""
+    return ', '.join([f'reviews_count = reviews_count {sign} 1', f'rating_sum = rating_sum {sign} {row}.rating']
+                     + [f'rating_{value} = rating_{value} {sign} ({row}.rating = {value})' for value in RATING_VALUES]
+                     + ['updated_at = CURRENT_TIMESTAMP'])
+
+
+# Строка блюда создается при первом отзыве, дальше счетчики меняются на разницу
+ADD_RATING_SQL = (
+    "INSERT INTO dish_ratings (dish_name, reviews_count, rating_sum, "
+    + ', '.join(f'rating_{value}' for value in RATING_VALUES) + ", updated_at) "
+    "VALUES (NEW.dish_name, 0, 0, " + ', '.join('0' for _ in RATING_VALUES) + ", CURRENT_TIMESTAMP) "
+    "ON CONFLICT (dish_name) DO NOTHING; "
+    f"UPDATE dish_ratings SET {rating_delta_sql('NEW', '+')} WHERE dish_name = NEW.dish_name;"
+)
+REMOVE_RATING_SQL = f"UPDATE dish_ratings SET {rating_delta_sql('OLD', '-')} WHERE dish_name = OLD.dish_name;"
+
+RATING_TRIGGERS = {
+    'INSERT': ADD_RATING_SQL,
+    'DELETE': REMOVE_RATING_SQL,
+    'UPDATE OF rating, dish_name': REMOVE_RATING_SQL + ' ' + ADD_RATING_SQL,
+}
+
+# Полный пересчет сводки из таблицы отзывов
+REBUILD_RATINGS_SQL = (
+    "INSERT INTO dish_ratings (dish_name, reviews_count, rating_sum, "
+    + ', '.join(f'rating_{value}' for value in RATING_VALUES) + ", updated_at) "
+    "SELECT dish_name, COUNT(*), SUM(rating), "
+    + ', '.join(f'SUM(rating = {value})' for value in RATING_VALUES) + ", :now "
+    "FROM reviews GROUP BY dish_name"
+)
+
+
+def rebuild_dish_ratings(connection):
+    """Пересчитать сводку отзывов по блюдам с нуля"""
+    connection.execute(db.text("DELETE FROM dish_ratings"))
+    connection.execute(db.text(REBUILD_RATINGS_SQL), {'now': datetime.utcnow()})
+
+
+def bayesian_score(prior_weight):
+    """SQL-выражение байесовской оценки блюда: (C * m + сумма) / (C + количество), m - средняя по всем отзывам"""
+    mean = (select(db.func.coalesce(db.func.sum(DishRating.rating_sum) * 1.0
+                                    / db.func.nullif(db.func.sum(DishRating.reviews_count), 0), 0))
+            .scalar_subquery())
+    return (prior_weight * mean + DishRating.rating_sum) / (prior_weight + DishRating.reviews_count)
+
+
+def get_dish_ratings(dish_names):
+    """Сводки отзывов для блюд (один запрос по первичному ключу): dish_name -> DishRating"""
+    names = set(dish_names)
+    if not names:
+        return {}
+    return {rating.dish_name: rating for rating in DishRating.query.filter(DishRating.dish_name.in_(names))}
+
+
+@migration
+def add_purchase_request_date_index(connection):
+    """Индекс для постраничной истории заявок на закупку"""
+    create_missing_indexes(connection, 'ix_purchase_requests_request_date')
+
+
+@migration
+def add_natural_key_indexes(connection):
+    """Уникальные индексы по естественным ключам меню и продуктов (upsert при импорте)"""
+    for table, columns in (('menus', 'date, meal_type, dish_name'), ('products', 'name')):
+        duplicates = connection.exec_driver_sql(
+            f"SELECT {columns}, COUNT(*) FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 5"
+        ).all()
+        if duplicates:
+            raise RuntimeError(f"В таблице {table} есть повторы по ({columns}), "
+                               f"объедините их перед миграцией: {[tuple(row) for row in duplicates]}")
+    create_missing_indexes(connection, 'uq_menus_date_meal_type_dish_name', 'uq_products_name')
+
+
+@migration
+def add_payment_date_index(connection):
+    """Индекс для выгрузки платежей по датам и статусу"""
+    create_missing_indexes(connection, 'ix_payments_payment_date_status')
+
+
+# Справочники, версия которых отслеживается триггерами: имя версии -> таблица
+VERSIONED_CATALOGS = {'products': 'products'}
+
+
+@migration
+def install_catalog_versions(connection):
+    """Счетчики версий справочников для ETag и индекс продуктов с низким запасом"""
+    CatalogVersion.__table__.create(connection, checkfirst=True)
+    create_missing_indexes(connection, 'ix_products_low_stock_name')
+    for name, table in VERSIONED_CATALOGS.items():
+        connection.execute(
+            db.text("INSERT OR IGNORE INTO catalog_versions (name, version, modified_at) VALUES (:name, 1, :now)"),
+            {'name': name, 'now': datetime.utcnow()}
+        )
+        for action in ('INSERT', 'UPDATE', 'DELETE'):
+            connection.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS trg_version_{table}_{action.lower()} AFTER {action} ON {table} "
+                f"BEGIN UPDATE catalog_versions SET version = version + 1, modified_at = CURRENT_TIMESTAMP "
+                f"WHERE name = '{name}'; END"
+            )
+
+
+def get_catalog_version(name):
+    """Версия и время последнего изменения справочника (один запрос по первичному ключу)"""
+    row = db.session.execute(
+        select(CatalogVersion.version, CatalogVersion.modified_at).where(CatalogVersion.name == name)
+    ).first()
+    return (row.version, row.modified_at) if row else (0, None)
+
+
+@migration
+def install_balance_ledger(connection):
+    """Журнал операций по балансу и снимки балансов; текущие балансы переносятся начальными записями"""
+    BalanceEntry.__table__.create(connection, checkfirst=True)
+    BalanceSnapshot.__table__.create(connection, checkfirst=True)
+    connection.execute(db.text("""
+        INSERT INTO balance_ledger (student_id, amount, kind, created_at)
+        SELECT id, CAST(ROUND(balance * 100) AS INTEGER), 'opening', :now FROM students
+        WHERE balance != 0 AND id NOT IN (SELECT student_id FROM balance_ledger)
+    """), {'now': datetime.utcnow()})
+    snapshot_balances(connection)
+
+
+@migration
+def install_jobs(connection):
+    """Таблица очереди фоновых задач"""
+    Job.__table__.create(connection, checkfirst=True)
+
+
+@migration
+def install_dish_ingredients(connection):
+    """Состав блюд: продукты и их количество на порцию"""
+    DishIngredient.__table__.create(connection, checkfirst=True)
+
+
+@migration
+def install_dish_ratings(connection):
+    """Сводка отзывов по блюдам и триггеры для ее обновления"""
+    DishRating.__table__.create(connection, checkfirst=True)
+    for action, body in RATING_TRIGGERS.items():
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS trg_rating_reviews_{action.split()[0].lower()} "
+            f"AFTER {action} ON reviews BEGIN {body} END"
+        )
+    rebuild_dish_ratings(connection)
+
+
+@migration
+def install_allergen_masks(connection):
+    """Маски аллергенов продуктов (по названиям) и ограничений учеников (по аллергиям и предпочтениям)"""
+    add_missing_columns(connection, Product, 'allergens')
+    add_missing_columns(connection, Student, 'restriction_mask')
+    products = connection.execute(select(Product.id, Product.name)).all()
+    if products:
+        connection.execute(
+            update(Product).where(Product.id == db.bindparam('product_id')).values(allergens=db.bindparam('mask')),
+            [{'product_id': product_id, 'mask': parse_allergens(name)} for product_id, name in products]
+        )
+    students = connection.execute(
+        select(Student.id, Student.allergies, Student.preferences)
+        .where(or_(Student.allergies.isnot(None), Student.preferences.isnot(None)))
+    ).all()
+    masks = [{'student_id': student_id, 'mask': parse_restrictions(allergies, preferences)}
+             for student_id, allergies, preferences in students]
+    masks = [row for row in masks if row['mask']]
+    if masks:
+        connection.execute(
+            update(Student).where(Student.id == db.bindparam('student_id'))
+            .values(restriction_mask=db.bindparam('mask')), masks
+        )
+
+
+@migration
+def install_archive_partitions(connection):
+    """Реестр архивных таблиц заказов и оплат"""
+    ArchivePartition.__table__.create(connection, checkfirst=True)
+
+
+@migration
+def add_ledger_order_index(connection):
+    """Индекс операций журнала по заказу"""
+    create_missing_indexes(connection, 'ix_balance_ledger_order_id')
+
+
+@migration
+def add_archive_history_indexes(connection):
+    """Индексы ARCHIVE_INDEXES в уже созданных архивных таблицах (история заказов ученика)"""
+    for source, term in connection.execute(
+            select(ArchivePartition.source, ArchivePartition.term)
+            .where(ArchivePartition.source.in_(list(ARCHIVE_INDEXES)))).all():
+        for index in archive_table(source, term).indexes:
+            index.create(connection, checkfirst=True)
+
+
+@migration
+def restrict_menu_meal_types(connection):
+    """Триггеры, запрещающие в menus.meal_type значения вне MEAL_TYPES (аналог CHECK для существующей таблицы)"""
+    allowed = ', '.join(f"'{meal_type}'" for meal_type in MEAL_TYPES)
+    invalid = connection.exec_driver_sql(
+        f"SELECT id, meal_type FROM menus WHERE meal_type NOT IN ({allowed}) LIMIT 5").all()
+    if invalid:
+        raise RuntimeError(f"В меню есть блюда с неизвестным приемом пищи, исправьте их перед миграцией: "
+                           f"{[tuple(row) for row in invalid]}")
+    for action in ('INSERT', 'UPDATE OF meal_type'):
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS trg_menus_meal_type_{action.split()[0].lower()} "
+            f"BEFORE {action} ON menus WHEN NEW.meal_type NOT IN ({allowed}) "
+            f"BEGIN SELECT RAISE(ABORT, 'menus.meal_type must be one of: {', '.join(MEAL_TYPES)}'); END"
+        )
+
+
+@migration
+def convert_money_to_kopecks(connection):
+    """Денежные столбцы (цены, оплаты, суммы архивов) из рублей с плавающей точкой в целые копейки"""
+    columns = [('menus', 'price'), ('payments', 'amount'), ('archive_partitions', 'amount_total')]
+    columns += [(table_name, 'amount') for table_name, in connection.execute(
+        select(ArchivePartition.table_name).where(ArchivePartition.source == 'payments')).all()]
+    for table_name, column in columns:
+        connection.exec_driver_sql(
+            f"UPDATE {table_name} SET {column} = CAST(ROUND({column} * 100) AS INTEGER) WHERE {column} IS NOT NULL")
+    reconcile_dashboard_stats(connection)
+
+
+@migration
+def restore_ledger_order_references(connection):
+    """Журнал операций без внешнего ключа на orders (заказы уходят в архив); ссылки, перенесенные прежней
+    версией в archived_order_id, возвращаются в order_id. Таблица пересобирается с теми же id и суммами."""
+    ledger = BalanceEntry.__table__
+    existing = {column['name'] for column in db.inspect(connection).get_columns(ledger.name)}
+    columns = [column.name for column in ledger.columns]
+    source = ['COALESCE(archived_order_id, order_id)' if name == 'order_id' and 'archived_order_id' in existing
+              else name for name in columns]
+    rebuilt = f'{ledger.name}_rebuilt'
+    connection.exec_driver_sql(
+        str(CreateTable(ledger).compile(connection)).replace(ledger.name, rebuilt, 1))
+    connection.exec_driver_sql(f"INSERT INTO {rebuilt} ({', '.join(columns)}) "
+                               f"SELECT {', '.join(source)} FROM {ledger.name}")
+    connection.exec_driver_sql(f'DROP TABLE {ledger.name}')
+    connection.exec_driver_sql(f'ALTER TABLE {rebuilt} RENAME TO {ledger.name}')
+    for index in ledger.indexes:
+        index.create(connection)
+
+
+def migrate_database():
+    """Применить недостающие шаги миграции"""
+    with db.engine.begin() as connection:
+        version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Миграция {number}: {step.__doc__}")
+            step(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version = {number}')
+
+
 # ================== СОЗДАНИЕ БАЗЫ ДАННЫХ ==================
 
-def create_database():
+def create_database(app):
     """Создание базы данных с тестовыми данными"""
     with app.app_context():
         # Создаем все таблицы
         db.create_all()
+        migrate_database()
         logger.info("✅ Таблицы созданы")
 
         # Создаем тестовых пользователей, если их нет
@@ -220,7 +3284,7 @@ def create_database():
             # Повар
             cook = User(
                 username='cook',
-                password=generate_password_hash('cook123'),
+                password=hash_password('cook123'),
                 role='cook',
                 email='cook@school.ru'
             )
@@ -229,7 +3293,7 @@ def create_database():
             # Администратор
             admin = User(
                 username='admin',
-                password=generate_password_hash('admin123'),
+                password=hash_password('admin123'),
                 role='admin',
                 email='admin@school.ru'
             )
@@ -238,7 +3302,7 @@ def create_database():
             # Ученик
             student_user = User(
                 username='student',
-                password=generate_password_hash('student123'),
+                password=hash_password('student123'),
                 role='student',
                 email='student@school.ru'
             )
@@ -250,10 +3314,11 @@ def create_database():
                 user_id=student_user.id,
                 grade='10A',
                 allergies='Нет',
-                preferences='Вегетарианец',
-                balance=1000.0
+                preferences='Вегетарианец'
             )
             db.session.add(student)
+            db.session.flush()
+            credit_balance(student.id, to_kopecks(1000), kind='opening')
 
             # Тестовые продукты
             products = [
@@ -262,6 +3327,8 @@ def create_database():
                 Product(name='Яйца', unit='шт', current_quantity=50.0, min_quantity=30.0),
                 Product(name='Молоко', unit='л', current_quantity=20.0, min_quantity=10.0),
                 Product(name='Картофель', unit='кг', current_quantity=30.0, min_quantity=20.0),
+                Product(name='Филе куриное', unit='кг', current_quantity=15.0, min_quantity=8.0),
+                Product(name='Филе минтая', unit='кг', current_quantity=10.0, min_quantity=6.0),
             ]
 
             for product in products:
@@ -314,6 +3381,24 @@ def create_database():
             db.session.add_all(menu_items)
             db.session.commit()
 
+            # Состав блюд (количество продукта на порцию)
+            recipes = {
+                "Каша овсяная с ягодами": [('Молоко', 0.2), ('Сахар', 0.01)],
+                "Омлет с овощами": [('Яйца', 2), ('Молоко', 0.05)],
+                "Блины с творогом": [('Мука пшеничная', 0.05), ('Яйца', 1), ('Молоко', 0.1), ('Сахар', 0.01)],
+                "Суп куриный с лапшой": [('Мука пшеничная', 0.03), ('Яйца', 0.5), ('Филе куриное', 0.05)],
+                "Котлета куриная с картофельным пюре": [('Картофель', 0.2), ('Молоко', 0.03),
+                                                        ('Филе куриное', 0.1)],
+                "Рыба запеченная с овощами": [('Картофель', 0.15), ('Филе минтая', 0.12)],
+            }
+            product_ids = {product.name: product.id for product in products}
+            db.session.add_all([
+                DishIngredient(dish_name=dish_name, product_id=product_ids[name], quantity=quantity)
+                for dish_name, ingredients in recipes.items()
+                for name, quantity in ingredients
+            ])
+            db.session.commit()
+
             logger.info("✅ Тестовые данные созданы")
             print("\n" + "=" * 60)
             print("🎉 БАЗА ДАННЫХ ГОТОВА!")
@@ -327,18 +3412,18 @@ def create_database():
 
 # ================== МАРШРУТЫ ==================
 
-@app.route('/')
+@route('/')
 def index():
     """Главная страница"""
-    user = get_current_user()
+    user = get_identity()
     return render_template('index.html', user=user)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     """Страница входа"""
     if 'user_id' in session:
-        user = get_current_user()
+        user = get_identity()
         if user:
             if user.role == 'student':
                 return redirect(url_for('student_dashboard'))
@@ -351,12 +3436,23 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
 
+        # Перебор паролей отсекается до поиска пользователя и хеширования
+        limit_keys = (('user', username), ('ip', request.remote_addr))
+        limited = login_rate_limited(*limit_keys)
+        if limited:
+            return limited
+
         user = User.query.filter_by(username=username).first()
 
-        if user and check_password_hash(user.password, password):
-            session['user_id'] = user.id
-            session['username'] = user.username
-            session['role'] = user.role
+        try:
+            authenticated = user is not None and verify_password(user, password)
+        except PasswordHashingBusy:
+            flash('Сервер перегружен, попробуйте войти через несколько секунд', 'danger')
+            return render_template('login.html', error='Сервер перегружен'), 503
+
+        if authenticated:
+            login_succeeded(*limit_keys)
+            remember_identity(user)
 
             flash(f'Добро пожаловать, {user.username}!', 'success')
 
@@ -373,7 +3469,7 @@ def login():
     return render_template('login.html')
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     """Страница регистрации"""
     if request.method == 'POST':
@@ -385,11 +3481,19 @@ def register():
         allergies = request.form.get('allergies', '')
         preferences = request.form.get('preferences', '')
 
+        limited = login_rate_limited(('ip', request.remote_addr))
+        if limited:
+            return limited
+
         if User.query.filter_by(username=username).first():
             flash('Пользователь с таким именем уже существует', 'danger')
             return render_template('register.html', error='Пользователь с таким именем уже существует')
 
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = hash_password(password)
+        except PasswordHashingBusy:
+            flash('Сервер перегружен, попробуйте позже', 'danger')
+            return render_template('register.html', error='Сервер перегружен'), 503
         new_user = User(
             username=username,
             password=hashed_password,
@@ -405,15 +3509,12 @@ def register():
                 user_id=new_user.id,
                 grade=grade,
                 allergies=allergies,
-                preferences=preferences,
-                balance=0.0
+                preferences=preferences
             )
             db.session.add(student)
             db.session.commit()
 
-        session['user_id'] = new_user.id
-        session['username'] = new_user.username
-        session['role'] = new_user.role
+        remember_identity(new_user)
 
         flash('Регистрация прошла успешно!', 'success')
 
@@ -427,7 +3528,7 @@ def register():
     return render_template('register.html')
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     """Выход из системы"""
     session.clear()
@@ -436,17 +3537,17 @@ def logout():
 
 
 # Кабинет ученика
-@app.route('/student/dashboard')
+@route('/student/dashboard')
 @login_required
 def student_dashboard():
     """Личный кабинет ученика"""
-    user = get_current_user()
+    user = get_identity()
 
     if user.role != 'student':
         flash('Доступ запрещен. Требуется роль ученика.', 'danger')
         return redirect(url_for('index'))
 
-    student = Student.query.filter_by(user_id=user.id).first()
+    student = get_current_student()
     if not student:
         flash('Профиль ученика не найден', 'danger')
         return redirect(url_for('logout'))
@@ -454,28 +3555,27 @@ def student_dashboard():
     today = datetime.now().date()
 
     # Заказы ученика
-    today_orders = Order.query.filter(
-        Order.student_id == student.id,
-        db.func.date(Order.order_date) == today
-    ).all()
+    today_orders = load_student_orders(student.id, today)
 
-    # Меню на сегодня
-    today_menu = Menu.query.filter_by(date=today).order_by(Menu.meal_type, Menu.dish_name).all()
+    # Меню на сегодня без блюд с аллергенами и продуктами, которые ученик не ест
+    full_menu = get_menu_for_date(today)
+    today_menu = filter_menu_for_student(full_menu, student)
 
     return render_template('student_dashboard.html',
                            student=student,
                            user=user,
                            today_orders=today_orders,
                            today_menu=today_menu,
+                           hidden_dishes_count=len(full_menu) - len(today_menu),
                            today_date=today)
 
 
-@app.route('/order/create', methods=['POST'])
+@route('/order/create', methods=['POST'])
 @login_required
 def create_order_frontend():
     """Создание заказа через фронтенд"""
     try:
-        user = get_current_user()
+        user = get_identity()
 
         if user.role != 'student':
             flash('Только ученики могут создавать заказы', 'danger')
@@ -483,137 +3583,164 @@ def create_order_frontend():
 
         menu_id = request.form.get('menu_id')
 
-        student = Student.query.filter_by(user_id=user.id).first()
-        if not student:
+        if user.student_id is None:
             flash('Профиль ученика не найден', 'danger')
             return redirect(url_for('student_dashboard'))
 
-        menu = Menu.query.get(menu_id)
-        if not menu:
-            flash('Блюдо не найдено', 'danger')
-            return redirect(url_for('student_dashboard'))
-
-        if menu.available_count <= 0:
-            flash('Это блюдо закончилось', 'warning')
-            return redirect(url_for('student_dashboard'))
-
-        # Проверяем баланс
-        if student.balance < menu.price:
-            flash('Недостаточно средств на балансе', 'warning')
+        try:
+            order = place_order(user.student_id, menu_id)
+        except OrderError as e:
+            flash(e.message, e.category)
             return redirect(url_for('student_dashboard'))
-
-        # Создаем заказ
-        new_order = Order(
-            student_id=student.id,
-            menu_id=menu.id,
-            status='pending'
-        )
-
-        db.session.add(new_order)
-        menu.available_count -= 1
-        student.balance -= menu.price  # Списание средств
-        db.session.commit()
+        menu = Menu.query.get(order.menu_id)
 
         flash(f'Заказ "{menu.dish_name}" создан! Средства списаны с баланса.', 'success')
         return redirect(url_for('student_dashboard'))
 
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Ошибка при создании заказа: {e}")
         flash('Произошла ошибка при создании заказа', 'danger')
         return redirect(url_for('student_dashboard'))
 
+@route('/order/checkout', methods=['POST'])
+@login_required
+def checkout_orders():
+    """Оформление корзины: несколько блюд, в том числе на разные даты"""
+    user = get_identity()
+    if user.role != 'student':
+        return jsonify({'error': 'Только ученики могут создавать заказы'}), 403
+
+    data = request.get_json(silent=True)
+    raw_ids = data.get('menu_ids') if isinstance(data, dict) else request.form.getlist('menu_id')
+    if not isinstance(raw_ids, list) or not raw_ids:
+        return jsonify({'error': 'Корзина пуста'}), 400
+    if len(raw_ids) > CHECKOUT_MAX_ITEMS:
+        return jsonify({'error': f'В корзине не может быть больше {CHECKOUT_MAX_ITEMS} позиций'}), 400
+    try:
+        menu_ids = [int(menu_id) for menu_id in raw_ids]
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Некорректный идентификатор блюда'}), 400
+
+    if user.student_id is None:
+        return jsonify({'error': 'Профиль ученика не найден'}), 404
+
+    try:
+        results, total = checkout(user.student_id, menu_ids)
+    except OrderError as e:
+        return jsonify({'error': e.message}), 409
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка при оформлении корзины: {e}")
+        return jsonify({'error': 'Произошла ошибка при оформлении корзины'}), 500
+
+    ordered = sum(1 for item in results if item['status'] == 'ok')
+    return jsonify({
+        'success': ordered > 0,
+        'ordered': ordered,
+        'rejected': len(results) - ordered,
+        'total': total,
+        'items': results
+    }), 200
+
+
+# Заявки на закупку, ожидающие решения: в кабинетах показывается только первая страница
+PENDING_REQUESTS_PAGE_SIZE = 20
+
+
+def pending_requests_page(cursor=None, limit=PENDING_REQUESTS_PAGE_SIZE):
+    """Страница ожидающих заявок по индексу (status, request_date), новые сверху"""
+    return keyset_page(PurchaseRequest.query.filter_by(status='pending'),
+                       (PurchaseRequest.request_date, PurchaseRequest.id), cursor=cursor, limit=limit)
+
+
 # Кабинет повара
-@app.route('/cook/dashboard')
+@route('/cook/dashboard')
 @login_required
 def cook_dashboard():
     """Личный кабинет повара"""
-    user = get_current_user()
+    user = get_identity()
 
     if user.role != 'cook':
         flash('Доступ запрещен. Требуется роль повара.', 'danger')
         return redirect(url_for('index'))
 
     today = datetime.now().date()
-    today_orders = Order.query.filter(db.func.date(Order.order_date) == today).all()
+    today_orders = load_kitchen_orders(today)
     products = Product.query.order_by(Product.name).all()
-    purchase_requests = PurchaseRequest.query.filter_by(status='pending').all()
+    purchase_requests, pending_cursor = pending_requests_page(request.args.get('cursor'))
 
-    # Получаем информацию о меню для заказов
+    # Блюдо и ученик уже загружены вместе с заказами, дополнительных запросов нет
     orders_with_menu = []
     for order in today_orders:
-        menu_item = Menu.query.get(order.menu_id) if order.menu_id else None
         orders_with_menu.append({
             'id': order.id,
-            'menu_item': menu_item,
+            'menu_item': order.menu,
             'status': order.status,
-            'menu_id': order.menu_id
+            'menu_id': order.menu_id,
+            'student_name': order.student.user.username if order.student and order.student.user else None,
+            'grade': order.student.grade if order.student else None
         })
 
     return render_template('cook_dashboard.html',
                            user=user,
-                           today_orders=orders_with_menu,  # Используем новую структуру
+                           today_orders=orders_with_menu,
                            products=products,
                            purchase_requests=purchase_requests,
-                           today_date=today,
-                           Menu=Menu)  # Добавляем модель Menu в контекст
+                           pending_requests_count=get_dashboard_stats().purchase_requests_pending,
+                           next_cursor=pending_cursor,
+                           today_date=today)
 
 # Кабинет администратора
-@app.route('/admin/dashboard')
+@route('/admin/dashboard')
 @login_required
 def admin_dashboard():
     """Личный кабинет администратора"""
-    user = get_current_user()
+    user = get_identity()
 
     if user.role != 'admin':
         flash('Доступ запрещен. Требуется роль администратора.', 'danger')
         return redirect(url_for('index'))
 
-    total_users = User.query.count()
-    total_students = User.query.filter_by(role='student').count()
-    total_cooks = User.query.filter_by(role='cook').count()
-    total_admins = User.query.filter_by(role='admin').count()
-
-    total_orders = Order.query.count()
+    # Счетчики поддерживаются триггерами, здесь читается одна готовая строка
+    stats = get_dashboard_stats()
     today = datetime.now().date()
-    today_orders = Order.query.filter(db.func.date(Order.order_date) == today).count()
-
-    total_payments = Payment.query.count()
-    total_revenue = db.session.query(db.func.sum(Payment.amount)).scalar() or 0
+    today_orders = Order.query.filter(day_range(Order.order_date, today)).count()
 
-    total_reviews = Review.query.count()
-    avg_rating = db.session.query(db.func.avg(Review.rating)).scalar() or 0
-
-    purchase_requests = PurchaseRequest.query.all()
-    pending_requests = PurchaseRequest.query.filter_by(status='pending').all()
+    purchase_requests = PurchaseRequest.query.order_by(PurchaseRequest.id.desc()).limit(10).all()
+    pending_requests, pending_cursor = pending_requests_page(request.args.get('cursor'))
 
     recent_users = User.query.order_by(User.id.desc()).limit(5).all()
     recent_reviews = Review.query.order_by(Review.date.desc()).limit(5).all()
 
     return render_template('admin_dashboard.html',
                            user=user,
-                           total_users=total_users,
-                           total_students=total_students,
-                           total_cooks=total_cooks,
-                           total_admins=total_admins,
-                           total_orders=total_orders,
+                           total_users=stats.users_total,
+                           total_students=stats.students_total,
+                           total_cooks=stats.cooks_total,
+                           total_admins=stats.admins_total,
+                           total_orders=stats.orders_total,
                            today_orders=today_orders,
-                           total_payments=total_payments,
-                           total_revenue=total_revenue,
-                           total_reviews=total_reviews,
-                           avg_rating=avg_rating,
+                           total_payments=stats.payments_total,
+                           total_revenue=stats.revenue_total,
+                           total_reviews=stats.reviews_total,
+                           avg_rating=stats.avg_rating,
                            purchase_requests=purchase_requests,
+                           total_requests=stats.purchase_requests_total,
                            pending_requests=pending_requests,
+                           pending_requests_count=stats.purchase_requests_pending,
+                           next_cursor=pending_cursor,
                            recent_users=recent_users,
                            recent_reviews=recent_reviews,
                            today_date=datetime.now().date())
 
 
 # Меню
-@app.route('/menu')
+@route('/menu')
 @login_required
 def menu():
     """Страница с меню"""
-    user = get_current_user()
+    user = get_identity()
     date_str = request.args.get('date')
 
     if date_str:
@@ -624,35 +3751,58 @@ def menu():
     else:
         date = datetime.now().date()
 
-    menus = Menu.query.filter_by(date=date).order_by(Menu.meal_type, Menu.dish_name).all()
+    menus = get_menu_for_date(date)
+    if user.role == 'student':
+        menus = filter_menu_for_student(menus, get_current_student())
+    ratings = get_dish_ratings(item['dish_name'] for item in menus)
 
     return render_template('menu.html',
                            user=user,
                            menus=menus,
+                           ratings=ratings,
                            current_date=date)
 
 
 # Статистика закупок
-@app.route('/purchase-statistics')
+PURCHASE_HISTORY_PAGE_SIZE = 50
+
+
+@route('/purchase-statistics')
 @login_required
 def purchase_statistics():
     """Статистика закупок для повара"""
-    user = get_current_user()
+    user = get_identity()
 
     if user.role != 'cook':
         flash('Доступ запрещен. Требуется роль повара.', 'danger')
         return redirect(url_for('index'))
 
-    products = Product.query.all()
-    purchase_requests = PurchaseRequest.query.order_by(PurchaseRequest.request_date.desc()).all()
-
-    total_products = len(products)
-    low_stock_count = len([p for p in products if p.current_quantity < p.min_quantity])
-    total_requests = len(purchase_requests)
-    pending_requests = len([r for r in purchase_requests if r.status == 'pending'])
-    approved_requests = len([r for r in purchase_requests if r.status == 'approved'])
-    low_stock_products = [p for p in products if p.current_quantity < p.min_quantity]
-    recent_requests = purchase_requests[:10]
+    is_low = Product.current_quantity < Product.min_quantity
+    total_products, low_stock_count = db.session.execute(
+        select(db.func.count(Product.id), db.func.coalesce(db.func.sum(case((is_low, 1), else_=0)), 0))
+    ).one()
+    # Продукты и продукты с низким запасом постранично по (name, id), как в /api/products
+    product_columns = (Product.name, Product.id)
+    products, next_products_cursor = keyset_page(Product.query, product_columns,
+                                                 cursor=request.args.get('products_cursor'),
+                                                 limit=PRODUCTS_PAGE_SIZE, descending=False)
+    low_stock_products, _ = keyset_page(Product.query.filter(is_low), product_columns,
+                                        limit=PRODUCTS_PAGE_SIZE, descending=False)
+
+    # Количество заявок по статусам одним GROUP BY
+    status_counts = dict(db.session.execute(
+        select(PurchaseRequest.status, db.func.count(PurchaseRequest.id)).group_by(PurchaseRequest.status)
+    ).all())
+    total_requests = sum(status_counts.values())
+    pending_requests = status_counts.get('pending', 0)
+    approved_requests = status_counts.get('approved', 0)
+
+    # История заявок постранично по (request_date, id)
+    history_columns = (PurchaseRequest.request_date, PurchaseRequest.id)
+    recent_requests, _ = keyset_page(PurchaseRequest.query, history_columns, limit=10)
+    purchase_requests, next_cursor = keyset_page(PurchaseRequest.query, history_columns,
+                                                 cursor=request.args.get('cursor'),
+                                                 limit=PURCHASE_HISTORY_PAGE_SIZE)
 
     return render_template('purchase_statistics.html',
                            user=user,
@@ -664,24 +3814,104 @@ def purchase_statistics():
                            pending_requests=pending_requests,
                            approved_requests=approved_requests,
                            low_stock_products=low_stock_products,
-                           recent_requests=recent_requests)
+                           recent_requests=recent_requests,
+                           next_cursor=next_cursor,
+                           next_products_cursor=next_products_cursor)
 
 
 # API для продуктов
-@app.route('/api/products', methods=['GET'])
+PRODUCTS_PAGE_SIZE = 100
+PRODUCTS_MAX_PAGE_SIZE = 500
+
+# Поля ответа: вычисляемые (низкий запас, заполненность склада) считаются в SQL
+PRODUCT_API_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'unit': Product.unit,
+    'current_quantity': Product.current_quantity,
+    'min_quantity': Product.min_quantity,
+    'created_at': Product.created_at,
+    'is_low_stock': (Product.current_quantity < Product.min_quantity).label('is_low_stock'),
+    'progress_percentage': case(
+        (Product.min_quantity <= 0, 0),
+        else_=db.func.min(Product.current_quantity * 100.0 / (Product.min_quantity * 3), 100)
+    ).label('progress_percentage'),
+}
+
+
+def products_page_query(fields, low_stock=None, prefix=None):
+    """Запрос страницы продуктов: нужные поля и фильтры, которые используют индексы по названию"""
+    columns = [PRODUCT_API_FIELDS[name] for name in dict.fromkeys(['name', 'id'] + fields)]
+    query = db.session.query(*columns)
+    if low_stock is True:
+        query = query.filter(Product.current_quantity < Product.min_quantity)  # частичный индекс
+    elif low_stock is False:
+        query = query.filter(Product.current_quantity >= Product.min_quantity)
+    if prefix:
+        # Диапазон вместо LIKE, чтобы работал индекс по названию
+        query = query.filter(Product.name >= prefix, Product.name < prefix + '\U0010ffff')
+    return query
+
+
+def product_api_value(name, value):
+    if name == 'is_low_stock':
+        return bool(value)
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def catalog_not_modified(etag, modified_at):
+    """Проверить условный GET: совпал ETag или ресурс не менялся с If-Modified-Since"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return bool(since and modified_at and modified_at.replace(microsecond=0) <= since.replace(tzinfo=None))
+
+
+@route('/api/products', methods=['GET'])
 def api_get_products():
-    """Получить все продукты"""
-    products = Product.query.order_by(Product.name).all()
-    result = [product.to_dict() for product in products]
-    return jsonify(result), 200
+    """Продукты постранично (?cursor, ?limit) с фильтрами ?low_stock, ?prefix и выбором полей ?fields"""
+    fields = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    unknown = [name for name in fields if name not in PRODUCT_API_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Неизвестные поля: {', '.join(unknown)}"}), 400
+    fields = fields or list(PRODUCT_API_FIELDS)
+    try:
+        limit = min(max(int(request.args.get('limit', PRODUCTS_PAGE_SIZE)), 1), PRODUCTS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Параметр limit должен быть числом'}), 400
+    low_stock = request.args.get('low_stock')
+    low_stock = None if low_stock in (None, '') else parse_bool(low_stock)
+    prefix = request.args.get('prefix', '').strip() or None
+    cursor = request.args.get('cursor')
+    if cursor and decode_cursor(cursor, (Product.name, Product.id)) is None:
+        return jsonify({'error': 'Некорректный курсор'}), 400
+
+    # Пока справочник не менялся, повторный опрос получает 304 без обращения к таблице продуктов
+    version, modified_at = get_catalog_version('products')
+    etag = f"products-{version}-{zlib.crc32(request.query_string):08x}"
+    if catalog_not_modified(etag, modified_at):
+        response = current_app.response_class(status=304)
+    else:
+        rows, next_cursor = keyset_page(products_page_query(fields, low_stock, prefix),
+                                        (Product.name, Product.id), cursor=cursor,
+                                        limit=limit, descending=False)
+        response = jsonify({
+            'items': [{name: product_api_value(name, row._mapping[name]) for name in fields} for row in rows],
+            'next_cursor': next_cursor,
+        })
+    response.set_etag(etag, weak=True)
+    if modified_at:
+        response.last_modified = modified_at
+    response.cache_control.no_cache = True
+    return response
 
 
-@app.route('/api/products', methods=['POST'])
+@route('/api/products', methods=['POST'])
 @login_required
 def api_create_product():
     """Создать новый продукт"""
     try:
-        user = get_current_user()
+        user = get_identity()
         if user.role != 'cook':
             return jsonify({'error': 'Требуется роль повара'}), 403
 
@@ -703,6 +3933,9 @@ def api_create_product():
         except (ValueError, TypeError):
             return jsonify({'error': 'Количество должно быть числом'}), 400
 
+        if Product.query.filter_by(name=name).first():
+            return jsonify({'error': 'Продукт с таким названием уже существует'}), 400
+
         product = Product(
             name=name,
             unit=unit,
@@ -724,12 +3957,223 @@ def api_create_product():
         return jsonify({'error': str(e)}), 500
 
 
+# Массовый импорт
+def import_from_request(kind):
+    """Импорт из загруженного файла (multipart, поле file) или из тела запроса"""
+    user = get_identity()
+    if user.role != 'cook':
+        return jsonify({'error': 'Требуется роль повара'}), 403
+
+    upload = request.files.get('file') if request.mimetype == 'multipart/form-data' else None
+    if upload is not None:
+        stream, fmt = upload.stream, detect_import_format(upload.filename, upload.mimetype)
+    else:
+        stream, fmt = request.stream, detect_import_format(content_type=request.mimetype)
+    fmt = request.args.get('format', fmt)
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'error': f"Укажите формат: {', '.join(IMPORT_FORMATS)}"}), 400
+
+    # Файл читается построчно, целиком в память не загружается
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        summary = import_records(kind, text, fmt)
+    except UnicodeDecodeError:
+        db.session.rollback()
+        return jsonify({'error': 'Файл должен быть в кодировке UTF-8'}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка при импорте ({kind}): {e}")
+        return jsonify({'error': 'Произошла ошибка при импорте'}), 500
+    finally:
+        text.detach()
+
+    return jsonify(dict(summary, success=summary['failed'] == 0)), 200
+
+
+@route('/api/menus/import', methods=['POST'])
+@login_required
+def api_import_menus():
+    """Импорт меню из CSV/JSON Lines (upsert по дате, приему пищи и блюду)"""
+    return import_from_request('menus')
+
+
+@route('/api/products/import', methods=['POST'])
+@login_required
+def api_import_products():
+    """Импорт продуктов из CSV/JSON Lines (upsert по названию)"""
+    return import_from_request('products')
+
+
+@route('/api/dish-ingredients/import', methods=['POST'])
+@login_required
+def api_import_dish_ingredients():
+    """Импорт состава блюд из CSV/JSON Lines (upsert по блюду и продукту)"""
+    return import_from_request('dish_ingredients')
+
+
+# Поток заказов для экранов кухни
+@route('/api/kitchen/stream', methods=['GET'])
+@login_required
+def api_kitchen_stream():
+    """Server-Sent Events: новые заказы и смена статусов; продолжение с заголовка Last-Event-ID"""
+    user = get_identity()
+    if user.role != 'cook':
+        return jsonify({'error': 'Требуется роль повара'}), 403
+
+    config = current_app.config
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    stream = kitchen_event_stream(get_event_bus(), last_id, config['KITCHEN_STREAM_HEARTBEAT'],
+                                  config['KITCHEN_STREAM_MAX_SECONDS'])
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx не должен буферизовать поток
+    return response
+
+
+# Выгрузка для бухгалтерии
+@route('/api/export/<kind>', methods=['GET'])
+@login_required
+def api_export(kind):
+    """Потоковая выгрузка заказов, платежей или отзывов в CSV/NDJSON (?gzip=1 - сжатый файл)"""
+    user = get_identity()
+    if user.role != 'admin':
+        return jsonify({'error': 'Требуется роль администратора'}), 403
+
+    spec = EXPORT_SPECS.get(kind)
+    if spec is None:
+        return jsonify({'error': f"Неизвестная выгрузка, доступны: {', '.join(EXPORT_SPECS)}"}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Формат должен быть одним из: {', '.join(EXPORT_FORMATS)}"}), 400
+
+    filters = {}
+    for name in ('date_from', 'date_to'):
+        value = request.args.get(name)
+        if value:
+            try:
+                filters[name] = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                return jsonify({'error': f'Параметр {name} должен быть в формате ГГГГ-ММ-ДД'}), 400
+    status = request.args.get('status')
+    if status:
+        if spec.status_name is None:
+            return jsonify({'error': 'У этой выгрузки нет фильтра по статусу'}), 400
+        filters['status'] = status
+
+    compress = parse_bool(request.args.get('gzip'))
+    filename = f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}" + ('.gz' if compress else '')
+    body = stream_with_context(export_stream(kind, fmt, compress=compress, **filters))
+    response = Response(body, mimetype='application/gzip' if compress else EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@route('/api/menus/forecast', methods=['GET'])
+@login_required
+def api_menu_forecast():
+    """Предлагаемое количество порций для меню на день (?date=ГГГГ-ММ-ДД, по умолчанию завтра)"""
+    user = get_identity()
+    if user.role not in ('cook', 'admin'):
+        return jsonify({'error': 'Требуется роль повара или администратора'}), 403
+    try:
+        day = (datetime.strptime(request.args['date'], '%Y-%m-%d').date() if request.args.get('date')
+               else datetime.now().date() + timedelta(days=1))
+    except ValueError:
+        return jsonify({'error': 'Дата должна быть в формате ГГГГ-ММ-ДД'}), 400
+    model = get_demand_model()
+    if model is None:
+        return jsonify({'error': 'Прогноз недоступен'}), 503
+    config = current_app.config
+    return jsonify({
+        'date': day.isoformat(),
+        'items': [
+            {'menu_id': item['id'], 'meal_type': item['meal_type'], 'dish_name': item['dish_name'],
+             'available_count': item['available_count'],
+             'proposed': model.propose(item['meal_type'], item['dish_name'], day, config),
+             'by_grade': model.by_grade(item['meal_type'], item['dish_name'], day)}
+            for item in get_menu_for_date(day)
+        ],
+    }), 200
+
+
+# Рейтинг блюд
+DISH_RANKING_SIZE = 10
+DISH_RANKING_MAX_SIZE = 100
+
+
+@route('/api/dishes/ranking', methods=['GET'])
+@login_required
+def api_dish_ranking():
+    """Лучшие (?order=top) или худшие (?order=bottom) блюда по байесовской оценке из сводки отзывов"""
+    order = request.args.get('order', 'top')
+    if order not in ('top', 'bottom'):
+        return jsonify({'error': 'Параметр order: top или bottom'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', DISH_RANKING_SIZE)), 1), DISH_RANKING_MAX_SIZE)
+        min_reviews = max(int(request.args.get('min_reviews', 1)), 1)
+    except ValueError:
+        return jsonify({'error': 'Параметры limit и min_reviews должны быть числами'}), 400
+
+    score = bayesian_score(current_app.config['RATING_PRIOR_WEIGHT']).label('score')
+    rows = db.session.execute(
+        select(DishRating, score)
+        .where(DishRating.reviews_count >= min_reviews)
+        .order_by(score.desc() if order == 'top' else score.asc(), DishRating.reviews_count.desc(),
+                  DishRating.dish_name)
+        .limit(limit)
+    ).all()
+    return jsonify({
+        'order': order,
+        'items': [
+            {'dish_name': rating.dish_name, 'score': round(score, 3), 'avg_rating': round(rating.avg_rating, 3),
+             'reviews_count': rating.reviews_count, 'histogram': rating.histogram,
+             'updated_at': rating.updated_at.isoformat()}
+            for rating, score in rows
+        ],
+    }), 200
+
+
+@route('/api/purchase-requests/generate', methods=['POST'])
+@login_required
+def api_generate_purchase_requests():
+    """Запустить проверку запасов в фоне (заявки создаст задача replenish)"""
+    user = get_identity()
+    if user.role not in ('cook', 'admin'):
+        return jsonify({'error': 'Требуется роль повара или администратора'}), 403
+    queued = enqueue('replenish', unique=True)
+    return jsonify({'success': True, 'queued': queued}), 202
+
+
+# Пополнение баланса
+@route('/api/students/<int:student_id>/topup', methods=['POST'])
+@login_required
+def api_topup_balance(student_id):
+    """Пополнить баланс ученика (сумма в рублях, до копеек)"""
+    user = get_identity()
+    if user.role != 'admin':
+        return jsonify({'error': 'Требуется роль администратора'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        amount = Decimal(str(data.get('amount')))
+    except InvalidOperation:
+        return jsonify({'error': 'Сумма должна быть числом'}), 400
+    if not amount.is_finite() or amount <= 0 or amount != amount.quantize(KOPECK):
+        return jsonify({'error': 'Сумма должна быть положительной, не точнее копейки'}), 400
+    if not db.session.get(Student, student_id):
+        return jsonify({'error': 'Ученик не найден'}), 404
+
+    credit_balance(student_id, to_kopecks(amount))
+    db.session.commit()
+    return jsonify({'success': True, 'balance': str(kopecks_to_rubles(get_balance(student_id)))}), 200
+
+
 # API для заказов
-@app.route('/api/orders/<int:order_id>/issue', methods=['POST'])
+@route('/api/orders/<int:order_id>/issue', methods=['POST'])
 @login_required
 def api_issue_order(order_id):
     """Отметить заказ как выданный"""
-    user = get_current_user()
+    user = get_identity()
     if user.role != 'cook':
         return jsonify({'message': 'Требуется роль повара'}), 403
 
@@ -742,17 +4186,1222 @@ def api_issue_order(order_id):
 
     order.status = 'issued'
     db.session.commit()
+    publish_order_events('order_status', [order.id])
 
     return jsonify({'message': 'Заказ отмечен как выданный'}), 200
 
 
+@route('/api/orders/transition', methods=['POST'])
+@login_required
+def api_transition_orders():
+    """Перевести пачку заказов в новый статус (по умолчанию 'issued') за один запрос.
+    Тело: {"order_ids": [...]} или {"grade": "5А", "meal_type": "lunch", "date": "ГГГГ-ММ-ДД"}"""
+    user = get_identity()
+    if user.role != 'cook':
+        return jsonify({'error': 'Требуется роль повара'}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    status = data.get('status', 'issued')
+    if status not in ORDER_TRANSITIONS:
+        return jsonify({'error': f"Статус должен быть одним из: {', '.join(ORDER_TRANSITIONS)}"}), 400
+
+    criteria = {}
+    if 'order_ids' in data:
+        raw_ids = data['order_ids']
+        if not isinstance(raw_ids, list) or not raw_ids:
+            return jsonify({'error': 'Список заказов пуст'}), 400
+        if len(raw_ids) > ORDER_BATCH_MAX:
+            return jsonify({'error': f'Не больше {ORDER_BATCH_MAX} заказов за раз'}), 400
+        try:
+            criteria['order_ids'] = sorted({int(order_id) for order_id in raw_ids})
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Некорректный идентификатор заказа'}), 400
+    else:
+        grade = data.get('grade')
+        meal_type = data.get('meal_type')
+        if not grade or meal_type not in MEAL_TYPES:
+            return jsonify({'error': 'Укажите order_ids или grade и meal_type'}), 400
+        try:
+            day = datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') else datetime.now().date()
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Дата должна быть в формате ГГГГ-ММ-ДД'}), 400
+        criteria.update(grade=grade, meal_type=meal_type, day=day)
+
+    try:
+        updated, skipped = transition_orders(status, **criteria)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка при смене статуса заказов: {e}")
+        return jsonify({'error': 'Произошла ошибка при смене статуса заказов'}), 500
+
+    return jsonify({
+        'success': True,
+        'status': status,
+        'updated': updated,
+        'skipped': skipped,
+    }), 200
+
+
+# API для мобильного приложения: без сессии, ученик и его ограничения берутся из JWT
+MOBILE_ORDERS_PAGE_SIZE = 50
+MOBILE_ORDERS_MAX_PAGE_SIZE = 200
+
+
+def init_jwt(app):
+    """JWT для мобильного API; ошибки токена в том же виде {'error': ...}, что и в остальном API"""
+    jwt = JWTManager(app)
+    jwt.unauthorized_loader(lambda reason: (jsonify({'error': 'Требуется токен доступа'}), 401))
+    jwt.invalid_token_loader(lambda reason: (jsonify({'error': 'Недействительный токен'}), 401))
+    jwt.expired_token_loader(lambda header, payload: (jsonify({'error': 'Срок действия токена истек'}), 401))
+
+
+def issue_student_tokens(user_id, student, refresh=True):
+    """Токены ученика: в утверждениях id ученика и маска ограничений, чтобы запросы обходились без базы"""
+    claims = {'sid': student.id, 'rm': student.restriction_mask or 0}
+    tokens = {'access_token': create_access_token(identity=str(user_id), additional_claims=claims)}
+    if refresh:
+        tokens['refresh_token'] = create_refresh_token(identity=str(user_id), additional_claims={'sid': student.id})
+    return tokens
+
+
+def student_token_required(f):
+    """Декоратор мобильного API: действующий access-токен ученика"""
+
+    @wraps(f)
+    @jwt_required()
+    def decorated_function(*args, **kwargs):
+        if get_jwt().get('sid') is None:
+            return jsonify({'error': 'Требуется токен ученика'}), 403
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def conditional_json(payload):
+    """JSON-ответ с ETag: повторный запрос с If-None-Match получает 304 без тела"""
+    response = jsonify(payload)
+    response.add_etag(weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+@route('/api/v1/auth/token', methods=['POST'])
+def api_v1_token():
+    """Вход ученика по логину и паролю: access- и refresh-токены"""
+    data = request.get_json(silent=True)
+    username, password = (data.get('username'), data.get('password')) if isinstance(data, dict) else (None, None)
+    if not isinstance(username, str) or not isinstance(password, str):
+        return jsonify({'error': 'Нужны username и password'}), 400
+
+    limit_keys = (('user', username), ('ip', request.remote_addr))
+    retry_after = login_retry_after(*limit_keys)
+    if retry_after:
+        response = jsonify({'error': 'Слишком много попыток, попробуйте позже'})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+
+    user = User.query.filter_by(username=username).first()
+    try:
+        authenticated = user is not None and verify_password(user, password)
+    except PasswordHashingBusy:
+        return jsonify({'error': 'Сервер перегружен, попробуйте позже'}), 503
+    if not authenticated:
+        return jsonify({'error': 'Неверный логин или пароль'}), 401
+    login_succeeded(*limit_keys)
+    if user.role != 'student' or user.student is None:
+        return jsonify({'error': 'API доступно только ученикам'}), 403
+    return jsonify(issue_student_tokens(user.id, user.student)), 200
+
+
+@route('/api/v1/auth/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def api_v1_refresh():
+    """Новый access-токен по refresh-токену (ограничения ученика перечитываются из базы)"""
+    student = Student.query.get(get_jwt().get('sid'))
+    if student is None:
+        return jsonify({'error': 'Профиль ученика не найден'}), 404
+    return jsonify(issue_student_tokens(get_jwt_identity(), student, refresh=False)), 200
+
+
+@route('/api/v1/menu', methods=['GET'])
+@student_token_required
+def api_v1_menu():
+    """Меню на день (?date=ГГГГ-ММ-ДД, по умолчанию сегодня) без блюд, которые ученику нельзя"""
+    try:
+        day = (datetime.strptime(request.args['date'], '%Y-%m-%d').date() if request.args.get('date')
+               else datetime.now().date())
+    except ValueError:
+        return jsonify({'error': 'Дата должна быть в формате ГГГГ-ММ-ДД'}), 400
+    items = filter_menu_by_restrictions(get_menu_for_date(day), get_jwt().get('rm', 0))
+    return conditional_json({
+        'date': day.isoformat(),
+        'items': [
+            {'id': item['id'], 'meal_type': item['meal_type'], 'dish_name': item['dish_name'],
+             'price': item['price'], 'available_count': item['available_count'],
+             'allergens': allergen_codes(item['allergen_mask']),
+             'allergens_known': item.get('allergens_known', False)}
+            for item in items
+        ],
+    })
+
+
+@route('/api/v1/balance', methods=['GET'])
+@student_token_required
+def api_v1_balance():
+    """Баланс ученика в рублях"""
+    return conditional_json({'balance': str(kopecks_to_rubles(get_balance(get_jwt()['sid'])))})
+
+
+@route('/api/v1/orders', methods=['POST'])
+@student_token_required
+def api_v1_create_orders():
+    """Заказ одного блюда ({"menu_id": 1}) или корзины ({"menu_ids": [1, 2]})"""
+    student_id = get_jwt()['sid']
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    raw_ids = data.get('menu_ids') if 'menu_ids' in data else [data.get('menu_id')]
+    if not isinstance(raw_ids, list) or not raw_ids:
+        return jsonify({'error': 'Нужен menu_id или непустой menu_ids'}), 400
+    if len(raw_ids) > CHECKOUT_MAX_ITEMS:
+        return jsonify({'error': f'В корзине не может быть больше {CHECKOUT_MAX_ITEMS} позиций'}), 400
+    try:
+        menu_ids = [int(menu_id) for menu_id in raw_ids]
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Некорректный идентификатор блюда'}), 400
+
+    try:
+        if 'menu_ids' in data:
+            results, total = checkout(student_id, menu_ids)
+            ordered = sum(1 for item in results if item['status'] == 'ok')
+            return jsonify({'ordered': ordered, 'total': total, 'items': results}), 201 if ordered else 409
+        order = place_order(student_id, menu_ids[0])
+    except OrderError as e:
+        return jsonify({'error': e.message}), 409
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка при оформлении заказа через API: {e}")
+        return jsonify({'error': 'Произошла ошибка при оформлении заказа'}), 500
+    return jsonify({'id': order.id, 'menu_id': order.menu_id, 'status': order.status}), 201
+
+
+def student_history_query(student_id, after=None, limit=MOBILE_ORDERS_PAGE_SIZE):
+    """Страница истории заказов ученика (оперативная таблица и архивы) с блюдами, новые первыми;
+    after - (order_date, id) последней строки предыдущей страницы. Выбирает limit + 1 строк."""
+
+    def student_orders(table):
+        # Условия курсора в каждой части UNION ALL, чтобы они шли по индексу (student_id, order_date)
+        conditions = [table.c.student_id == student_id]
+        if after is not None:
+            conditions.append(db.tuple_(table.c.order_date, table.c.id) < tuple(after))
+        return conditions
+
+    history = history_select('orders', ['id', 'order_date', 'status', 'menu_id'], 'order_date',
+                             where=student_orders).subquery()
+    return (select(history, Menu.date, Menu.meal_type, Menu.dish_name, Menu.price)
+            .join(Menu, Menu.id == history.c.menu_id)
+            .order_by(history.c.order_date.desc(), history.c.id.desc())
+            .limit(limit + 1))
+
+
+@route('/api/v1/orders', methods=['GET'])
+@student_token_required
+def api_v1_orders():
+    """История заказов ученика, новые первыми (?cursor, ?limit), вместе с архивом прошлых полугодий"""
+    try:
+        limit = min(max(int(request.args.get('limit', MOBILE_ORDERS_PAGE_SIZE)), 1), MOBILE_ORDERS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Параметр limit должен быть числом'}), 400
+    after = decode_cursor(request.args.get('cursor'), (Order.order_date, Order.id))
+    rows = db.session.execute(student_history_query(get_jwt()['sid'], after, limit)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].order_date, rows[-1].id])
+    return conditional_json({
+        'items': [
+            {'id': row.id, 'menu_id': row.menu_id, 'date': row.date.isoformat(), 'meal_type': row.meal_type,
+             'dish_name': row.dish_name, 'price': str(row.price), 'status': row.status,
+             'ordered_at': row.order_date.isoformat()}
+            for row in rows
+        ],
+        'next_cursor': next_cursor,
+    })
+
+
+# ================== НАГРУЗОЧНОЕ ТЕСТИРОВАНИЕ ==================
+
+BENCH_PASSWORD = 'bench123'
+BENCH_CHUNK_SIZE = 5000
+BENCH_BREAKFAST_DISHES = [f'Завтрак №{number}' for number in range(1, 13)]
+BENCH_LUNCH_DISHES = [f'Обед №{number}' for number in range(1, 13)]
+
+
+def bulk_insert(model, rows, returning=False):
+    """Вставить строки пачками по BENCH_CHUNK_SIZE; при returning вернуть id в порядке строк"""
+    ids = []
+    for start in range(0, len(rows), BENCH_CHUNK_SIZE):
+        chunk = rows[start:start + BENCH_CHUNK_SIZE]
+        if returning:
+            ids.extend(db.session.scalars(
+                insert(model).returning(model.id, sort_by_parameter_order=True), chunk
+            ).all())
+        else:
+            db.session.execute(insert(model), chunk)
+    return ids
+
+
+def seed_benchmark_data(students=2000, days=90, reviews=5000, products=200, order_rate=0.6, seed=42):
+    """Заполнить базу данными для нагрузочного теста (детерминированно по seed)"""
+    rng = random.Random(seed)
+    password_hash = hash_password(BENCH_PASSWORD)
+    today = datetime.now().date()
+
+    staff = [
+        {'username': 'bench_cook', 'password': password_hash, 'role': 'cook'},
+        {'username': 'bench_admin', 'password': password_hash, 'role': 'admin'},
+    ]
+    bulk_insert(User, staff)
+    cook_id = User.query.filter_by(username='bench_cook').first().id
+
+    user_ids = bulk_insert(User, [
+        {'username': f'bench_student_{number}', 'password': password_hash, 'role': 'student'}
+        for number in range(students)
+    ], returning=True)
+    grades = [f'{number}{letter}' for number in range(5, 12) for letter in 'АБВ']
+    student_ids = bulk_insert(Student, [
+        {'user_id': user_id, 'grade': rng.choice(grades), 'allergies': 'Нет', 'preferences': ''}
+        for user_id in user_ids
+    ], returning=True)
+    bulk_insert(BalanceEntry, [
+        {'student_id': student_id, 'amount': to_kopecks(1_000_000), 'kind': 'opening'}
+        for student_id in student_ids
+    ])
+    db.session.commit()
+
+    product_ids = bulk_insert(Product, [
+        {'name': f'Продукт №{number}', 'unit': rng.choice(['кг', 'л', 'шт']),
+         'current_quantity': rng.uniform(0, 100), 'min_quantity': rng.uniform(5, 30)}
+        for number in range(products)
+    ], returning=True)
+    bulk_insert(DishIngredient, [
+        {'dish_name': dish_name, 'product_id': product_id, 'quantity': round(rng.uniform(0.01, 0.3), 3)}
+        for dish_name in BENCH_BREAKFAST_DISHES + BENCH_LUNCH_DISHES
+        for product_id in rng.sample(product_ids, min(4, len(product_ids)))
+    ])
+    bulk_insert(PurchaseRequest, [
+        {'product_id': rng.choice(product_ids), 'quantity': rng.uniform(5, 50), 'requested_by': cook_id,
+         'status': rng.choice(['pending', 'approved', 'approved', 'rejected']),
+         'request_date': datetime.now() - timedelta(days=rng.uniform(0, days))}
+        for _ in range(products * 5)
+    ])
+    db.session.commit()
+
+    # Меню, заказы и оплаты по дням: в памяти одновременно только один день
+    orders_total = 0
+    for offset in range(days - 1, -2, -1):
+        day = today - timedelta(days=offset)
+        menu_rows = []
+        for meal_type, dishes in (('breakfast', BENCH_BREAKFAST_DISHES), ('lunch', BENCH_LUNCH_DISHES)):
+            for dish_name in rng.sample(dishes, 3):
+                menu_rows.append({'date': day, 'meal_type': meal_type, 'dish_name': dish_name,
+                                  'description': '', 'price': float(rng.randrange(100, 300, 10)),
+                                  'available_count': 1_000_000})
+        menu_ids = bulk_insert(Menu, menu_rows, returning=True)
+        if offset < 0:
+            continue  # на завтра только меню
+
+        order_rows = []
+        prices = []
+        for student_id in student_ids:
+            if rng.random() >= order_rate:
+                continue
+            index = rng.randrange(len(menu_ids))
+            order_rows.append({
+                'student_id': student_id,
+                'menu_id': menu_ids[index],
+                'order_date': datetime.combine(day, datetime.min.time()) + timedelta(minutes=rng.randrange(480, 900)),
+                'status': 'issued' if offset > 0 else rng.choice(['pending', 'paid']),
+                'payment_type': 'single'
+            })
+            prices.append(menu_rows[index]['price'])
+        order_ids = bulk_insert(Order, order_rows, returning=True)
+        bulk_insert(Payment, [
+            {'order_id': order_id, 'amount': price, 'payment_date': row['order_date'],
+             'method': rng.choice(['card', 'cash'])}
+            for order_id, price, row in zip(order_ids, prices, order_rows) if row['status'] != 'pending'
+        ])
+        db.session.commit()
+        orders_total += len(order_rows)
+
+    all_dishes = BENCH_BREAKFAST_DISHES + BENCH_LUNCH_DISHES
+    bulk_insert(Review, [
+        {'student_id': rng.choice(student_ids), 'dish_name': rng.choice(all_dishes),
+         'rating': rng.choices([1, 2, 3, 4, 5], weights=[1, 2, 4, 6, 5])[0], 'comment': '',
+         'date': datetime.now() - timedelta(days=rng.uniform(0, days))}
+        for _ in range(reviews)
+    ])
+    db.session.commit()
+    return {'students': students, 'days': days, 'orders': orders_total, 'reviews': reviews, 'products': products}
+
+
+class BenchScenario:
+    """Сценарий нагрузочного теста: запрос к одному маршруту от имени роли"""
+
+    def __init__(self, name, method, path, role=None, data=None, fresh_client=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.role = role
+        self.data = data
+        # Новый клиент (без cookie сессии) на каждый запрос, например для входа
+        self.fresh_client = fresh_client
+
+    def login(self, client, worker):
+        if self.role == 'student':
+            username = f'bench_student_{worker}'
+        elif self.role:
+            username = f'bench_{self.role}'
+        else:
+            return
+        client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+
+    def send(self, client, worker):
+        if self.name == 'login':
+            data = {'username': f'bench_student_{worker}', 'password': BENCH_PASSWORD}
+        else:
+            data = self.data
+        return client.open(self.path, method=self.method, data=data)
+
+
+def bench_scenarios():
+    """Маршруты, которые проверяет нагрузочный тест"""
+    today_menu = Menu.query.filter(Menu.date == datetime.now().date()).first()
+    menu_id = today_menu.id if today_menu else 0
+    return [
+        BenchScenario('login', 'POST', '/login', fresh_client=True),
+        BenchScenario('student_dashboard', 'GET', '/student/dashboard', role='student'),
+        BenchScenario('order_create', 'POST', '/order/create', role='student', data={'menu_id': menu_id}),
+        BenchScenario('cook_dashboard', 'GET', '/cook/dashboard', role='cook'),
+        BenchScenario('admin_dashboard', 'GET', '/admin/dashboard', role='admin'),
+        BenchScenario('purchase_statistics', 'GET', '/purchase-statistics', role='cook'),
+        BenchScenario('api_products', 'GET', '/api/products'),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(-(-fraction * len(sorted_values) // 1)) - 1))
+    return sorted_values[index]
+
+
+def run_bench_scenario(app, scenario, requests_count, threads):
+    """Выполнить сценарий в threads потоках; задержки, число SQL-запросов и коды ответов"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    local = threading.local()
+
+    def count_statement(*args):
+        local.statements = getattr(local, 'statements', 0) + 1
+
+    def worker(number):
+        client = app.test_client()
+        scenario.login(client, number)
+        samples = []
+        for _ in range(number, requests_count, threads):
+            if scenario.fresh_client:
+                client = app.test_client()
+            local.statements = 0
+            started = time.perf_counter()
+            response = scenario.send(client, number)
+            samples.append((time.perf_counter() - started, local.statements, response.status_code))
+        return samples
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            samples = [sample for chunk in pool.map(worker, range(threads)) for sample in chunk]
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    statements = [sample[1] for sample in samples]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample[2] >= 500),
+        'status_codes': dict(Counter(str(sample[2]) for sample in samples)),
+        'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'sql_per_request': round(sum(statements) / len(statements), 2) if statements else 0.0,
+        'sql_max': max(statements) if statements else 0,
+    }
+
+
+def current_commit():
+    """Короткий хэш текущего коммита git (если доступен)"""
+    import subprocess
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# ================== КОМАНДЫ CLI ==================
+
+@cli.command('init-db')
+def init_db():
+    """Создать таблицы, применить миграции и добавить тестовые данные"""
+    create_database(current_app._get_current_object())
+
+
+@cli.command('bench-orders')
+@click.option('--buyers', default=200, show_default=True, help='Количество одновременных покупателей')
+@click.option('--stock', default=50, show_default=True, help='Порций блюда в наличии')
+@click.option('--threads', default=32, show_default=True, help='Размер пула потоков')
+def bench_orders(buyers, stock, threads):
+    """Нагрузочный тест: N покупателей одновременно заказывают одно блюдо"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    app = current_app._get_current_object()
+
+    db.create_all()
+    tag = f'bench{int(time.time())}'
+    menu_item = Menu(date=datetime.now().date(), meal_type='lunch', dish_name=f'Бенчмарк {tag}',
+                     price=100.0, available_count=stock)
+    users = [User(username=f'{tag}_{i}', password='!', role='student') for i in range(buyers)]
+    db.session.add(menu_item)
+    db.session.add_all(users)
+    db.session.commit()
+    students = [Student(user_id=u.id, grade='bench') for u in users]
+    db.session.add_all(students)
+    db.session.flush()
+    for student in students:
+        credit_balance(student.id, to_kopecks(1000), kind='opening')
+    db.session.commit()
+    menu_id = menu_item.id
+    student_ids = [s.id for s in students]
+
+    outcomes = {'ok': 0, 'rejected': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def buy(student_id):
+        with app.app_context():
+            try:
+                place_order(student_id, menu_id)
+                key = 'ok'
+            except OrderError:
+                key = 'rejected'
+            except Exception as e:
+                logger.warning(f"Покупка не удалась: {e}")
+                key = 'failed'
+            with lock:
+                outcomes[key] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(buy, student_ids))
+    elapsed = time.perf_counter() - started
+
+    db.session.expire_all()
+    sold = Order.query.filter_by(menu_id=menu_id).count()
+    remaining = Menu.query.get(menu_id).available_count
+    oversold = max(0, sold - stock) + max(0, -remaining)
+
+    click.echo(f"Покупателей: {buyers}, порций: {stock}, потоков: {threads}")
+    click.echo(f"Успешно: {outcomes['ok']}, отказ: {outcomes['rejected']}, ошибок: {outcomes['failed']}")
+    click.echo(f"Время: {elapsed:.3f} c, пропускная способность: {buyers / elapsed:.1f} заказов/с")
+    click.echo(f"Заказов в базе: {sold}, остаток: {remaining}, перепродано: {oversold}")
+
+    # Убираем тестовые данные
+    BalanceEntry.query.filter(BalanceEntry.student_id.in_(student_ids)).delete()
+    Order.query.filter_by(menu_id=menu_id).delete()
+    Student.query.filter(Student.id.in_(student_ids)).delete()
+    User.query.filter(User.username.like(f'{tag}_%')).delete()
+    Menu.query.filter_by(id=menu_id).delete()
+    db.session.commit()
+
+    if oversold:
+        raise SystemExit(1)
+
+
+@cli.command('seed-bench')
+@click.option('--students', default=2000, show_default=True, help='Количество учеников')
+@click.option('--days', default=90, show_default=True, help='Дней истории меню, заказов и оплат')
+@click.option('--reviews', default=5000, show_default=True, help='Количество отзывов')
+@click.option('--products', default=200, show_default=True, help='Количество продуктов на складе')
+@click.option('--seed', default=42, show_default=True, help='Зерно генератора случайных чисел')
+def seed_bench(students, days, reviews, products, seed):
+    """Заполнить базу данными для нагрузочного теста (лучше отдельную: DATABASE_URL=...)"""
+    db.create_all()
+    migrate_database()
+    if User.query.filter_by(username='bench_admin').first():
+        click.echo("Данные для нагрузочного теста уже есть в этой базе")
+        return
+    started = time.perf_counter()
+    summary = seed_benchmark_data(students=students, days=days, reviews=reviews, products=products, seed=seed)
+    click.echo(f"✅ Данные созданы за {time.perf_counter() - started:.1f} c: {summary}")
+
+
+@cli.command('bench-http')
+@click.option('--requests', 'requests_count', default=200, show_default=True, help='Запросов на каждый маршрут')
+@click.option('--threads', default=8, show_default=True, help='Одновременных клиентов')
+@click.option('--only', default='', help='Через запятую: какие сценарии запускать')
+@click.option('--output', default='bench_results.json', show_default=True, help='Файл для результатов (JSON)')
+@click.option('--compare', 'compare_path', default=None, help='Сравнить с ранее сохраненными результатами')
+def bench_http(requests_count, threads, only, output, compare_path):
+    """Нагрузочный тест HTTP-маршрутов (база заполняется командой seed-bench)"""
+    app = current_app._get_current_object()
+    if not User.query.filter_by(username='bench_admin').first():
+        raise click.ClickException("Сначала заполните базу: flask seed-bench")
+
+    # Тест входит много раз подряд с одного адреса, ограничение попыток входа на это время снимается
+    app.config['LOGIN_RATE_BURST'] = 0
+    app.config['LOGIN_IP_RATE_BURST'] = 0
+
+    selected = {name.strip() for name in only.split(',') if name.strip()}
+    scenarios = [scenario for scenario in bench_scenarios() if not selected or scenario.name in selected]
+    results = {}
+    click.echo(f"{'сценарий':<22}{'rps':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'SQL/запр':>10}{'ошибок':>8}")
+    for scenario in scenarios:
+        result = run_bench_scenario(app, scenario, requests_count, threads)
+        results[scenario.name] = result
+        click.echo(f"{scenario.name:<22}{result['rps']:>9}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+                   f"{result['p99_ms']:>10}{result['sql_per_request']:>10}{result['errors']:>8}")
+
+    report = {
+        'commit': current_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'requests': requests_count,
+        'threads': threads,
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    click.echo(f"Результаты сохранены в {output}")
+
+    if compare_path:
+        with open(compare_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        click.echo(f"Сравнение с {compare_path} (коммит {baseline.get('commit')}):")
+        for name, result in results.items():
+            previous = baseline.get('results', {}).get(name)
+            if not previous:
+                continue
+            changes = []
+            for key in ('rps', 'p95_ms', 'sql_per_request'):
+                if previous[key]:
+                    changes.append(f"{key} {(result[key] - previous[key]) / previous[key] * 100:+.1f}%")
+            click.echo(f"  {name}: {', '.join(changes)}")
+
+
+@cli.command('import')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_SPECS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default=None,
+              help='Формат файла (по умолчанию по расширению)')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='Строк в одной транзакции')
+def import_file(kind, path, fmt, chunk_size):
+    """Импортировать меню или продукты из файла CSV/JSON Lines"""
+    fmt = fmt or detect_import_format(path)
+    if fmt is None:
+        raise click.ClickException("Не удалось определить формат файла, укажите --format")
+    started = time.perf_counter()
+    with open(path, encoding='utf-8-sig', newline='') as text:
+        summary = import_records(kind, text, fmt, chunk_size=chunk_size)
+    for error in summary['errors']:
+        click.echo(f"Строка {error['line']}: {error['error']}")
+    click.echo(f"✅ Обработано строк: {summary['processed']}, импортировано: {summary['imported']}, "
+               f"с ошибками: {summary['failed']} за {time.perf_counter() - started:.1f} c")
+
+
+@cli.command('snapshot-balances')
+@click.option('--rebuild', is_flag=True, help='Пересчитать снимки по всему журналу, а не от предыдущих')
+def snapshot_balances_command(rebuild):
+    """Обновить снимки балансов (запускать периодически, например из cron)"""
+    started = time.perf_counter()
+    updated = snapshot_balances(db.session.connection(), rebuild=rebuild)
+    db.session.commit()
+    click.echo(f"✅ Снимков обновлено: {updated} за {time.perf_counter() - started:.2f} c")
+
+
+@cli.command('verify-balances')
+@click.option('--fix', is_flag=True, help='При расхождениях пересчитать снимки по всему журналу')
+def verify_balances_command(fix):
+    """Сверить балансы по снимкам с полной суммой журнала операций"""
+    mismatches = verify_balances()
+    for student_id, fast, expected in mismatches:
+        click.echo(f"Ученик {student_id}: по снимку {kopecks_to_rubles(fast)}, по журналу {kopecks_to_rubles(expected)}")
+    if not mismatches:
+        click.echo("✅ Балансы сходятся")
+        return
+    if fix:
+        snapshot_balances(db.session.connection(), rebuild=True)
+        db.session.commit()
+        click.echo(f"Снимки пересчитаны, расхождений было: {len(mismatches)}")
+    else:
+        raise SystemExit(1)
+
+
+@cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Выполнить готовые задачи и выйти')
+def run_jobs(once):
+    """Отдельный процесс-исполнитель фоновых задач (веб-процессы задачи не выполняют, если не задан JOBS_ENABLED=1)"""
+    runner = current_app.extensions['jobs']
+    if once:
+        click.echo(f"Выполнено задач: {runner.run_pending()}")
+        return
+    runner.start()
+    click.echo(f"Исполнитель запущен, потоков: {runner.workers}. Ctrl+C - остановка")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        runner.stop()
+
+
+@cli.command('enqueue')
+@click.argument('name', type=click.Choice(sorted(TASKS)))
+@click.option('--payload', default=None, help='Аргументы задачи в JSON')
+@click.option('--delay', default=0, show_default=True, help='Через сколько секунд выполнить')
+def enqueue_command(name, payload, delay):
+    """Поставить фоновую задачу в очередь"""
+    enqueue(name, json.loads(payload) if payload else None, delay=delay)
+    click.echo(f"✅ Задача {name} поставлена в очередь")
+
+
+@cli.command('replenish')
+@click.option('--dry-run', is_flag=True, help='Только показать прогноз, заявки не создавать')
+def replenish(dry_run):
+    """Прогноз расхода продуктов и заявки на закупку для тех, что скоро закончатся"""
+    config = current_app.config
+    if dry_run:
+        for item in project_replenishment(config['REPLENISH_WINDOW_DAYS'], config['REPLENISH_LEAD_DAYS'],
+                                          config['REPLENISH_COVER_DAYS']):
+            days_left = '-' if item['days_left'] is None else item['days_left']
+            click.echo(f"{item['name']:<30}{item['current_quantity']:>10.2f} {item['unit']:<4}"
+                       f"расход/день {item['daily_rate']:>8}  дней до минимума {days_left:>6}  "
+                       f"заказать {item['order_quantity']}{' (заявка уже есть)' if item['has_pending_request'] else ''}")
+        return
+    created = generate_purchase_requests(config)
+    click.echo(f"✅ Создано заявок на закупку: {len(created)}")
+
+
+@cli.command('forecast-menu')
+@click.option('--date', 'date_str', default=None, help='День меню ГГГГ-ММ-ДД (по умолчанию завтра)')
+@click.option('--apply', 'apply_counts', is_flag=True, help='Записать предложенное количество порций')
+def forecast_menu(date_str, apply_counts):
+    """Предложить количество порций для меню на день по истории заказов"""
+    day = (datetime.strptime(date_str, '%Y-%m-%d').date() if date_str
+           else datetime.now().date() + timedelta(days=1))
+    model = get_demand_model()
+    if model is None:
+        raise click.ClickException("Для прогноза нужен NumPy")
+    config = current_app.config
+    ordered = dict(db.session.execute(
+        select(Order.menu_id, db.func.count(Order.id)).join(Menu, Menu.id == Order.menu_id)
+        .where(Menu.date == day).group_by(Order.menu_id)
+    ).all())
+    items = menu_for_date_query(day).all()
+    for item in items:
+        proposed = model.propose(item.meal_type, item.dish_name, day, config)
+        click.echo(f"{item.meal_type:<10}{item.dish_name:<40}сейчас {item.available_count:>5}  "
+                   f"прогноз {proposed:>5}  по классам {model.by_grade(item.meal_type, item.dish_name, day)}")
+        if apply_counts:
+            # Уже сделанные заказы вычитаются: available_count - это оставшиеся порции
+            item.available_count = max(proposed - ordered.get(item.id, 0), 0)
+    if apply_counts:
+        db.session.commit()
+        click.echo(f"✅ Количество порций обновлено: {len(items)}")
+
+
+@cli.command('forecast-backtest')
+@click.option('--days', default=28, show_default=True, help='Сколько последних дней проверять')
+@click.option('--half-life', default=None, type=int, help='Период полураспада веса, дней')
+@click.option('--baseline', default=100, show_default=True, help='Постоянное количество порций для сравнения')
+def forecast_backtest(days, half_life, baseline):
+    """Проверить прогноз спроса на истории: ошибка, недостача, остатки и время расчета"""
+    config = current_app.config
+    started = time.perf_counter()
+    report = backtest_demand(days, half_life or config['FORECAST_HALF_LIFE_DAYS'], config, baseline=baseline)
+    if report is None:
+        raise click.ClickException("В базе нет истории меню и заказов")
+    click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+    click.echo(f"Время: {time.perf_counter() - started:.2f} c")
+
+
+@cli.command('reconcile-stats')
+def reconcile_stats():
+    """Пересчитать счетчики кабинета администратора с нуля"""
+    before = get_dashboard_stats()
+    before_values = {column.name: getattr(before, column.name) for column in DashboardStats.__table__.columns}
+    reconcile_dashboard_stats(db.session.connection())
+    db.session.commit()
+    db.session.expire_all()
+    after = get_dashboard_stats()
+    for name, value in before_values.items():
+        if name in ('id', 'reconciled_at'):
+            continue
+        new_value = getattr(after, name)
+        if new_value != value:
+            click.echo(f"{name}: {value} -> {new_value}")
+    click.echo("✅ Счетчики пересчитаны")
+
+
+@cli.command('archive-orders')
+@click.option('--horizon', default=None, type=int, help='Возраст заказов в днях (по умолчанию ARCHIVE_HORIZON_DAYS)')
+@click.option('--batch-size', default=None, type=int, help='Заказов в одной транзакции')
+@click.option('--dry-run', is_flag=True, help='Только посчитать, что будет перенесено')
+def archive_orders(horizon, batch_size, dry_run):
+    """Перенести выданные заказы старше горизонта и их оплаты в архивные таблицы полугодий"""
+    config = current_app.config
+    started = time.perf_counter()
+    moved = archive_closed_orders(horizon or config['ARCHIVE_HORIZON_DAYS'],
+                                  batch_size or config['ARCHIVE_BATCH_SIZE'], dry_run=dry_run)
+    verb = 'Будет перенесено' if dry_run else 'Перенесено'
+    click.echo(f"{verb}: заказов {moved['orders']}, оплат {moved['payments']} "
+               f"({time.perf_counter() - started:.2f} c)")
+    for partition in ArchivePartition.query.order_by(ArchivePartition.source, ArchivePartition.term):
+        click.echo(f"  {partition.table_name:<30}{partition.rows_count:>10}  "
+                   f"{partition.date_from:%Y-%m-%d} - {partition.date_to:%Y-%m-%d}")
+
+
+@cli.command('rebuild-ratings')
+def rebuild_ratings():
+    """Пересчитать сводку отзывов по блюдам из таблицы отзывов"""
+    rebuild_dish_ratings(db.session.connection())
+    db.session.commit()
+    click.echo(f"✅ Сводка пересчитана: {DishRating.query.count()} блюд")
+
+
+def explain_query_plan(query):
+    """Получить EXPLAIN QUERY PLAN для запроса (список строк плана)"""
+    statement = query.statement if hasattr(query, 'statement') else query
+    compiled = statement.compile(dialect=db.engine.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup or ())
+    rows = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).all()
+    return [row[-1] for row in rows]
+
+
+def dashboard_queries(day):
+    """Запросы кабинетов, которые обязаны использовать индексы"""
+    return {
+        'kitchen_orders': kitchen_orders_query(day),
+        'student_orders': student_orders_query(1, day),
+        'admin_today_orders': select(db.func.count(Order.id)).where(day_range(Order.order_date, day)),
+        'menu_for_date': menu_for_date_query(day),
+        'student_by_user': Student.query.filter_by(user_id=1),
+        'login_user': User.query.filter_by(username='student'),
+        'mobile_order_history': student_history_query(1),
+        'pending_requests': PurchaseRequest.query.filter_by(status='pending')
+            .order_by(PurchaseRequest.request_date.desc(), PurchaseRequest.id.desc())
+            .limit(PENDING_REQUESTS_PAGE_SIZE + 1),
+        'recent_reviews': Review.query.order_by(Review.date.desc()).limit(5),
+        'purchase_history_page': PurchaseRequest.query
+            .filter(db.tuple_(PurchaseRequest.request_date, PurchaseRequest.id) < (datetime.utcnow(), 0))
+            .order_by(PurchaseRequest.request_date.desc(), PurchaseRequest.id.desc())
+            .limit(PURCHASE_HISTORY_PAGE_SIZE + 1),
+        'products_low_stock_page': products_page_query(['name', 'id'], low_stock=True)
+            .order_by(Product.name, Product.id).limit(PRODUCTS_PAGE_SIZE + 1),
+        'products_prefix_page': products_page_query(['name', 'id'], prefix='Мо')
+            .order_by(Product.name, Product.id).limit(PRODUCTS_PAGE_SIZE + 1),
+        'export_orders': EXPORT_SPECS['orders'].query(day - timedelta(days=30), day, 'paid'),
+        'export_payments': EXPORT_SPECS['payments'].query(day - timedelta(days=30), day),
+        'export_reviews': EXPORT_SPECS['reviews'].query(day - timedelta(days=30), day),
+    }
+
+
+@cli.command('check-query-plans')
+def check_query_plans():
+    """Проверить по EXPLAIN QUERY PLAN, что запросы кабинетов используют индексы"""
+    failed = False
+    for name, query in dashboard_queries(datetime.now().date()).items():
+        plan = explain_query_plan(query)
+        full_scans = [line for line in plan if line.startswith('SCAN') and 'INDEX' not in line]
+        failed = failed or bool(full_scans)
+        click.echo(f"{'FAIL' if full_scans else 'OK'} {name}: {'; '.join(plan)}")
+
+    if failed:
+        raise SystemExit(1)
+
+
+@cli.command('check-query-counts')
+def check_query_counts():
+    """Проверить, что загрузка кабинетов укладывается в постоянное число запросов"""
+    today = datetime.now().date()
+    failed = False
+    student = Student.query.first()
+    loaders = [('cook_dashboard', lambda: load_kitchen_orders(today))]
+    if student:
+        loaders.append(('student_dashboard', lambda: load_student_orders(student.id, today)))
+
+    for name, loader in loaders:
+        db.session.expunge_all()
+        with QueryCounter() as counter:
+            orders = loader()
+            # Обращаемся к связям так же, как шаблоны
+            for order in orders:
+                if order.menu:
+                    order.menu.dish_name
+                if order.student and order.student.user:
+                    order.student.user.username
+        status = 'OK' if counter.count <= DASHBOARD_QUERY_BUDGET else 'FAIL'
+        failed = failed or status == 'FAIL'
+        click.echo(f"{status} {name}: заказов {len(orders)}, запросов {counter.count} "
+                   f"(лимит {DASHBOARD_QUERY_BUDGET})")
+
+    if failed:
+        raise SystemExit(1)
+
+
+# ================== МЕТРИКИ И ПРОФИЛИРОВАНИЕ ==================
+
+# Границы корзин гистограммы длительности запросов (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """Счетчики запросов процесса для /metrics (у каждого воркера gunicorn свои)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}  # endpoint -> [счетчики по корзинам..., +Inf]
+        self.latency_sum = Counter()
+        self.requests = Counter()  # (endpoint, status) -> количество
+        self.db_statements = Counter()
+        self.db_seconds = Counter()
+        self.slow_queries = 0
+        self.jobs = Counter()  # (задача, итог) -> количество
+        self.job_wait_seconds = Counter()
+        self.job_run_seconds = Counter()
+
+    def observe_request(self, endpoint, status, seconds, statements, db_seconds):
+        with self._lock:
+            buckets = self.latency.setdefault(endpoint, [0] * (len(LATENCY_BUCKETS) + 1))
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+                    break
+            else:
+                buckets[-1] += 1
+            self.latency_sum[endpoint] += seconds
+            self.requests[(endpoint, status)] += 1
+            self.db_statements[endpoint] += statements
+            self.db_seconds[endpoint] += db_seconds
+
+    def observe_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def observe_job(self, name, outcome, wait, seconds):
+        with self._lock:
+            self.jobs[(name, outcome)] += 1
+            self.job_wait_seconds[name] += wait
+            self.job_run_seconds[name] += seconds
+
+    def render(self, queue_depth=None):
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            '# HELP canteen_http_request_duration_seconds Длительность обработки запроса',
+            '# TYPE canteen_http_request_duration_seconds histogram',
+        ]
+        with self._lock:
+            for endpoint, buckets in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append(f'canteen_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'canteen_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.latency_sum[endpoint]:.6f}')
+                lines.append(f'canteen_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+            lines += ['# HELP canteen_http_requests_total Количество запросов по статусу ответа',
+                      '# TYPE canteen_http_requests_total counter']
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'canteen_http_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines += ['# HELP canteen_db_statements_total SQL-запросов, выполненных при обработке',
+                      '# TYPE canteen_db_statements_total counter']
+            for endpoint, count in sorted(self.db_statements.items()):
+                lines.append(f'canteen_db_statements_total{{endpoint="{endpoint}"}} {count}')
+            lines += ['# HELP canteen_db_seconds_total Время выполнения SQL-запросов',
+                      '# TYPE canteen_db_seconds_total counter']
+            for endpoint, seconds in sorted(self.db_seconds.items()):
+                lines.append(f'canteen_db_seconds_total{{endpoint="{endpoint}"}} {seconds:.6f}')
+            lines += ['# HELP canteen_slow_queries_total SQL-запросов дольше SLOW_QUERY_MS',
+                      '# TYPE canteen_slow_queries_total counter',
+                      f'canteen_slow_queries_total {self.slow_queries}']
+            lines += ['# HELP canteen_jobs_total Выполненных фоновых задач по итогу (done, queued - повтор, failed)',
+                      '# TYPE canteen_jobs_total counter']
+            for (name, outcome), count in sorted(self.jobs.items()):
+                lines.append(f'canteen_jobs_total{{task="{name}",outcome="{outcome}"}} {count}')
+            lines += ['# HELP canteen_job_wait_seconds_total Время ожидания задач в очереди',
+                      '# TYPE canteen_job_wait_seconds_total counter']
+            for name, seconds in sorted(self.job_wait_seconds.items()):
+                lines.append(f'canteen_job_wait_seconds_total{{task="{name}"}} {seconds:.6f}')
+            lines += ['# HELP canteen_job_run_seconds_total Время выполнения задач',
+                      '# TYPE canteen_job_run_seconds_total counter']
+            for name, seconds in sorted(self.job_run_seconds.items()):
+                lines.append(f'canteen_job_run_seconds_total{{task="{name}"}} {seconds:.6f}')
+        if queue_depth is not None:
+            lines += ['# HELP canteen_job_queue_depth Задач в очереди по статусу',
+                      '# TYPE canteen_job_queue_depth gauge']
+            for status in ('queued', 'running', 'done', 'failed'):
+                lines.append(f'canteen_job_queue_depth{{status="{status}"}} {queue_depth.get(status, 0)}')
+        return '\n'.join(lines) + '\n'
+
+
+def install_query_hooks(app, metrics):
+    """Считать SQL-запросы и их время; медленные запросы писать в лог"""
+    slow_seconds = app.config['SLOW_QUERY_MS'] / 1000
+
+    with app.app_context():
+        engine = db.engine
+
+    # Время начала хранится в контексте выполнения: если запрос упал и after_cursor_execute
+    # не вызван, значение уходит вместе с контекстом и не сдвигает замеры следующих запросов
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_query_start', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        if has_request_context():
+            g.sql_count = g.get('sql_count', 0) + 1
+            g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+        if slow_seconds and elapsed >= slow_seconds:
+            metrics.observe_slow_query()
+            endpoint = request.endpoint if has_request_context() else None
+            logger.warning(f"Медленный запрос {elapsed * 1000:.1f} мс ({endpoint}): {' '.join(statement.split())[:500]}")
+
+
+def token_matches(expected, given):
+    return bool(expected) and hmac.compare_digest(expected.encode(), (given or '').encode())
+
+
+def profiling_allowed():
+    """Профилировать запрос: профилировщик и запись отчета на диск дороги, поэтому только для
+    администратора или по PROFILE_TOKEN"""
+    config = current_app.config
+    header = config['PROFILE_HEADER']
+    if not config['PROFILING_ENABLED'] or header not in request.headers:
+        return False
+    if token_matches(config['PROFILE_TOKEN'], request.headers.get(f'{header}-Token')):
+        return True
+    identity = get_identity()
+    return identity is not None and identity.role == 'admin'
+
+
+def metrics_allowed():
+    """Доступ к /metrics: по METRICS_TOKEN, а без него - только с этой же машины"""
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and token_matches(token, given)
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def start_profiler():
+    """Запустить профилировщик для текущего запроса (pyinstrument, если установлен)"""
+    if request.headers.get(current_app.config['PROFILE_HEADER'], '').lower() == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return 'pyinstrument', profiler
+        except ImportError:
+            logger.warning("pyinstrument не установлен, используется cProfile")
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return 'cprofile', profiler
+
+
+def stop_profiler(kind, profiler):
+    if kind == 'pyinstrument':
+        if profiler.is_running:
+            profiler.stop()
+    else:
+        profiler.disable()
+
+
+def save_profile(kind, profiler):
+    """Остановить профилировщик и сохранить отчет в PROFILE_DIR; вернуть имя файла"""
+    directory = current_app.config['PROFILE_DIR'] or os.path.join(current_app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    name = f"{request.endpoint or 'unknown'}-{datetime.utcnow():%Y%m%d-%H%M%S-%f}"
+    stop_profiler(kind, profiler)
+    if kind == 'pyinstrument':
+        name += '.html'
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+    else:
+        name += '.prof'
+        profiler.dump_stats(os.path.join(directory, name))
+    return name
+
+
+def init_instrumentation(app):
+    """Подключить таймеры запросов, счетчики SQL, /metrics и профилирование по заголовку"""
+    if not (app.config['METRICS_ENABLED'] or app.config['SLOW_QUERY_MS'] or app.config['PROFILING_ENABLED']):
+        return  # ничего не подключено - никаких накладных расходов
+
+    metrics = app.extensions['metrics'] = Metrics()
+    install_query_hooks(app, metrics)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        if profiling_allowed():
+            g.profiler = start_profiler()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        statements = g.get('sql_count', 0)
+        db_seconds = g.get('sql_seconds', 0.0)
+        metrics.observe_request(request.endpoint or 'unknown', response.status_code, elapsed, statements, db_seconds)
+        response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                             f'db;dur={db_seconds * 1000:.1f};desc="{statements} SQL"')
+        profiler = g.pop('profiler', None)
+        if profiler:
+            response.headers['X-Profile-File'] = save_profile(*profiler)
+        return response
+
+    @app.teardown_request
+    def discard_profiler(error):
+        # after_request не вызывается, если обработчик упал: профилировщик потока выключается здесь
+        profiler = g.pop('profiler', None)
+        if profiler:
+            stop_profiler(*profiler)
+
+    if app.config['METRICS_ENABLED']:
+        def metrics_endpoint():
+            """Метрики приложения в формате Prometheus"""
+            if not metrics_allowed():
+                return 'Forbidden', 403, {'Content-Type': 'text/plain; charset=utf-8'}
+            return metrics.render(queue_depth=job_queue_depth()), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+        app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+
+
+# ================== ФАБРИКА ПРИЛОЖЕНИЯ ==================
+
+def build_engine_options(config):
+    """Параметры движка SQLAlchemy: пул соединений и проверка соединения перед выдачей"""
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        # Для базы в памяти Flask-SQLAlchemy сам выбирает StaticPool
+        return options
+    options.update(
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+    )
+    if uri.startswith('sqlite'):
+        # Соединения из пула переходят между потоками; ожидание блокировки задаем PRAGMA busy_timeout
+        options['connect_args'] = {'check_same_thread': False}
+    else:
+        options['pool_recycle'] = config['DB_POOL_RECYCLE']
+    return options
+
+
+def install_sqlite_pragmas(engine, config):
+    """Выполнять PRAGMA при каждом новом соединении с SQLite"""
+    pragmas = [
+        f"journal_mode={config['SQLITE_JOURNAL_MODE']}",
+        f"synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"cache_size={int(config['SQLITE_CACHE_SIZE'])}",
+        f"mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f'PRAGMA {pragma}')
+        cursor.close()
+
+
+def require_secret_keys(app):
+    """Вне отладки и тестов ключи по умолчанию запрещены: с ними можно подделать сессию или токен"""
+    if app.debug or app.testing:
+        return
+    if app.config['JWT_SECRET_KEY'] == DEFAULT_SECRET_KEY:
+        raise RuntimeError("Задайте JWT_SECRET_KEY или SECRET_KEY: ключ по умолчанию допустим только "
+                           "в режиме отладки (FLASK_DEBUG=1)")
+    if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY:
+        raise RuntimeError("Задайте SECRET_KEY: им подписываются сессии, ключ по умолчанию допустим только "
+                           "в режиме отладки (FLASK_DEBUG=1)")
+
+
+def create_app(config=None):
+    """Фабрика приложения: настройки из окружения, база данных, маршруты и команды"""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    require_secret_keys(app)
+    if 'SQLALCHEMY_ENGINE_OPTIONS' not in app.config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = build_engine_options(app.config)
+
+    logging.basicConfig(level=app.config['LOG_LEVEL'])
+    if app.config['TRUSTED_PROXIES']:
+        # request.remote_addr - адрес клиента, а не прокси: на нем держится ограничение попыток входа
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            install_sqlite_pragmas(db.engine, app.config)
+
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.context_processor(utility_processor)
+    app.register_error_handler(IdentityGone, identity_gone)
+    init_instrumentation(app)
+    init_jobs(app)
+    init_jwt(app)
+    # Кириллица в JSON без \uXXXX-экранирования: ответы API втрое короче
+    app.json.ensure_ascii = False
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+
+    return app
+
+
 # ================== ЗАПУСК ==================
 
+# Продакшен (несколько процессов): gunicorn -w 4 'single_file_app:create_app()'
+# База создается отдельно: flask --app single_file_app init-db
+
 if __name__ == '__main__':
-    # Создаем новую базу данных
-    create_database()
+    # Локальный запуск одним процессом: фоновые задачи выполняются здесь же
+    app = create_app({'JOBS_ENABLED': env_bool('JOBS_ENABLED', True), 'DEBUG': env_bool('FLASK_DEBUG', True)})
+
+    # Создаем базу данных для локального запуска
+    create_database(app)
 
     # Запускаем приложение
     print("\n🚀 Запуск приложения...")
     print("🌐 Откройте в браузере: http://127.0.0.1:5000")
-    app.run(debug=True, port=5000, host='0.0.0.0')
+    app.run(debug=app.debug, port=5000, host='0.0.0.0')
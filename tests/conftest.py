@@ -0,0 +1,63 @@
+import os
+import sys
+
+import pytest
+from jinja2 import DictLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import single_file_app as canteen  # noqa: E402
+
+# В репозитории нет HTML-шаблонов: тестовые обращаются к тем же данным, что и настоящие
+TEMPLATES = {
+    'login.html': '{{ error }}',
+    'cook_dashboard.html': (
+        '{% for order in today_orders %}{{ order.menu_item.dish_name }} {{ order.student_name }} '
+        '{{ order.grade }}{% endfor %}{% for request in purchase_requests %}{{ request.id }}{% endfor %}'
+    ),
+    'purchase_statistics.html': (
+        '{% for product in products %}{{ product.name }}{% endfor %}'
+        '{% for product in low_stock_products %}{{ product.name }}{% endfor %}'
+    ),
+    'student_dashboard.html': (
+        '{{ student.balance }}{% for order in today_orders %}{{ order.menu.dish_name }}{% endfor %}'
+        '{% for item in today_menu %}{{ item.dish_name }}{% endfor %}'
+    ),
+}
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Фабрика приложений с тестовой базой; настройки можно переопределить"""
+    apps = []
+
+    def make(**config):
+        app = canteen.create_app(dict({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / f'canteen{len(apps)}.db'}",
+            'JOBS_ENABLED': False,
+            'PASSWORD_HASH_WORKERS': 0,
+            'LOGIN_RATE_BURST': 0,
+            'TESTING': True,
+        }, **config))
+        app.jinja_loader = DictLoader(TEMPLATES)
+        canteen.create_database(app)
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            canteen.db.session.remove()
+            canteen.db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+def login(app, username, password):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302
+    return client
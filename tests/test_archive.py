@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+
+from conftest import canteen
+
+
+def test_archiving_leaves_ledger_charges_unchanged(app):
+    with app.app_context():
+        student = canteen.Student.query.join(canteen.User).filter(canteen.User.username == 'student').one()
+        menu = canteen.Menu.query.first()
+        balance = canteen.get_balance(student.id)
+        [order_id] = canteen.bulk_insert(canteen.Order, [
+            {'student_id': student.id, 'menu_id': menu.id, 'status': 'issued',
+             'order_date': datetime.now() - timedelta(days=400)}
+        ], returning=True)
+        canteen.credit_balance(student.id, 500)
+        assert canteen.charge_orders(student.id, [(order_id, 500)])
+        canteen.db.session.commit()
+
+        ledger = canteen.db.session.execute(canteen.select(canteen.BalanceEntry.__table__)).all()
+
+        moved = canteen.archive_closed_orders(horizon_days=180, batch_size=100)
+        assert moved['orders'] >= 1
+
+        assert canteen.db.session.execute(canteen.select(canteen.BalanceEntry.__table__)).all() == ledger
+        charge = canteen.BalanceEntry.query.filter_by(order_id=order_id).one()
+        assert charge.amount == -500 and canteen.db.session.get(canteen.Order, order_id) is None
+        archived = canteen.db.session.execute(canteen.history_select(
+            'orders', ['id', 'student_id', 'order_date'], 'order_date',
+            where=lambda table: [table.c.id == charge.order_id])).one()
+        assert archived.student_id == student.id
+        assert canteen.get_balance(student.id) == balance
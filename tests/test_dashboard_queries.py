@@ -0,0 +1,110 @@
+import itertools
+from datetime import datetime
+
+from flask import template_rendered
+
+from conftest import canteen, login
+
+usernames = (f'load_{number}' for number in itertools.count())
+
+
+def add_orders(app, count, demo_orders=1):
+    """count заказов на сегодня от новых учеников и demo_orders заказов демо-ученика"""
+    with app.app_context():
+        db = canteen.db
+        menu = canteen.Menu.query.filter_by(date=datetime.now().date()).first()
+        user_ids = canteen.bulk_insert(canteen.User, [
+            {'username': next(usernames), 'password': '-', 'role': 'student'} for _ in range(count)
+        ], returning=True)
+        student_ids = canteen.bulk_insert(canteen.Student, [
+            {'user_id': user_id, 'grade': '7Б'} for user_id in user_ids
+        ], returning=True)
+        demo_student = canteen.Student.query.join(canteen.User).filter(canteen.User.username == 'student').one()
+        canteen.bulk_insert(canteen.Order, [
+            {'student_id': student_id, 'menu_id': menu.id, 'status': 'pending', 'order_date': datetime.now()}
+            for student_id in student_ids + [demo_student.id] * demo_orders
+        ])
+        db.session.commit()
+
+
+def statements_for(app, client, path):
+    """Число SQL-запросов за один запрос к странице (после прогрева кэшей)"""
+    assert client.get(path).status_code == 200
+    with app.app_context():
+        with canteen.QueryCounter() as counter:
+            assert client.get(path).status_code == 200
+    return counter.count
+
+
+def test_cook_dashboard_query_count_does_not_depend_on_orders(app):
+    client = login(app, 'cook', 'cook123')
+    add_orders(app, 1)
+    few = statements_for(app, client, '/cook/dashboard')
+    add_orders(app, 50)
+    many = statements_for(app, client, '/cook/dashboard')
+    assert few == many
+
+
+def test_student_dashboard_query_count_does_not_depend_on_orders(app):
+    client = login(app, 'student', 'student123')
+    add_orders(app, 1)
+    few = statements_for(app, client, '/student/dashboard')
+    add_orders(app, 0, demo_orders=20)
+    many = statements_for(app, client, '/student/dashboard')
+    assert few == many
+
+
+def test_cook_dashboard_lists_one_page_of_pending_requests(app):
+    client = login(app, 'cook', 'cook123')
+    with app.app_context():
+        product = canteen.Product.query.first()
+        cook = canteen.User.query.filter_by(username='cook').one()
+        canteen.bulk_insert(canteen.PurchaseRequest, [
+            {'product_id': product.id, 'quantity': 1, 'status': 'pending', 'requested_by': cook.id,
+             'request_date': datetime.utcnow()}
+            for _ in range(canteen.PENDING_REQUESTS_PAGE_SIZE * 2)
+        ])
+        canteen.db.session.commit()
+        pending = canteen.PurchaseRequest.query.filter_by(status='pending').count()
+    assert pending > canteen.PENDING_REQUESTS_PAGE_SIZE
+
+    captured = []
+    with template_rendered.connected_to(lambda sender, template, context, **extra: captured.append(context), app):
+        assert client.get('/cook/dashboard').status_code == 200
+    context = captured[-1]
+    assert len(context['purchase_requests']) == canteen.PENDING_REQUESTS_PAGE_SIZE
+    assert context['pending_requests_count'] == pending
+    assert context['next_cursor']
+
+
+def test_student_balance_is_read_once_per_transaction(app):
+    with app.app_context():
+        student = canteen.Student.query.join(canteen.User).filter(canteen.User.username == 'student').one()
+        with canteen.QueryCounter() as counter:
+            first = student.balance
+            assert student.balance == first
+        assert counter.count == 1
+
+        canteen.credit_balance(student.id, 1000)
+        canteen.db.session.commit()
+        assert student.balance == first + 10
+
+
+def test_purchase_statistics_pages_products(app):
+    client = login(app, 'cook', 'cook123')
+    with app.app_context():
+        canteen.bulk_insert(canteen.Product, [
+            {'name': f'Продукт {number:04d}', 'unit': 'кг', 'current_quantity': 0, 'min_quantity': 1,
+             'allergens': 0}
+            for number in range(canteen.PRODUCTS_PAGE_SIZE * 2)
+        ])
+        canteen.db.session.commit()
+
+    captured = []
+    with template_rendered.connected_to(lambda sender, template, context, **extra: captured.append(context), app):
+        assert client.get('/purchase-statistics').status_code == 200
+    context = captured[-1]
+    assert len(context['products']) == canteen.PRODUCTS_PAGE_SIZE
+    assert len(context['low_stock_products']) == canteen.PRODUCTS_PAGE_SIZE
+    assert context['next_products_cursor']
+    assert context['total_products'] > canteen.PRODUCTS_PAGE_SIZE * 2
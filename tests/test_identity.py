@@ -0,0 +1,29 @@
+import pytest
+from flask import render_template_string, session
+
+from conftest import canteen
+
+
+def set_session(**values):
+    session.update(dict({'username': 'ghost', 'role': 'student', 'student_id': None}, **values))
+
+
+def test_templates_read_identity_without_queries(app):
+    with app.test_request_context('/'):
+        set_session(user_id=1)
+        with canteen.QueryCounter() as counter:
+            assert render_template_string('{{ get_identity().role }} {{ get_current_user().username }}') \
+                == 'student ghost'
+        assert counter.count == 0
+
+
+def test_deleted_user_is_logged_out(app):
+    with app.test_request_context('/'):
+        set_session(user_id=999999)
+        identity = canteen.get_identity()
+        with pytest.raises(canteen.IdentityGone):
+            identity.email
+        response = app.handle_user_exception(canteen.IdentityGone())
+        assert response.status_code == 302
+        assert response.location.endswith('/login')
+        assert 'user_id' not in session
@@ -0,0 +1,57 @@
+import io
+from datetime import date
+
+from conftest import canteen
+
+DAY = date(2030, 9, 2)
+
+
+def import_menu(app, text):
+    with app.app_context():
+        summary = canteen.import_records('menus', io.StringIO(text), 'csv')
+        assert summary['failed'] == 0, summary['errors']
+        return canteen.Menu.query.filter_by(date=DAY, dish_name='Каша').one().available_count
+
+
+def test_reimport_without_count_keeps_stock(app):
+    assert import_menu(app, 'date,meal_type,dish_name,price,available_count\n'
+                            f'{DAY},breakfast,Каша,50,47\n') == 47
+    assert import_menu(app, f'date,meal_type,dish_name,price\n{DAY},breakfast,Каша,55\n') == 47
+    assert import_menu(app, 'date,meal_type,dish_name,price,available_count\n'
+                            f'{DAY},breakfast,Каша,55,30\n') == 30
+
+
+def test_forecast_fills_only_new_dishes(app, monkeypatch):
+    import_menu(app, f'date,meal_type,dish_name,price,available_count\n{DAY},breakfast,Каша,50,47\n')
+    proposed = []
+
+    class Model:
+        def propose(self, meal_type, dish_name, day, config):
+            proposed.append(dish_name)
+            return 12
+
+    monkeypatch.setattr(canteen, 'get_demand_model', Model)
+    assert import_menu(app, f'date,meal_type,dish_name,price\n{DAY},breakfast,Каша,55\n'
+                            f'{DAY},breakfast,Сырники,80\n') == 47
+    assert proposed == ['Сырники']
+    with app.app_context():
+        assert canteen.Menu.query.filter_by(date=DAY, dish_name='Сырники').one().available_count == 12
+
+
+def test_recipe_import_makes_dish_allergens_known(app):
+    import_menu(app, f'date,meal_type,dish_name,price,available_count\n{DAY},breakfast,Каша,50,47\n')
+    with app.app_context():
+        assert 'Каша' not in canteen.dish_allergen_masks(['Каша'])
+        milk = canteen.Product.query.filter_by(name='Молоко').one()
+        summary = canteen.import_records('dish_ingredients', io.StringIO(
+            'dish_name,product,product_id,quantity\n'
+            'Каша,Молоко,,0.2\n'
+            f'Каша,,{milk.id},0.25\n'
+            'Каша,Несуществующий продукт,,1\n'), 'csv')
+        assert (summary['imported'], summary['failed']) == (2, 1)
+        assert summary['errors'][0]['line'] == 4
+        recipe = canteen.DishIngredient.query.filter_by(dish_name='Каша').one()
+        assert (recipe.product_id, recipe.quantity) == (milk.id, 0.25)
+        assert canteen.dish_allergen_masks(['Каша']) == {'Каша': milk.allergens}
+        item, = [item for item in canteen.get_menu_for_date(DAY) if item['dish_name'] == 'Каша']
+        assert item['allergens_known']
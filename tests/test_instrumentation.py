@@ -0,0 +1,50 @@
+import sys
+
+import pytest
+
+from conftest import login
+
+
+@pytest.fixture
+def profiled_app(make_app, tmp_path):
+    app = make_app(PROFILING_ENABLED=True, PROFILE_DIR=str(tmp_path / 'profiles'), PROFILE_TOKEN='secret')
+
+    def broken():
+        raise RuntimeError('boom')
+
+    app.add_url_rule('/broken', 'broken', broken)
+    return app
+
+
+def test_profiling_needs_admin_or_token(profiled_app):
+    student = login(profiled_app, 'student', 'student123')
+    assert 'X-Profile-File' not in student.get('/login', headers={'X-Profile': '1'}).headers
+
+    admin = login(profiled_app, 'admin', 'admin123')
+    assert admin.get('/login', headers={'X-Profile': '1'}).headers['X-Profile-File'].endswith('.prof')
+
+    anonymous = profiled_app.test_client()
+    assert 'X-Profile-File' in anonymous.get('/login', headers={'X-Profile': '1', 'X-Profile-Token': 'secret'}).headers
+    assert 'X-Profile-File' not in anonymous.get('/login', headers={'X-Profile': '1', 'X-Profile-Token': 'nope'}).headers
+
+
+def test_profiler_is_stopped_when_the_view_fails(profiled_app):
+    # Исключение проходит мимо after_request (TESTING пробрасывает его наружу)
+    client = profiled_app.test_client()
+    with pytest.raises(RuntimeError):
+        client.get('/broken', headers={'X-Profile': '1', 'X-Profile-Token': 'secret'})
+    assert sys.getprofile() is None
+
+
+def test_metrics_are_local_only_without_token(make_app):
+    app = make_app(METRICS_ENABLED=True)
+    client = app.test_client()
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code == 403
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+
+
+def test_metrics_token(make_app):
+    app = make_app(METRICS_ENABLED=True, METRICS_TOKEN='scrape')
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape'}).status_code == 200
@@ -0,0 +1,48 @@
+from conftest import canteen
+
+
+def make_limited_app(make_app, **config):
+    return make_app(PASSWORD_HASH_METHOD='pbkdf2:sha256:1000', LOGIN_RATE_BURST=3, LOGIN_IP_RATE_BURST=5,
+                    **config)
+
+
+def add_students(app, count):
+    with app.app_context():
+        password = canteen.hash_password('secret')
+        canteen.bulk_insert(canteen.User, [
+            {'username': f'pupil_{number}', 'password': password, 'role': 'student'} for number in range(count)
+        ])
+        canteen.db.session.commit()
+
+
+def post_login(client, username, password, **headers):
+    return client.post('/login', data={'username': username, 'password': password}, headers=headers)
+
+
+def test_successful_logins_do_not_use_up_the_ip_budget(make_app):
+    app = make_limited_app(make_app)
+    add_students(app, 12)
+    client = app.test_client()
+    for number in range(12):
+        assert post_login(client, f'pupil_{number}', 'secret').status_code == 302
+
+
+def test_failed_logins_are_limited_per_username(make_app):
+    app = make_limited_app(make_app)
+    add_students(app, 2)
+    client = app.test_client()
+    for _ in range(3):
+        assert post_login(client, 'pupil_0', 'wrong').status_code == 200
+    response = post_login(client, 'pupil_0', 'secret')
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
+    assert post_login(client, 'pupil_1', 'secret').status_code == 302
+
+
+def test_ip_limit_uses_forwarded_address_behind_trusted_proxy(make_app):
+    app = make_limited_app(make_app, TRUSTED_PROXIES=1)
+    client = app.test_client()
+    for number in range(5):
+        assert post_login(client, f'nobody_{number}', 'wrong', **{'X-Forwarded-For': '10.0.0.1'}).status_code == 200
+    assert post_login(client, 'nobody_9', 'wrong', **{'X-Forwarded-For': '10.0.0.1'}).status_code == 429
+    assert post_login(client, 'nobody_9', 'wrong', **{'X-Forwarded-For': '10.0.0.2'}).status_code == 200
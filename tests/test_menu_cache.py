@@ -0,0 +1,34 @@
+from datetime import datetime
+
+from conftest import canteen
+
+
+def cached_meal_types(day):
+    cache = canteen.get_menu_cache()
+    return {meal_type for meal_type in canteen.MEAL_TYPES
+            if cache.get(canteen.menu_cache_key(day, meal_type)) is not None}
+
+
+def test_menu_change_invalidates_cache_after_commit(app):
+    day = datetime.now().date()
+    with app.app_context():
+        canteen.get_menu_for_date(day)
+        menu = canteen.Menu.query.filter_by(date=day).first()
+        menu.description = 'Новое описание'
+        canteen.db.session.flush()
+        # До COMMIT кэш не трогается: параллельный запрос не должен перечитать старые данные в кэш
+        assert menu.meal_type in cached_meal_types(day)
+        canteen.db.session.commit()
+        assert menu.meal_type not in cached_meal_types(day)
+
+
+def test_rolled_back_menu_change_keeps_cache(app):
+    day = datetime.now().date()
+    with app.app_context():
+        canteen.get_menu_for_date(day)
+        menu = canteen.Menu.query.filter_by(date=day).first()
+        menu.description = 'Отмененное описание'
+        canteen.db.session.flush()
+        canteen.db.session.rollback()
+        canteen.db.session.commit()
+        assert menu.meal_type in cached_meal_types(day)
@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from conftest import canteen
+
+
+def test_natural_key_index_waits_for_its_duplicate_check(app):
+    """Первый шаг миграции не создает уникальный индекс меню раньше шага, который проверяет повторы"""
+    with app.app_context():
+        with canteen.db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX uq_menus_date_meal_type_dish_name')
+            connection.exec_driver_sql(
+                'INSERT INTO menus (date, meal_type, dish_name, price, available_count) '
+                'SELECT date, meal_type, dish_name, price, available_count FROM menus LIMIT 1')
+            connection.exec_driver_sql('PRAGMA user_version = 0')
+
+        with pytest.raises(RuntimeError, match='menus'):
+            canteen.migrate_database()
+
+
+def test_menu_meal_type_is_restricted_on_every_write_path(app):
+    with app.app_context():
+        menu = canteen.Menu.query.first()
+        with pytest.raises(ValueError):
+            menu.meal_type = 'dinner'
+        with pytest.raises(IntegrityError):
+            canteen.db.session.execute(canteen.update(canteen.Menu).where(canteen.Menu.id == menu.id)
+                                       .values(meal_type='dinner'))
+        canteen.db.session.rollback()
+
+
+def test_money_columns_are_converted_to_kopecks(app):
+    """Цены, записанные старой версией в рублях, после миграции читаются теми же суммами"""
+    with app.app_context():
+        menu_id = canteen.Menu.query.first().id
+        with canteen.db.engine.begin() as connection:
+            connection.exec_driver_sql(f'UPDATE menus SET price = 150.1 WHERE id = {menu_id}')
+            connection.exec_driver_sql(f'PRAGMA user_version = {canteen.MIGRATIONS.index(canteen.convert_money_to_kopecks)}')
+        canteen.migrate_database()
+        with canteen.db.engine.connect() as connection:
+            assert connection.exec_driver_sql(f'SELECT price FROM menus WHERE id = {menu_id}').scalar() == 15010
+        assert canteen.db.session.get(canteen.Menu, menu_id).price == canteen.Decimal('150.10')
+
+
+def test_ledger_order_references_are_restored_without_foreign_key(app):
+    """Ссылки, перенесенные прежней версией в archived_order_id, возвращаются в order_id"""
+    with app.app_context():
+        student = canteen.Student.query.first()
+        charge = canteen.BalanceEntry(student_id=student.id, amount=-100, kind='charge', order_id=10 ** 6)
+        canteen.db.session.add(charge)
+        canteen.db.session.commit()
+        charge_id, order_id = charge.id, charge.order_id
+        with canteen.db.engine.begin() as connection:
+            connection.exec_driver_sql('ALTER TABLE balance_ledger ADD COLUMN archived_order_id INTEGER')
+            connection.exec_driver_sql(
+                f'UPDATE balance_ledger SET order_id = NULL, archived_order_id = {order_id} WHERE id = {charge_id}')
+            connection.exec_driver_sql(
+                f'PRAGMA user_version = {canteen.MIGRATIONS.index(canteen.restore_ledger_order_references)}')
+        canteen.migrate_database()
+        with canteen.db.engine.connect() as connection:
+            assert connection.exec_driver_sql(
+                f'SELECT order_id FROM balance_ledger WHERE id = {charge_id}').scalar() == order_id
+            assert 'archived_order_id' not in {
+                column['name'] for column in canteen.db.inspect(connection).get_columns('balance_ledger')}
+            assert 'orders' not in {
+                key['referred_table'] for key in canteen.db.inspect(connection).get_foreign_keys('balance_ledger')}
+            assert {index['name'] for index in canteen.db.inspect(connection).get_indexes('balance_ledger')} == {
+                index.name for index in canteen.BalanceEntry.__table__.indexes}
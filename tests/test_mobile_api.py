@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from conftest import canteen
+
+
+def token_client(app):
+    client = app.test_client()
+    response = client.post('/api/v1/auth/token', json={'username': 'student', 'password': 'student123'})
+    assert response.status_code == 200
+    client.environ_base['HTTP_AUTHORIZATION'] = f"Bearer {response.get_json()['access_token']}"
+    return client
+
+
+def test_order_history_includes_archived_orders(app):
+    with app.app_context():
+        student = canteen.Student.query.join(canteen.User).filter(canteen.User.username == 'student').one()
+        menu = canteen.Menu.query.first()
+        archived_ids = canteen.bulk_insert(canteen.Order, [
+            {'student_id': student.id, 'menu_id': menu.id, 'status': 'issued',
+             'order_date': datetime.now() - timedelta(days=400 + days)}
+            for days in range(3)
+        ], returning=True)
+        canteen.db.session.commit()
+        assert canteen.archive_closed_orders(horizon_days=180, batch_size=100)['orders'] >= 3
+        hot_ids = [order_id for (order_id,) in canteen.db.session.execute(
+            canteen.select(canteen.Order.id).where(canteen.Order.student_id == student.id))]
+
+    client = token_client(app)
+    seen, cursor = [], None
+    while True:
+        response = client.get('/api/v1/orders', query_string={'limit': 2, 'cursor': cursor or ''})
+        assert response.status_code == 200
+        page = response.get_json()
+        seen.extend(item['id'] for item in page['items'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert sorted(seen) == sorted(hot_ids + archived_ids)
+    assert seen[-3:] == archived_ids
+
+
+def test_unexpected_order_error_returns_json(app, monkeypatch):
+    client = token_client(app)
+
+    def broken(student_id, menu_id):
+        raise RuntimeError('database is gone')
+
+    monkeypatch.setattr(canteen, 'place_order', broken)
+    response = client.post('/api/v1/orders', json={'menu_id': 1})
+    assert response.status_code == 500
+    assert 'error' in response.get_json()
+
+
+def test_default_jwt_secret_is_refused_outside_debug(tmp_path):
+    config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'canteen.db'}",
+              'JWT_SECRET_KEY': canteen.DEFAULT_SECRET_KEY, 'DEBUG': False, 'TESTING': False}
+    with pytest.raises(RuntimeError, match='JWT_SECRET_KEY'):
+        canteen.create_app(config)
+    assert canteen.create_app(dict(config, DEBUG=True)).debug
+
+
+def test_default_session_secret_is_refused_outside_debug(tmp_path):
+    config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'canteen.db'}",
+              'SECRET_KEY': canteen.DEFAULT_SECRET_KEY, 'JWT_SECRET_KEY': 'jwt-secret',
+              'DEBUG': False, 'TESTING': False}
+    with pytest.raises(RuntimeError, match='Задайте SECRET_KEY'):
+        canteen.create_app(config)
+    assert canteen.create_app(dict(config, SECRET_KEY='session-secret')).secret_key == 'session-secret'
+
+
+def test_order_charge_is_recorded_as_exact_payment(app):
+    with app.app_context():
+        student = canteen.Student.query.join(canteen.User).filter(canteen.User.username == 'student').one()
+        menu = canteen.Menu(date=datetime.now().date(), meal_type='lunch', dish_name='Котлета с пюре',
+                            description='', price='150.10', available_count=5)
+        potato = canteen.Product.query.filter_by(name='Картофель').one()
+        canteen.db.session.add_all([menu, canteen.DishIngredient(dish_name=menu.dish_name, product_id=potato.id,
+                                                                 quantity=0.2)])
+        canteen.credit_balance(student.id, canteen.to_kopecks('1000'))
+        canteen.db.session.commit()
+        menu_id = menu.id
+        revenue = canteen.db.session.get(canteen.DashboardStats, 1).revenue_total
+
+    client = token_client(app)
+    response = client.post('/api/v1/orders', json={'menu_ids': [menu_id, menu_id]})
+    assert response.status_code == 201
+    assert response.get_json()['total'] == '300.20'
+    assert {item['price'] for item in response.get_json()['items']} == {'150.10'}
+
+    with app.app_context():
+        payments = canteen.Payment.query.filter(canteen.Payment.method == 'balance').all()
+        assert [payment.amount for payment in payments] == [Decimal('150.10')] * 2
+        canteen.db.session.expire_all()
+        assert canteen.db.session.get(canteen.DashboardStats, 1).revenue_total == revenue + Decimal('300.20')
+
+
+def test_restricted_and_unknown_dishes_cannot_be_ordered(app):
+    """Ученик-вегетарианец не может заказать мясное блюдо и блюдо без состава ни по одному пути"""
+    with app.app_context():
+        student = canteen.Student.query.join(canteen.User).filter(canteen.User.username == 'student').one()
+        assert student.restriction_mask
+        meat_id = canteen.Menu.query.filter_by(dish_name='Котлета куриная с картофельным пюре').first().id
+        unknown = canteen.Menu(date=datetime.now().date(), meal_type='lunch', dish_name='Пирожок',
+                               description='', price='40', available_count=5)
+        canteen.db.session.add(unknown)
+        canteen.db.session.commit()
+        unknown_id = unknown.id
+
+    client = token_client(app)
+    for menu_id in (meat_id, unknown_id):
+        assert client.post('/api/v1/orders', json={'menu_id': menu_id}).status_code == 409
+    response = client.post('/api/v1/orders', json={'menu_ids': [meat_id, unknown_id]})
+    assert response.status_code == 409
+    assert [item['status'] for item in response.get_json()['items']] == ['restricted', 'restricted']
+    menu = client.get('/api/v1/menu').get_json()['items']
+    assert not {item['id'] for item in menu} & {meat_id, unknown_id}
+    with app.app_context():
+        assert not canteen.Order.query.filter(canteen.Order.menu_id.in_([meat_id, unknown_id])).count()
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from conftest import canteen
+
+
+def test_class_transition_reports_skipped_orders(app):
+    with app.app_context():
+        menu = canteen.Menu.query.filter_by(date=datetime.now().date()).first()
+        user_ids = canteen.bulk_insert(canteen.User, [
+            {'username': f'class_{number}', 'password': '-', 'role': 'student'} for number in range(2)
+        ], returning=True)
+        student_ids = canteen.bulk_insert(canteen.Student, [
+            {'user_id': user_id, 'grade': '9В'} for user_id in user_ids
+        ], returning=True)
+        paid_id, pending_id = canteen.bulk_insert(canteen.Order, [
+            {'student_id': student_id, 'menu_id': menu.id, 'status': status, 'order_date': datetime.now()}
+            for student_id, status in zip(student_ids, ('paid', 'pending'))
+        ], returning=True)
+        canteen.db.session.commit()
+
+        updated, skipped = canteen.transition_orders('issued', grade='9В', meal_type=menu.meal_type,
+                                                     day=menu.date)
+
+    assert updated == [paid_id]
+    assert skipped == [{'id': pending_id, 'reason': 'status', 'status': 'pending'}]
@@ -0,0 +1,13 @@
+def test_products_pages_and_rejects_bad_cursor(app):
+    client = app.test_client()
+    first = client.get('/api/products', query_string={'limit': 2, 'fields': 'name'})
+    assert first.status_code == 200
+    cursor = first.get_json()['next_cursor']
+    assert cursor
+    second = client.get('/api/products', query_string={'limit': 2, 'fields': 'name', 'cursor': cursor})
+    assert second.status_code == 200
+    assert second.get_json()['items'] != first.get_json()['items']
+
+    response = client.get('/api/products', query_string={'cursor': 'zzz'})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
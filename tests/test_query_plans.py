@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import canteen
+
+# Запрос из dashboard_queries -> индекс, который он обязан использовать
+EXPECTED_INDEXES = {
+    'kitchen_orders': 'ix_orders_order_date_status',
+    'student_orders': 'ix_orders_student_id_order_date',
+    'admin_today_orders': 'ix_orders_order_date_status',
+    'menu_for_date': 'uq_menus_date_meal_type_dish_name',
+    'student_by_user': 'ix_students_user_id',
+    'login_user': 'sqlite_autoindex_users_1',
+    'mobile_order_history': 'ix_orders_student_id_order_date',
+    'pending_requests': 'ix_purchase_requests_status_request_date',
+    'recent_reviews': 'ix_reviews_date',
+    'purchase_history_page': 'ix_purchase_requests_request_date',
+    'products_low_stock_page': 'ix_products_low_stock_name',
+    'products_prefix_page': 'uq_products_name',
+    'export_orders': 'ix_orders_order_date_status',
+    'export_payments': 'ix_payments_payment_date_status',
+    'export_reviews': 'ix_reviews_date',
+}
+
+
+@pytest.fixture
+def plans(app):
+    with app.app_context():
+        yield {name: canteen.explain_query_plan(query)
+               for name, query in canteen.dashboard_queries(datetime.now().date()).items()}
+
+
+def test_every_dashboard_query_has_an_expected_index(plans):
+    assert set(plans) == set(EXPECTED_INDEXES)
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED_INDEXES))
+def test_dashboard_query_uses_index(plans, name):
+    plan = plans[name]
+    assert any(EXPECTED_INDEXES[name] in line for line in plan), plan
+    assert not [line for line in plan if line.startswith('SCAN') and 'INDEX' not in line], plan